@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import resource
+import argparse
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'scripts'))
+
+import synthetic
+import stand_ins
+
+"""Benchmarks for the Python side of the pipeline"""
+# Each benchmark times one Python hot path (FASTA handling, coverage parsing, VCF filtering and consensus, edit
+# counting, correct_regions) or the full run_conditions() flow on synthetic inputs, with the external tools replaced by
+# the stand-ins in stand_ins.py. Every measurement runs in a fresh worker process, so its peak RSS is its own. Results
+# are written to benchmark_results.tsv/.json in the output directory, with the scaling exponent of each benchmark's
+# run time with genome size (1.0 is linear) in benchmark_scaling.tsv.
+
+# The start-site database shipped in db/; fixstart stops when it has none.
+START_SITES = os.path.join(BENCHMARK_DIR, '..', 'db', 'dnaA_and_plasmid_startSites.fasta')
+RESULT_COLUMNS = ('benchmark', 'genome_mb', 'depth', 'seconds', 'mb_per_second', 'peak_rss_mb', 'rss_growth_mb',
+                  'details')
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_fasta_read(data, workdir):
+    from fasta_io import read_fasta
+    records, seconds = timed(read_fasta, data['genome'])
+    return seconds, {'records': len(records)}
+
+
+def bench_fasta_write(data, workdir):
+    from fasta_io import read_fasta, write_fasta
+    records = read_fasta(data['genome'])
+    seconds = timed(write_fasta, records, os.path.join(workdir, 'written.fasta'), 80)[1]
+    return seconds, {}
+
+
+def bench_fasta_normalise(data, workdir):
+    from fasta_io import read_fasta, normalise_fasta
+    records = read_fasta(data['genome'])
+    descriptions = dict((name, 'LN:i:{0} RC:i:50 XC:f:1.000000'.format(len(seq))) for name, seq in records)
+    racon_style = synthetic.write_fasta(records, os.path.join(workdir, 'racon.fasta'), line_width=10 ** 9,
+                                        descriptions=descriptions)
+    seconds = timed(normalise_fasta, racon_style, os.path.join(workdir, 'normalised.fasta'))[1]
+    return seconds, {}
+
+
+def bench_fasta_fetch(data, workdir, windows=2000, window=5000):
+    from fasta_io import FastaIndex
+    with FastaIndex(data['genome']) as fasta:
+        rng = random.Random(1)
+        regions = []
+        for _ in range(windows):
+            name = rng.choice(fasta.names)
+            start = rng.randrange(max(1, fasta.length(name) - window))
+            regions.append((name, start, start + window))
+        seconds = timed(lambda: [fasta.fetch(*region) for region in regions])[1]
+    return seconds, {'windows': windows, 'window': window}
+
+
+def bench_coverage(coverage_file, cutoff_divisor=8, read_length=300):
+    from coverage_runs import read_coverage
+    coverage = read_coverage(coverage_file)
+    cutoff = int(round(coverage.median() / cutoff_divisor))
+    regions = coverage.low_coverage_regions(cutoff, read_length)
+    return sum(len(found) for found in regions.values())
+
+
+def bench_coverage_bedgraph(data, workdir):
+    regions, seconds = timed(bench_coverage, data['coverage'])
+    return seconds, {'low_coverage_regions': regions}
+
+
+def bench_coverage_per_base(data, workdir):
+    regions, seconds = timed(bench_coverage, data['per_base_coverage'])
+    return seconds, {'low_coverage_regions': regions}
+
+
+def bench_filter_vcf(data, workdir):
+    import fix_repeats
+    seconds = timed(fix_repeats.filter_vcf, data['vcf'], os.path.join(workdir, 'filtered.vcf'))[1]
+    return seconds, {}
+
+
+def bench_variant_consensus(data, workdir):
+    import variants
+    from fasta_io import read_fasta
+    sequences = dict(read_fasta(data['genome']))
+
+    def apply():
+        with open(data['vcf']) as vcf:
+            calls = variants.read_variants(vcf)
+        return variants.apply_consensus(sequences, calls), calls
+    (consensus, calls), seconds = timed(apply)
+    return seconds, {'variants_applied': sum(len(found) for found in calls.values())}
+
+
+def bench_seq_diff(data, workdir, edits_per_mb=200):
+    from fasta_io import read_fasta
+    from seq_diff import diff_assemblies
+    records = read_fasta(data['genome'])
+    rng = random.Random(1)
+    polished = []
+    for name, seq in records:
+        bases = bytearray(seq.encode())
+        for _ in range(int(len(bases) * edits_per_mb / 1e6)):
+            bases[rng.randrange(len(bases))] = ord(rng.choice('ACGT'))
+        polished.append((name, bases.decode()))
+    edits, seconds = timed(diff_assemblies, records, polished)
+    return seconds, {'edits': sum(counts.total() for counts in edits.values())}
+
+
+def bench_correct_regions(data, workdir):
+    import fix_repeats
+    seconds = timed(fix_repeats.correct_regions, data['genome'], data['pe_reads'], data['coverage'], workdir,
+                    os.path.join(workdir, 'corrected.fasta'), 300, str(data['threads']))[1]
+    return seconds, {}
+
+
+# bench_full_flow() runs flye_pipeline.run_conditions() on the synthetic reads with every tool replaced by its
+# stand-in. 'tool_seconds' is the wall time spent in external commands (from run_metrics.json) and 'python_seconds'
+# the remainder: orchestration and the Python hot paths between tools.
+def bench_full_flow(data, workdir):
+    import flye_pipeline
+    outdir = os.path.join(workdir, 'pipeline')
+    tools = data['tools']
+    sys.argv = ['flye_pipeline.py', '-t', str(data['threads']), '-s', 'bench', '-o', outdir,
+                '-l', data['long_reads'], '-pe', data['pe_reads'], '-d', START_SITES,
+                '--flye_path', tools['flye'], '--berokka_path', tools['berokka'],
+                '--circlator_path', tools['circlator'], '--minimap2_path', tools['minimap2'],
+                '--bwa_path', tools['bwa'], '--racon_path', tools['racon'], '--medaka_path', tools['medaka_consensus']]
+    seconds = timed(flye_pipeline.run_conditions)[1]
+    with open(os.path.join(outdir, 'run_metrics.json')) as handle:
+        commands = json.load(handle)['commands']
+    tool_seconds = sum(command['wall_seconds'] for command in commands)
+    return seconds, {'commands': len(commands), 'tool_seconds': round(tool_seconds, 2),
+                     'python_seconds': round(seconds - tool_seconds, 2)}
+
+
+# bench_medaka_batch() runs a batch of MEDAKA_SAMPLES samples up to the medaka stage twice, with medaka_consensus for
+# each sample and with one shared medaka run (--medaka_batch), and reports samples per hour for both. The stand-in
+# medaka takes MEDAKA_STARTUP seconds per model load.
+MEDAKA_SAMPLES = 4
+MEDAKA_STARTUP = 1.0
+
+
+def bench_medaka_batch(data, workdir):
+    import flye_pipeline
+    os.environ['BENCH_MEDAKA_STARTUP'] = str(MEDAKA_STARTUP)
+    samplesheet = os.path.join(workdir, 'samples.tsv')
+    with open(samplesheet, 'w') as sheet:
+        sheet.write('sample_name\tlong_reads\tpe_reads\n')
+        for index in range(MEDAKA_SAMPLES):
+            sheet.write('s{0}\t{1}\t{2}\n'.format(index, data['long_reads'], data['pe_reads']))
+    tools = data['tools']
+    details = {}
+    for batch in (1, MEDAKA_SAMPLES):
+        args = flye_pipeline.get_arguments(
+            ['-t', str(data['threads']), '-o', os.path.join(workdir, 'batch_{0}'.format(batch)), '--samplesheet',
+             samplesheet, '--to_stage', 'medaka', '--medaka_batch', str(batch), '-d', START_SITES, '--flye_path',
+             tools['flye'], '--berokka_path', tools['berokka'], '--circlator_path', tools['circlator'],
+             '--minimap2_path', tools['minimap2'], '--bwa_path', tools['bwa'], '--racon_path', tools['racon'],
+             '--medaka_path', tools['medaka_consensus']])
+        seconds = timed(flye_pipeline.run_batch, args)[1]
+        details['samples_per_hour_batch_{0}'.format(batch)] = round(MEDAKA_SAMPLES * 3600 / seconds, 1)
+    return seconds, details
+
+
+# name: (function, varies with depth, inputs it needs beyond the genome)
+BENCHMARKS = [
+    ('fasta_read', bench_fasta_read, False, ()),
+    ('fasta_write', bench_fasta_write, False, ()),
+    ('fasta_normalise', bench_fasta_normalise, False, ()),
+    ('fasta_fetch', bench_fasta_fetch, False, ()),
+    ('coverage_bedgraph', bench_coverage_bedgraph, True, ('coverage',)),
+    ('coverage_per_base', bench_coverage_per_base, True, ('per_base_coverage',)),
+    ('filter_vcf', bench_filter_vcf, True, ('vcf',)),
+    ('variant_consensus', bench_variant_consensus, True, ('vcf',)),
+    ('seq_diff', bench_seq_diff, False, ()),
+    ('correct_regions', bench_correct_regions, True, ('coverage', 'reads')),
+    ('full_flow', bench_full_flow, True, ('coverage', 'reads')),
+    ('medaka_batch', bench_medaka_batch, True, ('reads',)),
+]
+
+
+# prepare_inputs() writes (or re-uses) the synthetic inputs for one genome size and depth.
+def prepare_inputs(data_dir, size_mb, depth, read_depth, needs, seed):
+    size_dir = os.path.join(data_dir, '{0:g}mb'.format(size_mb))
+    os.makedirs(size_dir, exist_ok=True)
+    data = {'genome_mb': size_mb, 'depth': depth, 'genome': os.path.join(size_dir, 'genome.fasta')}
+    generated = {}
+
+    def genome_and_repeats():
+        if 'genome' not in generated:
+            generated['genome'] = synthetic.make_genome(size_mb, seed)
+        return generated['genome']
+
+    def generate(key, path, writer):
+        data[key] = path
+        if not os.path.isfile(path):
+            print("Writing {0}".format(path))
+            records, repeats = genome_and_repeats()
+            writer(records, repeats, path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    generate('genome', data['genome'], lambda records, repeats, path: synthetic.write_fasta(records, path))
+    depth_prefix = os.path.join(size_dir, '{0}x'.format(depth))
+    if 'coverage' in needs:
+        generate('coverage', depth_prefix + '_coverage.bedgraph',
+                 lambda records, repeats, path: synthetic.write_coverage(records, repeats, depth, path, seed=seed))
+    if 'per_base_coverage' in needs:
+        generate('per_base_coverage', depth_prefix + '_coverage.txt',
+                 lambda records, repeats, path: synthetic.write_coverage(records, repeats, depth, path, per_base=True,
+                                                                         seed=seed))
+    if 'vcf' in needs:
+        generate('vcf', depth_prefix + '_calls.vcf',
+                 lambda records, repeats, path: synthetic.write_vcf(records, path, depth, seed=seed))
+    if 'reads' in needs:
+        reads_prefix = os.path.join(size_dir, '{0}x_reads_'.format(read_depth))
+        generate('long_reads', reads_prefix + 'long.fastq',
+                 lambda records, repeats, path: synthetic.write_long_reads(records, path, read_depth, seed=seed))
+        generate('pe_reads', reads_prefix + 'pe.fastq',
+                 lambda records, repeats, path: synthetic.write_pe_reads(records, path, read_depth, seed=seed))
+    return data
+
+
+# run_worker() is the entry point of the worker process: it runs one benchmark and writes its result to a JSON file.
+def run_worker(name, data_file, result_file):
+    with open(data_file) as handle:
+        data = json.load(handle)
+    baseline = peak_rss_mb()
+    function = dict((bench[0], bench[1]) for bench in BENCHMARKS)[name]
+    seconds, details = function(data, data['workdir'])
+    peak = peak_rss_mb()
+    result = {'benchmark': name, 'genome_mb': data['genome_mb'], 'depth': data['depth'] if data['uses_depth'] else '',
+              'seconds': round(seconds, 4), 'mb_per_second': round(data['genome_mb'] / seconds, 3) if seconds else '',
+              'peak_rss_mb': round(peak, 1), 'rss_growth_mb': round(peak - baseline, 1), 'details': details}
+    with open(result_file, 'w') as handle:
+        json.dump(result, handle)
+
+
+def run_benchmark(name, data, outdir, repeat):
+    best = None
+    for attempt in range(repeat):
+        workdir = os.path.join(outdir, 'work', '{0}_{1:g}mb_{2}x_{3}'.format(name, data['genome_mb'], data['depth'],
+                                                                             attempt))
+        if os.path.isdir(workdir):
+            subprocess.run(['rm', '-rf', workdir])
+        os.makedirs(workdir)
+        data = dict(data, workdir=workdir)
+        data_file = os.path.join(workdir, 'data.json')
+        result_file = os.path.join(workdir, 'result.json')
+        with open(data_file, 'w') as handle:
+            json.dump(data, handle)
+        env = dict(os.environ, PATH=data['bin_dir'] + os.pathsep + os.environ.get('PATH', ''),
+                   BENCH_GENOME=data['genome'], BENCH_COVERAGE=data.get('coverage', ''), BENCH_DEPTH=str(data['depth']))
+        with open(os.path.join(workdir, 'worker.log'), 'w') as log:
+            worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', name, '--data', data_file,
+                                     '--result', result_file], stdout=log, stderr=subprocess.STDOUT, env=env)
+        if worker.returncode != 0:
+            raise Exception("Benchmark {0} failed, see {1}".format(name, os.path.join(workdir, 'worker.log')))
+        with open(result_file) as handle:
+            result = json.load(handle)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+# scaling_exponent() fits log(seconds) = k * log(genome size) + c; k is about 1 for a linear-time hot path.
+def scaling_exponent(points):
+    if len(points) < 2:
+        return None
+    xs = [math.log(size) for size, seconds in points]
+    ys = [math.log(max(seconds, 1e-6)) for size, seconds in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    if spread == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread
+
+
+def write_reports(results, outdir):
+    with open(os.path.join(outdir, 'benchmark_results.json'), 'w') as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+    with open(os.path.join(outdir, 'benchmark_results.tsv'), 'w') as tsv:
+        tsv.write('\t'.join(RESULT_COLUMNS) + '\n')
+        for result in results:
+            details = ';'.join('{0}={1}'.format(key, value) for key, value in sorted(result['details'].items()))
+            tsv.write('\t'.join(str(result[column]) for column in RESULT_COLUMNS[:-1]) + '\t' + details + '\n')
+    curves = {}
+    for result in results:
+        curves.setdefault((result['benchmark'], result['depth']), []).append((result['genome_mb'], result['seconds']))
+    print("\nScaling with genome size (exponent 1.0 = linear):")
+    with open(os.path.join(outdir, 'benchmark_scaling.tsv'), 'w') as tsv:
+        tsv.write('benchmark\tdepth\tgenome_mb\tseconds\tscaling_exponent\n')
+        for (name, depth), points in curves.items():
+            exponent = scaling_exponent(points)
+            sizes = ','.join('{0:g}'.format(size) for size, seconds in points)
+            times = ','.join('{0:.3f}'.format(seconds) for size, seconds in points)
+            exponent_text = '{0:.2f}'.format(exponent) if exponent is not None else 'NA'
+            tsv.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(name, depth, sizes, times, exponent_text))
+            print("{0:<20} {1:>5} {2:>6}".format(name, '{0}x'.format(depth) if depth != '' else '', exponent_text))
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline's Python hot paths on synthetic data")
+    parser.add_argument('-o', '--outdir', default='benchmark_results', help="Directory for inputs, work and reports")
+    parser.add_argument('--sizes', default='1,4,12', help="Comma-separated genome sizes in Mb")
+    parser.add_argument('--depths', default='30,100,500', help="Comma-separated coverage depths")
+    parser.add_argument('--read_depth', type=int, default=10,
+                        help="Depth of the synthetic reads for correct_regions and full_flow")
+    parser.add_argument('--benchmarks', default=','.join(bench[0] for bench in BENCHMARKS),
+                        help="Comma-separated benchmarks to run")
+    parser.add_argument('-t', '--threads', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1, help="Run each measurement N times and keep the fastest")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def run_conditions():
+    args = get_arguments()
+    if args.worker is not None:
+        run_worker(args.worker, args.data, args.result)
+        return
+    selected = args.benchmarks.split(',')
+    unknown = set(selected) - set(bench[0] for bench in BENCHMARKS)
+    if unknown:
+        raise Exception("Unknown benchmark(s): {0}".format(', '.join(sorted(unknown))))
+    outdir = os.path.abspath(args.outdir)
+    os.makedirs(outdir, exist_ok=True)
+    tools = stand_ins.install(os.path.join(outdir, 'bin'))
+    results = []
+    for size_mb in [float(size) for size in args.sizes.split(',')]:
+        for index, depth in enumerate([int(depth) for depth in args.depths.split(',')]):
+            for name, function, uses_depth, needs in BENCHMARKS:
+                if name not in selected or (not uses_depth and index > 0):
+                    continue
+                data = prepare_inputs(os.path.join(outdir, 'data'), size_mb, depth, args.read_depth, needs, args.seed)
+                data.update({'threads': args.threads, 'tools': tools, 'bin_dir': os.path.join(outdir, 'bin'),
+                             'uses_depth': uses_depth})
+                result = run_benchmark(name, data, outdir, args.repeat)
+                results.append(result)
+                print("{0:<20} {1:>6g} Mb {2:>5} {3:>9.3f}s {4:>9} Mb/s {5:>8.1f} MB peak RSS".format(
+                    name, size_mb, '{0}x'.format(depth) if uses_depth else '', result['seconds'],
+                    result['mb_per_second'], result['peak_rss_mb']))
+                sys.stdout.flush()
+    write_reports(results, outdir)
+
+
+if __name__ == "__main__":
+    run_conditions()
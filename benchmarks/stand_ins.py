@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import gzip
+import shutil
+import random
+import time
+import zlib
+
+from synthetic import COMPLEMENT, read_fasta, vcf_header, vcf_lines
+
+"""Lightweight stand-ins for the external tools"""
+# install() links this file into a directory under the names of the tools the pipeline calls; each link then behaves
+# like that tool just far enough for the pipeline to run end to end in seconds: flye returns the synthetic genome,
+# racon/medaka/circlator/berokka pass their draft through, minimap2 and bwa report every read at the position recorded
+# in its header, and bedtools/bcftools report coverage and variants for the synthetic data. The directory goes first on
+# PATH (fix_repeats calls bwa, samtools, bcftools and bedtools by name) and its links can be passed to the '--*_path'
+# options. Inputs that a real tool would read are read in full, so I/O is still exercised.
+#
+# Environment: BENCH_GENOME (the FASTA flye returns), BENCH_COVERAGE (bedGraph reported for the whole assembly),
+# BENCH_DEPTH (depth reported otherwise, default 50), BENCH_REDO (report zero depth on fix_repeats regions),
+# BENCH_VARIANT_RATE (variants per kb reported by bcftools, default 0.5), BENCH_RACON_EDITS (substitutions per Mb
+# made by racon, default 0), BENCH_MEDAKA_STARTUP (seconds medaka takes to load its model, default 0).
+
+TOOLS = ('flye', 'berokka', 'circlator', 'minimap2', 'racon', 'medaka_consensus', 'medaka', 'mini_align', 'bwa',
+         'samtools', 'bedtools', 'bcftools')
+
+
+def install(bin_dir):
+    """Link the stand-ins into 'bin_dir'; returns a dict of tool name to path"""
+    os.makedirs(bin_dir, exist_ok=True)
+    source = os.path.abspath(__file__)
+    paths = {}
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        if not os.path.islink(path):
+            os.symlink(source, path)
+        paths[tool] = path
+    return paths
+
+
+def positional(args, skip_values=()):
+    """Arguments that are not options or the values of the options in 'skip_values'"""
+    values = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in skip_values:
+            skip = True
+        elif not arg.startswith('-'):
+            values.append(arg)
+    return values
+
+
+def consume(path):
+    """Read a file the way a tool would, in chunks"""
+    with open(path, 'rb') as handle:
+        while handle.read(1 << 20):
+            pass
+
+
+def reference_fasta(path):
+    """The FASTA behind an index path (bwa prefix, cached minimap2 .mmi)"""
+    if path.endswith('.mmi'):
+        path = path.rsplit('.', 2)[0]
+    return path
+
+
+# read_tags() returns the name of a read as bwa reports it (the first word without a trailing /1 or /2) and the tags in
+# its header, also when the interleaver has joined them onto the name with underscores.
+def read_tags(header):
+    name = header[1:].split()[0]
+    if name.endswith(('/1', '/2')):
+        name = name[:-2]
+    fields = re.sub(r'_(?=[a-z]+=)', ' ', header[1:]).split()
+    tags = dict(field.split('=', 1) for field in fields[1:] if '=' in field)
+    return name, tags
+
+
+# align() writes a SAM (or PAF) record for every read of a FASTQ file at the contig/position in its header. Contigs
+# renamed '<sample>|<contig>' by medaka batching are matched on their original name.
+def align(reference, reads, out, paf=False):
+    lengths = dict((name, len(seq)) for name, seq in read_fasta(reference_fasta(reference)))
+    aliases = dict((name.split('|')[-1], name) for name in lengths)
+    if not paf:
+        out.write('@HD\tVN:1.6\tSO:unsorted\n')
+        for name, length in lengths.items():
+            out.write('@SQ\tSN:{0}\tLN:{1}\n'.format(name, length))
+    with open(reads, 'rb') as handle:
+        gzipped = handle.read(2) == b'\x1f\x8b'
+    with (gzip.open(reads, 'rt') if gzipped else open(reads)) as fastq:
+        for header in fastq:
+            seq = fastq.readline().rstrip()
+            fastq.readline()
+            qual = fastq.readline().rstrip()
+            name, tags = read_tags(header)
+            contig = aliases.get(tags.get('contig'))
+            if contig not in lengths:
+                if not paf:
+                    out.write('{0}\t4\t*\t0\t0\t*\t*\t0\t0\t{1}\t{2}\n'.format(name, seq, qual))
+                continue
+            position = min(int(tags.get('pos', 1)), lengths[contig])
+            reverse = tags.get('strand') == '-'
+            if paf:
+                out.write('{0}\t{1}\t0\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{1}\t{1}\t60\n'.format(
+                    name, len(seq), '-' if reverse else '+', contig, lengths[contig], position - 1,
+                    min(lengths[contig], position - 1 + len(seq))))
+                continue
+            if reverse:
+                seq = seq.translate(COMPLEMENT)[::-1]
+                qual = qual[::-1]
+            out.write('{0}\t{1}\t{2}\t{3}\t60\t{4}M\t*\t0\t0\t{5}\t{6}\n'.format(
+                name, 16 if reverse else 0, contig, position, len(seq), seq, qual))
+
+
+def write_fai(fasta_file):
+    entries = []
+    offset = 0
+    with open(fasta_file, 'rb') as fasta:
+        for line in fasta:
+            offset += len(line)
+            if line.startswith(b'>'):
+                entries.append([line[1:].split()[0].decode(), 0, offset, 0, 0])
+            elif entries:
+                if entries[-1][3] == 0:
+                    entries[-1][3:] = [len(line.rstrip()), len(line)]
+                entries[-1][1] += len(line.rstrip())
+    with open(fasta_file + '.fai', 'w') as fai:
+        for entry in entries:
+            fai.write('\t'.join(str(value) for value in entry) + '\n')
+
+
+def sam_lengths(sam_file):
+    lengths = {}
+    with open(sam_file) as sam:
+        for line in sam:
+            if not line.startswith('@'):
+                break
+            if line.startswith('@SQ'):
+                tags = dict(field.split(':', 1) for field in line.rstrip('\n').split('\t')[1:])
+                lengths[tags['SN']] = int(tags['LN'])
+    return lengths
+
+
+def flye(args):
+    read_mode = '--nano-hq' if '--nano-hq' in args else '--nano-raw'
+    consume(args[args.index(read_mode) + 1])
+    outdir = args[args.index('-o') + 1]
+    os.makedirs(outdir, exist_ok=True)
+    shutil.copyfile(os.environ['BENCH_GENOME'], os.path.join(outdir, 'assembly.fasta'))
+
+
+def berokka(args):
+    outdir = args[args.index('--outdir') + 1]
+    os.makedirs(outdir, exist_ok=True)
+    shutil.copyfile(positional(args, ('--outdir',))[0], os.path.join(outdir, '02.trimmed.fa'))
+
+
+def circlator(args):
+    values = positional(args[1:], ('--genes_fa', '--min_contig_length'))
+    shutil.copyfile(values[0], values[1] + '.fasta')
+
+
+def minimap2(args):
+    values = positional(args, ('-t', '-x', '-ax', '-d'))
+    if '-d' in args:
+        shutil.copyfile(values[0], args[args.index('-d') + 1])
+        return
+    align(values[0], values[1], sys.stdout, paf='-ax' not in args and '-a' not in args)
+
+
+def racon(args):
+    values = positional(args, ('-t', '-m', '-x', '-g', '-w'))
+    consume(values[0])
+    consume(values[1])
+    rng = random.Random(zlib.crc32(values[2].encode()))
+    edits_per_mb = float(os.environ.get('BENCH_RACON_EDITS', '0'))
+    for name, seq in read_fasta(values[2]):
+        if edits_per_mb:
+            bases = bytearray(seq.encode())
+            for _ in range(int(len(bases) * edits_per_mb / 1e6)):
+                bases[rng.randrange(len(bases))] = ord(rng.choice('ACGT'))
+            seq = bases.decode()
+        sys.stdout.write('>{0} LN:i:{1} RC:i:50 XC:f:1.000000\n{2}\n'.format(name, len(seq), seq))
+
+
+def medaka_consensus(args):
+    if '-h' in args:
+        print('medaka 1.0.3 (stand-in)')
+        return
+    time.sleep(float(os.environ.get('BENCH_MEDAKA_STARTUP', '0')))
+    consume(args[args.index('-i') + 1])
+    outdir = args[args.index('-o') + 1]
+    os.makedirs(outdir, exist_ok=True)
+    shutil.copyfile(args[args.index('-d') + 1], os.path.join(outdir, 'consensus.fasta'))
+
+
+def mini_align(args):
+    with open(args[args.index('-p') + 1] + '.bam', 'w') as out:
+        align(args[args.index('-r') + 1], args[args.index('-i') + 1], out)
+
+
+# medaka() stands in for 'medaka consensus' (which lists the contigs with aligned reads) and 'medaka stitch' (which
+# writes those contigs of the draft).
+def medaka(args):
+    if args[0] == 'consensus':
+        time.sleep(float(os.environ.get('BENCH_MEDAKA_STARTUP', '0')))
+        with open(args[1]) as sam, open(args[2], 'w') as out:
+            contigs = set(line.split('\t')[2] for line in sam if not line.startswith('@'))
+            out.write('\n'.join(sorted(contigs - {'*'})) + '\n')
+    elif args[0] == 'stitch':
+        with open(args[1]) as hdf:
+            contigs = set(hdf.read().split())
+        with open(args[3], 'w') as out:
+            for name, seq in read_fasta(args[2]):
+                if name in contigs:
+                    out.write('>{0}\n{1}\n'.format(name, seq))
+
+
+def bwa(args):
+    if not args:
+        sys.stderr.write('Program: bwa (stand-in)\nVersion: 0.7.17-r1188\n')
+        sys.exit(1)
+    if args[0] == 'index':
+        for suffix in ('amb', 'ann', 'bwt', 'pac', 'sa'):
+            open('{0}.{1}'.format(args[-1], suffix), 'w').close()
+    elif args[0] == 'mem':
+        values = positional(args[1:], ('-t', '-o'))
+        if '-o' in args:
+            with open(args[args.index('-o') + 1], 'w') as out:
+                align(values[0], values[1], out)
+        else:
+            align(values[0], values[1], sys.stdout)
+
+
+def samtools(args):
+    if args[0] == '--version':
+        print('samtools 1.10 (stand-in)')
+    elif args[0] == 'view':
+        exclude = int(args[args.index('-F') + 1], 0) if '-F' in args else 0
+        with open(positional(args[1:], ('-t', '-@', '-F'))[-1]) as sam:
+            for line in sam:
+                if line.startswith('@'):
+                    if '-h' in args:
+                        sys.stdout.write(line)
+                elif int(line.split('\t', 2)[1]) & exclude == 0:
+                    sys.stdout.write(line)
+    elif args[0] == 'sort':
+        values = positional(args[1:], ('-@', '-m', '-o', '-T'))
+        source = open(values[0]) if values else sys.stdin
+        out = open(args[args.index('-o') + 1], 'w') if '-o' in args else sys.stdout
+        shutil.copyfileobj(source, out)
+        out.close()
+    elif args[0] == 'index':
+        open(args[-1] + '.bai', 'w').close()
+    elif args[0] == 'merge':
+        values = positional(args[1:], ('-@',))
+        headers = ['@HD\tVN:1.6\tSO:coordinate\n']
+        records = []
+        for path in values[1:]:
+            with open(path) as sam:
+                for line in sam:
+                    if line.startswith('@SQ'):
+                        headers.append(line)
+                    elif not line.startswith('@'):
+                        records.append(line)
+        with open(values[0], 'w') as out:
+            out.writelines(headers + records)
+    elif args[0] == 'faidx':
+        write_fai(args[1])
+    elif args[0] == 'fastq':
+        with open(args[-1]) as sam:
+            for line in sam:
+                if line.startswith('@'):
+                    continue
+                fields = line.split('\t')
+                if int(fields[1]) & 0x904 == 0:
+                    sys.stdout.write('@{0}\n{1}\n+\n{2}\n'.format(fields[0], fields[9], fields[10].rstrip('\n')))
+
+
+def bedtools(args):
+    if args[0] == '--version':
+        print('bedtools v2.29.2 (stand-in)')
+        return
+    depth = int(os.environ.get('BENCH_DEPTH', '50'))
+    if '-g' in args:
+        with open(args[args.index('-g') + 1]) as genome:
+            for line in genome:
+                name, length = line.split()[:2]
+                sys.stdout.write('{0}\t0\t{1}\t{2}\n'.format(name, length, 0 if os.environ.get('BENCH_REDO') else depth))
+        return
+    lengths = sam_lengths(args[args.index('-ibam') + 1])
+    coverage = os.environ.get('BENCH_COVERAGE')
+    if coverage:
+        with open(coverage) as track:
+            names = set(line.split('\t', 1)[0] for line in track)
+        if names == set(lengths):
+            with open(coverage) as track:
+                shutil.copyfileobj(track, sys.stdout)
+            return
+    for name, length in lengths.items():
+        sys.stdout.write('{0}\t0\t{1}\t{2}\n'.format(name, length, depth))
+
+
+def bcftools(args):
+    if args[0] == '--version':
+        print('bcftools 1.10.2 (stand-in)')
+    elif args[0] == 'mpileup':
+        consume(positional(args[1:], ('-f',))[-1])
+        records = read_fasta(args[args.index('-f') + 1])
+        rng = random.Random(zlib.crc32(''.join(name for name, seq in records).encode()))
+        sys.stdout.writelines(vcf_header(records))
+        rate = float(os.environ.get('BENCH_VARIANT_RATE', '0.5'))
+        for name, seq in records:
+            sys.stdout.writelines(vcf_lines(name, seq, rng, int(os.environ.get('BENCH_DEPTH', '50')), rate))
+    elif args[0] == 'call':
+        shutil.copyfileobj(sys.stdin, sys.stdout)
+
+
+if __name__ == "__main__":
+    tool = os.path.basename(sys.argv[0])
+    arguments = sys.argv[1:]
+    if tool not in TOOLS:
+        sys.exit("Run this file through the links made by install(), e.g. bin/racon")
+    if '--version' in arguments and tool not in ('samtools', 'bcftools', 'bedtools'):
+        print('{0} (stand-in)'.format(tool))
+        sys.exit(0)
+    globals()[tool](arguments)
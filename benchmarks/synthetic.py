@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+import os
+import math
+import random
+import argparse
+
+"""Synthetic inputs for the benchmark suite"""
+# Generates a multi-replicon genome (a chromosome plus plasmids, with copies of an IS-like repeat in the chromosome),
+# coverage tracks for it at a given depth (bedGraph as from 'bedtools genomecov -bga', or per-base as from
+# 'genomecov -d') with coverage dips over the repeat copies, bcftools-call style VCF records, and ONT-like long reads
+# and interleaved paired-end short reads. Read headers carry the contig, position and strand they were sampled from, so
+# that the stand-in aligners can report them without aligning anything.
+
+# Share of the genome in the chromosome and each plasmid.
+REPLICON_FRACTIONS = (0.92, 0.05, 0.02, 0.01)
+REPEAT_LENGTH = 1300
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choices('ACGT', k=length))
+
+
+# make_genome() returns a list of (name, sequence) replicons totalling about 'size_mb' Mb, and a dict of contig name to
+# the (start, end) intervals of the repeat copies.
+def make_genome(size_mb, seed=1):
+    rng = random.Random(seed)
+    total = int(size_mb * 1e6)
+    repeat = random_sequence(rng, REPEAT_LENGTH)
+    records = []
+    repeats = {}
+    for index, fraction in enumerate(REPLICON_FRACTIONS):
+        name = 'chromosome' if index == 0 else 'plasmid_{0}'.format(index)
+        length = max(2000, int(total * fraction))
+        seq = random_sequence(rng, length)
+        repeats[name] = []
+        if index == 0:
+            copies = max(2, int(size_mb * 4))
+            step = length // (copies + 1)
+            for copy in range(copies):
+                start = step * (copy + 1)
+                seq = seq[:start] + repeat + seq[start + REPEAT_LENGTH:]
+                repeats[name].append((start, start + REPEAT_LENGTH))
+        records.append((name, seq))
+    return records, repeats
+
+
+def write_fasta(records, path, line_width=60, descriptions=None):
+    with open(path, 'w') as fasta:
+        for name, seq in records:
+            header = name if descriptions is None else '{0} {1}'.format(name, descriptions.get(name, ''))
+            fasta.write('>' + header.rstrip() + '\n')
+            for i in range(0, len(seq), line_width):
+                fasta.write(seq[i:i + line_width] + '\n')
+    return path
+
+
+def read_fasta(path):
+    records = []
+    with open(path) as fasta:
+        for line in fasta:
+            if line.startswith('>'):
+                records.append([line[1:].split()[0], []])
+            else:
+                records[-1][1].append(line.strip())
+    return [(name, ''.join(chunks)) for name, chunks in records]
+
+
+# coverage_runs() yields (start, end, depth) runs for one contig: runs of 1-30 bases with depths scattered around
+# 'depth', dropping to about a twentieth of it over the repeat copies.
+def coverage_runs(rng, length, depth, repeats):
+    spread = max(1.0, math.sqrt(depth))
+    boundaries = sorted(set([0, length] + [position for interval in repeats for position in interval]))
+    for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+        in_repeat = any(start <= segment_start < stop for start, stop in repeats)
+        mean, sd = (depth / 20.0, spread / 20.0) if in_repeat else (depth, spread)
+        position = segment_start
+        while position < segment_end:
+            end = min(segment_end, position + rng.randint(1, 30))
+            yield position, end, max(0, int(rng.gauss(mean, sd)))
+            position = end
+
+
+def write_coverage(records, repeats, depth, path, per_base=False, seed=1):
+    rng = random.Random(seed)
+    with open(path, 'w') as out:
+        for name, seq in records:
+            for start, end, value in coverage_runs(rng, len(seq), depth, repeats.get(name, [])):
+                if per_base:
+                    for position in range(start + 1, end + 1):
+                        out.write('{0}\t{1}\t{2}\n'.format(name, position, value))
+                else:
+                    out.write('{0}\t{1}\t{2}\t{3}\n'.format(name, start, end, value))
+    return path
+
+
+# vcf_lines() yields 'bcftools call -cv' style records for one sequence at about 'rate' sites per kb: mostly SNPs, with
+# insertions, deletions, multi-allelic sites and overlapping records mixed in, and a share of records that fail the
+# allele frequency, mapping quality or alternative read support filters.
+def vcf_lines(name, seq, rng, depth=50, rate=0.5):
+    position = rng.randint(1, 50)
+    while position < len(seq) - 20:
+        ref_base = seq[position - 1]
+        kind = rng.random()
+        alt_base = rng.choice([base for base in 'ACGT' if base != ref_base])
+        genotype = '1'
+        if kind < 0.7:
+            ref, alt = ref_base, alt_base
+        elif kind < 0.8:
+            ref, alt = ref_base, ref_base + random_sequence(rng, rng.randint(1, 6))
+        elif kind < 0.9:
+            ref, alt = seq[position - 1:position + rng.randint(1, 6)], ref_base
+        elif kind < 0.95:
+            ref, alt = ref_base, '{0},{1}'.format(alt_base, ref_base + random_sequence(rng, 2))
+            genotype = rng.choice(['1', '2'])
+        else:
+            ref, alt = seq[position - 1:position + 3], ref_base
+        dp = max(2, int(rng.gauss(depth, math.sqrt(depth))))
+        af1 = 1.0 if rng.random() < 0.8 else 0.5
+        mq = 60 if rng.random() < 0.95 else 5
+        alt_reads = dp if rng.random() < 0.97 else 1
+        dp4 = '0,{0},{1},{2}'.format(dp - alt_reads, alt_reads // 2, alt_reads - alt_reads // 2)
+        info = 'DP={0};AF1={1};AC1=1;DP4={2};MQ={3};FQ=-{4}'.format(dp, af1, dp4, mq, rng.randint(30, 200))
+        if rng.random() < 0.1:
+            info += ';PV4={0},1,1,{1}'.format(rng.choice(['1', '1e-05']), rng.choice(['1', '0.5']))
+        yield '{0}\t{1}\t.\t{2}\t{3}\t{4}\t.\t{5}\tGT:PL\t{6}:{7},0\n'.format(
+            name, position, ref, alt, rng.randint(20, 225), info, genotype, rng.randint(50, 255))
+        # overlapping records: the next site occasionally falls inside this one
+        if len(ref) > 2 and rng.random() < 0.5:
+            position += 1
+        else:
+            position += len(ref) + max(1, int(rng.expovariate(rate / 1000.0)))
+
+
+def vcf_header(records):
+    lines = ['##fileformat=VCFv4.2\n']
+    for name, seq in records:
+        lines.append('##contig=<ID={0},length={1}>\n'.format(name, len(seq)))
+    lines.append('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n')
+    return lines
+
+
+def write_vcf(records, path, depth=50, rate=0.5, seed=1):
+    rng = random.Random(seed)
+    with open(path, 'w') as out:
+        out.writelines(vcf_header(records))
+        for name, seq in records:
+            out.writelines(vcf_lines(name, seq, rng, depth, rate))
+    return path
+
+
+def sample_fragment(rng, records, weights, length):
+    name, seq = rng.choices(records, weights=weights)[0]
+    start = rng.randrange(len(seq))
+    if length >= len(seq):
+        fragment = seq
+    elif start + length <= len(seq):
+        fragment = seq[start:start + length]
+    else:
+        fragment = seq[start:] + seq[:start + length - len(seq)]
+    return name, start + 1, fragment
+
+
+def add_errors(rng, seq, error_rate):
+    if not error_rate:
+        return seq
+    bases = bytearray(seq.encode())
+    for _ in range(int(len(bases) * error_rate)):
+        bases[rng.randrange(len(bases))] = ord(rng.choice('ACGT'))
+    return bases.decode()
+
+
+# write_long_reads() samples ONT-like reads (exponential length distribution, 'error_rate' substitutions) to 'depth'x.
+def write_long_reads(records, path, depth, mean_length=8000, error_rate=0.02, seed=1):
+    rng = random.Random(seed)
+    weights = [len(seq) for name, seq in records]
+    target = sum(weights) * depth
+    written = 0
+    index = 0
+    with open(path, 'w') as out:
+        while written < target:
+            length = max(500, int(rng.expovariate(1.0 / mean_length)))
+            name, position, fragment = sample_fragment(rng, records, weights, length)
+            strand = '+'
+            if rng.random() < 0.5:
+                fragment = fragment.translate(COMPLEMENT)[::-1]
+                strand = '-'
+            fragment = add_errors(rng, fragment, error_rate)
+            out.write('@long_{0} contig={1} pos={2} strand={3}\n{4}\n+\n{5}\n'.format(
+                index, name, position, strand, fragment, '5' * len(fragment)))
+            written += len(fragment)
+            index += 1
+    return path
+
+
+# write_pe_reads() samples interleaved 150 bp read pairs from 400 bp fragments to 'depth'x.
+def write_pe_reads(records, path, depth, read_length=150, insert_size=400, seed=1):
+    rng = random.Random(seed)
+    weights = [len(seq) for name, seq in records]
+    pairs = int(sum(weights) * depth / (2 * read_length))
+    quality = 'F' * read_length
+    with open(path, 'w') as out:
+        for index in range(pairs):
+            name, position, fragment = sample_fragment(rng, records, weights, insert_size)
+            mate1 = fragment[:read_length]
+            mate2 = fragment[-read_length:].translate(COMPLEMENT)[::-1]
+            out.write('@pe_{0}/1 contig={1} pos={2} strand=+\n{3}\n+\n{4}\n'.format(index, name, position, mate1,
+                                                                                    quality))
+            out.write('@pe_{0}/2 contig={1} pos={2} strand=-\n{3}\n+\n{4}\n'.format(
+                index, name, position + insert_size - read_length, mate2, quality))
+    return path
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Write a synthetic genome and matching benchmark inputs")
+    parser.add_argument('-o', '--outdir', required=True, help="Directory to write the inputs to")
+    parser.add_argument('--genome_size', type=float, default=5.0, help="Genome size in Mb")
+    parser.add_argument('--depth', type=int, default=100, help="Mean depth of the coverage track and VCF")
+    parser.add_argument('--read_depth', type=int, default=0, help="Depth of long and short reads to write (0: none)")
+    parser.add_argument('--per_base', action='store_true', default=False, help="Also write a per-base coverage file")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+    os.makedirs(args.outdir, exist_ok=True)
+    genome, repeat_copies = make_genome(args.genome_size, args.seed)
+    write_fasta(genome, os.path.join(args.outdir, 'genome.fasta'))
+    write_coverage(genome, repeat_copies, args.depth, os.path.join(args.outdir, 'coverage.bedgraph'), seed=args.seed)
+    if args.per_base:
+        write_coverage(genome, repeat_copies, args.depth, os.path.join(args.outdir, 'coverage.txt'), per_base=True,
+                       seed=args.seed)
+    write_vcf(genome, os.path.join(args.outdir, 'calls.vcf'), args.depth, seed=args.seed)
+    if args.read_depth:
+        write_long_reads(genome, os.path.join(args.outdir, 'long_reads.fastq'), args.read_depth, seed=args.seed)
+        write_pe_reads(genome, os.path.join(args.outdir, 'pe_reads.fastq'), args.read_depth, seed=args.seed)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import argparse
+import subprocess
+import concurrent.futures
+
+import telemetry
+import executor
+from stages import run_stages
+from index_cache import IndexCache
+from fasta_io import read_fasta, write_fasta
+from scratch import scratch_dir
+
+"""Per-contig parallel polishing"""
+# Multi-replicon assemblies (a chromosome plus several plasmids) are split by contig after circlator clean. A single
+# alignment of each read set against the whole assembly assigns every read to the replicon its primary alignment hits,
+# and each replicon is then polished with the usual racon1 .. racon4 stages as an independent job in a process pool, so
+# that small plasmids no longer wait behind the chromosome. The polished contigs are merged back in assembly order.
+
+# Stages of the single-sample pipeline that are run for each contig.
+PER_CONTIG_STAGES = ('racon1', 'racon4')
+
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+def contig_directory_name(index, contig_name):
+    return "{0:03d}_{1}".format(index + 1, re.sub(r'[^A-Za-z0-9._-]', '_', contig_name))
+
+
+# assign_reads() streams the SAM output of an aligner and writes every read with a primary alignment into the FASTQ
+# file of the contig it aligned to. Reads are taken from SEQ/QUAL of the primary record (reverse complemented back to
+# their original orientation), so the read file is only read once, by the aligner. Returns the reads kept per contig.
+def assign_reads(align_cmd, contig_handles):
+    counts = dict((name, 0) for name in contig_handles)
+    aligner = telemetry.Popen(align_cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in aligner.stdout:
+        if line.startswith('@'):
+            continue
+        fields = line.split('\t', 11)
+        flag = int(fields[1])
+        if flag & 0x904 or fields[2] not in contig_handles:
+            continue
+        seq = fields[9]
+        qual = fields[10].rstrip('\n')
+        if flag & 0x10:
+            seq = seq.translate(COMPLEMENT)[::-1]
+            qual = qual[::-1]
+        if qual == '*':
+            qual = 'I' * len(seq)
+        contig_handles[fields[2]].write('@{0}\n{1}\n+\n{2}\n'.format(fields[0], seq, qual))
+        counts[fields[2]] += 1
+    aligner.stdout.close()
+    aligner.wait()
+    return counts
+
+
+# split_assembly() writes one directory per contig holding the contig and the long and short reads assigned to it.
+def split_assembly(args, assembly, split_dir, threads):
+    contigs = read_fasta(assembly)
+    jobs = []
+    long_handles = {}
+    short_handles = {}
+    for index, (name, seq) in enumerate(contigs):
+        contig_dir = os.path.join(split_dir, contig_directory_name(index, name))
+        os.makedirs(os.path.join(contig_dir, 'berokka_results'), exist_ok=True)
+        contig_name = contig_directory_name(index, name)
+        write_fasta([(name, seq)], os.path.join(contig_dir, 'berokka_results', contig_name + '_clean.fasta'))
+        long_handles[name] = open(os.path.join(contig_dir, 'long_reads.fastq'), 'w')
+        short_handles[name] = open(os.path.join(contig_dir, 'pe_reads.fastq'), 'w')
+        jobs.append({'name': name, 'length': len(seq), 'directory': contig_dir, 'sample_name': contig_name})
+    try:
+        print("Assigning long reads to {0} contigs".format(len(contigs)))
+        long_counts = assign_reads([args.minimap2_path, '-t', threads, '-ax', 'map-ont', assembly, args.long_reads],
+                                   long_handles)
+        print("Assigning short reads to {0} contigs".format(len(contigs)))
+        if args.index_cache is not None:
+            bwa_prefix = IndexCache(args.index_cache, args.index_cache_size).bwa_index(args.bwa_path, assembly)
+        else:
+            telemetry.run([args.bwa_path, 'index', assembly])
+            bwa_prefix = assembly
+        short_counts = assign_reads([args.bwa_path, 'mem', '-t', threads, bwa_prefix, args.pe_reads], short_handles)
+    finally:
+        for handle in list(long_handles.values()) + list(short_handles.values()):
+            handle.close()
+    for job in jobs:
+        job['long_reads'] = long_counts[job['name']]
+        job['pe_reads'] = short_counts[job['name']]
+        print("Contig {0} ({1} bp): {2} long reads, {3} short reads".format(job['name'], job['length'],
+                                                                           job['long_reads'], job['pe_reads']))
+    return jobs
+
+
+def contig_arguments(args, job):
+    contig_args = argparse.Namespace(**vars(args))
+    contig_args.outdir = job['directory']
+    contig_args.sample_name = job['sample_name']
+    contig_args.long_reads = os.path.join(job['directory'], 'long_reads.fastq')
+    contig_args.pe_reads = os.path.join(job['directory'], 'pe_reads.fastq')
+    contig_args.existing_contigs = True
+    contig_args.contigs = os.path.join(job['directory'], 'berokka_results', job['sample_name'] + '_clean.fasta')
+    contig_args.per_contig = False
+    contig_args.target_depth = 0
+    contig_args.scratch = os.path.join(scratch_dir(args), 'per_contig')
+    return contig_args
+
+
+# polish_contig() is the process pool worker: it builds the single-sample stage graph for one contig and runs its
+# racon1 .. racon4 stages. Contigs without reads of both types are carried through unpolished, since racon drops
+# targets that have no alignments. Once 'cancel_event' is set (another contig failed), the contig's tools are stopped.
+# Returns the path of the polished contig.
+def polish_contig(build_stages, args, job, threads, cancel_event=None):
+    contig_args = contig_arguments(args, job)
+    stages = build_stages(contig_args)
+    polished = [stage for stage in stages if stage.name == PER_CONTIG_STAGES[1]][0].outputs[0]
+    if job['long_reads'] == 0 or job['pe_reads'] == 0:
+        sys.stderr.write("Warning: contig {0} has no assigned long or short reads and is left unpolished\n".format(
+            job['name']))
+        os.makedirs(os.path.dirname(polished), exist_ok=True)
+        write_fasta(read_fasta(contig_args.contigs), polished)
+        return polished
+    stop_polling = None
+    if cancel_event is not None:
+        stop_polling = executor.supervisor().cancel_when(cancel_event, os.path.abspath(contig_args.outdir),
+                                                         "another contig failed")
+    try:
+        run_stages(stages, contig_args.outdir, threads, resume=args.resume, from_stage=PER_CONTIG_STAGES[0],
+                   to_stage=PER_CONTIG_STAGES[1])
+    finally:
+        if stop_polling is not None:
+            stop_polling()
+    return polished
+
+
+# polish_per_contig() splits 'assembly', polishes every contig in a process pool and writes the merged result, in the
+# original contig order, to 'outfile'. Larger contigs are submitted first so the chromosome starts straight away. The
+# first contig to fail stops the others and cancels those not yet started.
+def polish_per_contig(build_stages, args, assembly, outfile, threads, workers=None):
+    split_dir = os.path.join(args.outdir, 'per_contig_polish')
+    os.makedirs(split_dir, exist_ok=True)
+    jobs = split_assembly(args, assembly, split_dir, threads)
+    threads = int(threads)
+    if workers is None:
+        workers = min(len(jobs), threads)
+    workers = max(1, min(workers, len(jobs)))
+    threads_per_worker = str(max(1, threads // workers))
+    print("Polishing {0} contigs with {1} worker(s) of {2} thread(s)".format(len(jobs), workers, threads_per_worker))
+    polished = {}
+    with executor.process_context().Manager() as manager, executor.process_pool(workers) as pool:
+        cancel_event = manager.Event()
+        futures = {}
+        for job in sorted(jobs, key=lambda job: -job['length']):
+            futures[pool.submit(telemetry.measured, polish_contig, build_stages, args, job, threads_per_worker,
+                                cancel_event)] = job['name']
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                polished[futures[future]] = telemetry.worker_result(future)
+        except BaseException:
+            cancel_event.set()
+            for future in futures:
+                future.cancel()
+            raise
+    merged = []
+    for job in jobs:
+        merged.extend(read_fasta(polished[job['name']]))
+    write_fasta(merged, outfile)
+    return outfile
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import shutil
+
+from fasta_io import read_fasta
+from seq_diff import EditCounts, diff_assemblies
+
+"""Convergence-driven polishing rounds"""
+# With '--adaptive_polish', the second and later racon rounds of the long-read and short-read phases only run while the
+# previous round of the same phase still changed the assembly by at least '--convergence_threshold' edits per Mbp, up to
+# '--max_long_rounds'/'--max_short_rounds'. Every round's per-contig edit counts and run time, and the time saved by the
+# rounds that were skipped, are kept in polish_convergence.json in the output directory.
+
+LOG_NAME = "polish_convergence.json"
+
+
+def measure_round(reference, polished):
+    """Return (per-contig EditCounts, total EditCounts, edits per Mbp) for one polishing round"""
+    old_records = read_fasta(reference)
+    contig_edits = diff_assemblies(old_records, read_fasta(polished))
+    total = EditCounts()
+    for edits in contig_edits.values():
+        total.add(edits)
+    length = sum(len(seq) for name, seq in old_records)
+    rate = total.total() / (length / 1e6) if length else 0.0
+    return contig_edits, total, rate
+
+
+class ConvergenceLog(object):
+    def __init__(self, outdir):
+        self.path = os.path.join(outdir, LOG_NAME)
+        self.rounds = {}
+        self.skipped = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as handle:
+                data = json.load(handle)
+            self.rounds = data.get('rounds', {})
+            self.skipped = data.get('skipped', {})
+
+    def record_round(self, label, phase, reference, polished, elapsed):
+        contig_edits, total, rate = measure_round(reference, polished)
+        self.rounds[label] = {'phase': phase, 'reference': reference, 'polished': polished,
+                              'elapsed': round(elapsed, 2), 'edits_per_mbp': round(rate, 3),
+                              'edits': total.as_dict(),
+                              'contigs': dict((name, edits.as_dict()) for name, edits in contig_edits.items())}
+        self.save()
+        print("Polish round {0}: {1} edits ({2} substitutions, {3} insertions, {4} deletions), {5:.2f} edits/Mbp, "
+              "{6:.1f}s".format(label, total.total(), total.substitutions, total.insertions, total.deletions, rate,
+                                elapsed))
+        return rate
+
+    def record_skipped(self, phase, skipped_rounds, time_saved):
+        self.skipped[phase] = {'rounds': skipped_rounds, 'time_saved': round(time_saved, 2)}
+        self.save()
+        if skipped_rounds:
+            print("Polishing converged: skipped {0} {1}-read round(s), saving about {2:.1f}s".format(
+                skipped_rounds, phase, time_saved))
+
+    def phase_elapsed(self, phase):
+        return [entry['elapsed'] for entry in self.rounds.values() if entry['phase'] == phase]
+
+    def save(self):
+        with open(self.path, 'w') as handle:
+            json.dump({'rounds': self.rounds, 'skipped': self.skipped}, handle, indent=2, sort_keys=True)
+
+
+# run_adaptive_rounds() continues a polishing phase after its first round. 'first_reference'/'first_polished' are the
+# input and output of that first round, and 'reference' is the input of the second round (the first round's output,
+# possibly rotated by circlator fixstart). Rounds 2 .. max_rounds are run with round_function(reference, round, threads)
+# until a round changes fewer than 'threshold' edits per Mbp. The last polish is copied to 'output'.
+def run_adaptive_rounds(log, phase, first_reference, first_polished, reference, output, round_function, max_rounds,
+                        threshold, threads):
+    rate = measure_round(first_reference, first_polished)[2]
+    polish_round = 2
+    while polish_round <= max_rounds and rate >= threshold:
+        label = "{0}{1}".format(phase, polish_round)
+        start = time.time()
+        polished = round_function(reference, polish_round, threads)
+        rate = log.record_round(label, phase, reference, polished, time.time() - start)
+        reference = polished
+        polish_round += 1
+    skipped_rounds = max_rounds - polish_round + 1
+    elapsed = log.phase_elapsed(phase)
+    time_saved = skipped_rounds * (sum(elapsed) / len(elapsed)) if elapsed else 0.0
+    log.record_skipped(phase, skipped_rounds, time_saved)
+    if os.path.abspath(reference) != os.path.abspath(output):
+        shutil.copyfile(reference, output)
+    return output
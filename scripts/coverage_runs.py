@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import subprocess
+from array import array
+
+import telemetry
+
+"""Run-length coverage tracks for fix_repeats"""
+# Coverage is held per contig as runs of equal depth (start, end, depth; 0-based, half-open) in compact typed arrays,
+# instead of one Python int per base. Runs can be read from 'bedtools genomecov -bga' bedGraph output, which is already
+# run-length encoded, from the legacy per-base 'genomecov -d' output (collapsed into runs while reading), or straight
+# from a sorted BAM. The median is taken from a depth histogram weighted by run length and low coverage windows are
+# found by walking runs, not bases, with the same read_length padding as the original per-base scan.
+
+
+class ContigCoverage(object):
+    def __init__(self, name):
+        self.name = name
+        self.starts = array('l')
+        self.ends = array('l')
+        self.depths = array('l')
+
+    def add_run(self, start, end, depth):
+        if self.depths and self.depths[-1] == depth and self.ends[-1] == start:
+            self.ends[-1] = end
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.depths.append(depth)
+
+    def length(self):
+        return self.ends[-1] if self.ends else 0
+
+    def runs(self):
+        return zip(self.starts, self.ends, self.depths)
+
+    # low_coverage_regions() reproduces the per-base scan of the original correct_regions(): a window opens
+    # 'read_length' bases before the first base below 'cutoff' (ignoring the first 'read_length' bases of the contig),
+    # low bases separated by at most 2 * read_length covered bases are merged, and the window closes 'read_length'
+    # bases after the last low base once more than 2 * read_length covered bases follow it. A window still open at
+    # the contig end is not reported.
+    def low_coverage_regions(self, cutoff, read_length):
+        regions = []
+        minval = None
+        maxval = None
+        for start, end, depth in self.runs():
+            if depth < cutoff:
+                if minval is None:
+                    first = max(start, read_length + 1)
+                    if first < end:
+                        minval = first - read_length
+                if minval is not None:
+                    maxval = end - 1
+            elif maxval is not None:
+                close = max(start, maxval + 2 * read_length + 1)
+                if close < end:
+                    regions.append((minval, maxval + read_length))
+                    minval = None
+                    maxval = None
+        return regions
+
+    def any_below(self, cutoff, start, end):
+        """True if any base in [start, end) has a depth below 'cutoff'"""
+        for run_start, run_end, depth in self.runs():
+            if run_end <= start:
+                continue
+            if run_start >= end:
+                break
+            if depth < cutoff:
+                return True
+        return False
+
+
+class Coverage(object):
+    def __init__(self):
+        self.contigs = {}
+
+    def contig(self, name):
+        if name not in self.contigs:
+            self.contigs[name] = ContigCoverage(name)
+        return self.contigs[name]
+
+    def histogram(self):
+        histogram = {}
+        for contig in self.contigs.values():
+            for start, end, depth in contig.runs():
+                histogram[depth] = histogram.get(depth, 0) + end - start
+        return histogram
+
+    # median() selects the same element as sorting every per-base depth and taking index round(n / 2), without
+    # building that list.
+    def median(self):
+        histogram = self.histogram()
+        total = sum(histogram.values())
+        if total == 0:
+            return 0
+        rank = min(int(round(total / 2)), total - 1)
+        seen = 0
+        for depth in sorted(histogram):
+            seen += histogram[depth]
+            if seen > rank:
+                return depth
+        return 0
+
+    def low_coverage_regions(self, cutoff, read_length):
+        return dict((name, contig.low_coverage_regions(cutoff, read_length)) for name, contig in self.contigs.items())
+
+
+def read_per_base(lines, coverage):
+    """Parse 'genomecov -d' lines (contig, 1-based position, depth) into runs"""
+    for line in lines:
+        ref, pos, depth = line.split()
+        pos = int(pos)
+        coverage.contig(ref).add_run(pos - 1, pos, int(depth))
+    return coverage
+
+
+def read_bedgraph(lines, coverage):
+    """Parse 'genomecov -bga' lines (contig, start, end, depth) into runs"""
+    for line in lines:
+        ref, start, end, depth = line.split()
+        coverage.contig(ref).add_run(int(start), int(end), int(depth))
+    return coverage
+
+
+# read_coverage() loads a coverage file, detecting per-base or bedGraph format from the number of columns.
+def read_coverage(coverage_file):
+    coverage = Coverage()
+    with open(coverage_file) as cov:
+        first = None
+        for line in cov:
+            if line.strip() and not line.startswith(('#', 'track')):
+                first = line
+                break
+        if first is None:
+            return coverage
+        parse = read_bedgraph if len(first.split()) == 4 else read_per_base
+        parse([first], coverage)
+        parse(cov, coverage)
+    return coverage
+
+
+# coverage_from_bam() streams bedGraph coverage of a sorted BAM from bedtools, without writing it to disk. 'genome' is
+# an optional bedtools genome file, so that contigs without any alignments are reported too.
+def coverage_from_bam(bam_file, genome=None, bedtools_path='bedtools'):
+    cmd = [bedtools_path, 'genomecov', '-bga', '-ibam', bam_file]
+    if genome is not None:
+        cmd += ['-g', genome]
+    genomecov = telemetry.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    coverage = read_bedgraph(genomecov.stdout, Coverage())
+    genomecov.stdout.close()
+    genomecov.wait()
+    return coverage
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import time
+import signal
+import atexit
+import asyncio
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+
+"""Fail-fast supervision of external tools"""
+# Every tool started through telemetry.Popen/telemetry.run is handed to a single asyncio event loop running in a
+# background thread. The loop streams the tool's stderr into the stage's log file (outdir/logs/<stage>.log) without
+# blocking the stage, enforces the stage's deadline ('--stage_timeout') and, when a tool of a sample fails, kills the
+# sample's other running tools and refuses to start new ones, so a failed Flye or bwa stops the sample within seconds
+# instead of letting later stages run on empty files. Tools run in their own session so that a kill reaches every
+# process of a shell pipeline. Reaping stays with the calling thread (os.wait4 in telemetry), which raises ToolError
+# for a failed, timed out or cancelled command. validate_output() checks stage outputs before they are recorded.
+
+LOG_DIR = "logs"
+TAIL_LINES = 20
+# Bytes of an unfinished stderr line kept for the tail.
+MAX_PARTIAL_LINE = 1 << 16
+# Seconds between SIGTERM and SIGKILL when a tool is stopped.
+KILL_GRACE = 10.0
+FASTA_SUFFIXES = ('.fasta', '.fa', '.fna')
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+class ToolError(Exception):
+    pass
+
+
+# StderrProtocol copies a command's stderr to its log and keeps the last lines in the watch's tail. A line split across
+# reads is held back until it is complete (or the pipe closes), so the tail shows it whole.
+class StderrProtocol(asyncio.Protocol):
+    def __init__(self, watch):
+        self.watch = watch
+        self.partial = b''
+
+    def data_received(self, data):
+        self.watch.log.write(data)
+        self.watch.log.flush()
+        lines = (self.partial + data).splitlines(True)
+        self.partial = lines.pop() if lines and not lines[-1].endswith(b'\n') else b''
+        self.partial = self.partial[-MAX_PARTIAL_LINE:]
+        self.watch.tail.extend(line.rstrip(b'\r\n').decode('utf-8', 'replace') for line in lines)
+
+    def connection_lost(self, exc):
+        if self.partial:
+            self.watch.tail.append(self.partial.rstrip(b'\r').decode('utf-8', 'replace'))
+            self.partial = b''
+        self.watch.log.close()
+        self.watch.drained.set()
+
+
+# Watch holds what the supervisor knows about one running command.
+class Watch(object):
+    def __init__(self, pid, sample, stage_name, tool, log_path, deadline):
+        self.pid = pid
+        self.sample = sample
+        self.stage_name = stage_name
+        self.tool = tool
+        self.log_path = log_path
+        self.deadline = deadline
+        self.log = None
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+        self.drained = threading.Event()
+        self.reason = None
+        self.finished = False
+        self.handles = []
+
+    def describe_failure(self, returncode):
+        if self.reason is not None:
+            message = "{0} in stage '{1}' was stopped: {2}".format(self.tool, self.stage_name, self.reason)
+        else:
+            message = "{0} exited with status {1} in stage '{2}'".format(self.tool, returncode, self.stage_name)
+        if self.log_path is not None:
+            self.drained.wait(5)
+            message += "; stderr is in {0}".format(self.log_path)
+            if self.tail:
+                message += ", ending:\n    " + "\n    ".join(self.tail)
+        return message
+
+
+class Supervisor(object):
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.cancelled = {}
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def check_startable(self, sample, stage_name, deadline):
+        """Raise ToolError if a command of 'sample' must not be started any more"""
+        with self.lock:
+            reason = self.cancelled.get(sample)
+        if reason is not None:
+            raise ToolError("Not starting a new command in stage '{0}': {1}".format(stage_name, reason))
+        if deadline is not None and time.time() >= deadline:
+            raise ToolError("Stage '{0}' ran past its time limit".format(stage_name))
+
+    # watch() starts supervising a command; 'stderr_fd' is the read end of its stderr pipe, or None.
+    def watch(self, pid, sample, stage_name, tool, command, stderr_fd, log_path, deadline):
+        watch = Watch(pid, sample, stage_name, tool, log_path if stderr_fd is not None else None, deadline)
+        if stderr_fd is not None:
+            watch.log = open(log_path, 'ab')
+            watch.log.write("### {0} {1}\n".format(time.strftime('%Y-%m-%dT%H:%M:%S'), command).encode('utf-8'))
+            watch.log.flush()
+        else:
+            watch.drained.set()
+        with self.lock:
+            self.watches[pid] = watch
+        self.loop.call_soon_threadsafe(self.start_watch, watch, stderr_fd)
+        return watch
+
+    def start_watch(self, watch, stderr_fd):
+        if stderr_fd is not None:
+            pipe = os.fdopen(stderr_fd, 'rb', 0)
+            self.loop.create_task(self.loop.connect_read_pipe(lambda: StderrProtocol(watch), pipe))
+        if watch.deadline is not None:
+            delay = max(0.0, watch.deadline - time.time())
+            watch.handles.append(self.loop.call_later(delay, self.stop, watch, "stage time limit reached"))
+
+    # finish() is called by the thread that reaped the command. A failure that was not caused by the supervisor
+    # cancels the rest of the sample.
+    def finish(self, watch, returncode, check):
+        watch.finished = True
+        with self.lock:
+            self.watches.pop(watch.pid, None)
+        self.loop.call_soon_threadsafe(self.clear_timers, watch)
+        if returncode == 0:
+            return None
+        message = watch.describe_failure(returncode)
+        if check and watch.reason is None:
+            self.cancel(watch.sample, "{0} failed in stage '{1}'".format(watch.tool, watch.stage_name))
+        return message
+
+    def clear_timers(self, watch):
+        for handle in watch.handles:
+            handle.cancel()
+
+    def cancel(self, sample, reason):
+        """Stop every running command of 'sample' and refuse to start new ones"""
+        with self.lock:
+            self.cancelled.setdefault(sample, reason)
+            running = [watch for watch in self.watches.values() if watch.sample == sample]
+        for watch in running:
+            self.loop.call_soon_threadsafe(self.stop, watch, reason)
+
+    def clear(self, sample):
+        """Allow commands of 'sample' (and of the per-contig jobs below it) to start again after a cancellation"""
+        with self.lock:
+            for key in [key for key in self.cancelled if key == sample or key.startswith(sample + os.sep)]:
+                del self.cancelled[key]
+
+    def stop(self, watch, reason, sig=signal.SIGTERM):
+        if watch.finished:
+            return
+        if watch.reason is None:
+            watch.reason = reason
+        try:
+            os.killpg(watch.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            return
+        if sig == signal.SIGTERM:
+            watch.handles.append(self.loop.call_later(KILL_GRACE, self.stop, watch, reason, signal.SIGKILL))
+
+    # cancel_when() cancels 'sample' once 'event' (e.g. a multiprocessing.Manager().Event() shared with a process
+    # pool) is set. Returns a callable that stops the polling.
+    def cancel_when(self, event, sample, reason, interval=1.0):
+        state = {'stopped': False}
+
+        def poll():
+            if state['stopped']:
+                return
+            try:
+                is_set = event.is_set()
+            except (OSError, EOFError):
+                return
+            if is_set:
+                self.cancel(sample, reason)
+                return
+            self.loop.call_later(interval, poll)
+
+        def stop_polling():
+            state['stopped'] = True
+        self.loop.call_soon_threadsafe(poll)
+        return stop_polling
+
+    def kill_all(self):
+        with self.lock:
+            running = list(self.watches.values())
+        for watch in running:
+            try:
+                os.killpg(watch.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+
+def supervisor():
+    """Return this process's Supervisor (process pool workers get their own)"""
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None or _supervisor.pid != os.getpid():
+            _supervisor = Supervisor()
+            atexit.register(_supervisor.kill_all)
+        return _supervisor
+
+
+# process_context() is the multiprocessing context used for process pools. By the time a pool starts, this process is
+# running the supervisor's event loop and the scratch and progress threads, and a forked worker can inherit a lock that
+# one of them held at the time of the fork and block on it forever. 'forkserver' starts the workers from a separate
+# single-threaded server process instead.
+def process_context():
+    return multiprocessing.get_context('forkserver')
+
+
+def process_pool(max_workers):
+    """A ProcessPoolExecutor whose workers are started through process_context() (forked on Python 3.6)"""
+    try:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context())
+    except TypeError:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
+
+def stage_log_path(outdir, stage_name):
+    log_dir = os.path.join(outdir, LOG_DIR)
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, "{0}.log".format(stage_name))
+
+
+# parse_timeouts() reads '--stage_timeout' values such as 'flye=12,medaka=4' or '24' (hours; a bare number applies to
+# every stage) into a dict of stage name (or '*') to seconds.
+def parse_timeouts(spec):
+    timeouts = {}
+    if not spec:
+        return timeouts
+    for item in spec.split(','):
+        name, _, hours = item.rpartition('=')
+        try:
+            timeouts[name.strip() or '*'] = float(hours) * 3600
+        except ValueError:
+            raise Exception("Cannot read stage timeout '{0}'; use e.g. flye=12,medaka=4 (hours)".format(item))
+    return timeouts
+
+
+def validate_output(path):
+    """Raise ToolError unless 'path' is a plausible FASTA, SAM or BAM file (other files must exist)"""
+    if not os.path.isfile(path):
+        raise ToolError("Expected output {0} was not written".format(path))
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(FASTA_SUFFIXES + ('.sam', '.bam')) and os.path.getsize(path) == 0:
+        raise ToolError("Output {0} is empty".format(path))
+    if name.endswith(FASTA_SUFFIXES + ('.sam',)):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as handle:
+            first = handle.read(1)
+        expected = b'>' if name.endswith(FASTA_SUFFIXES) else b'@'
+        if first != expected:
+            raise ToolError("Output {0} does not start with '{1}'".format(path, expected.decode()))
+    elif path.endswith('.bam'):
+        with gzip.open(path, 'rb') as handle:
+            try:
+                magic = handle.read(4)
+            except (OSError, EOFError):
+                magic = b''
+        if magic != b'BAM\1':
+            raise ToolError("Output {0} is not a BAM file".format(path))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import mmap
+
+"""Shared FASTA/FASTQ reading and writing"""
+# Sequences are parsed from binary lines into a bytearray per record and decoded once, so a 5 Mb chromosome is never
+# rebuilt by repeated string concatenation. Headers are normalised to their first word while parsing, which replaces
+# rewriting whole files with 'sed' before indexing. FastaIndex reads (or builds) a samtools-compatible .fai and slices
+# regions straight out of a memory-mapped file, and FastaWriter streams records out with a fixed line width.
+
+
+def open_binary(path):
+    """Open a plain or gzipped file for binary reading"""
+    with open(path, 'rb') as handle:
+        magic = handle.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def header_name(line):
+    """Return the first word of a '>' or '@' header line (bytes) as a str"""
+    fields = line[1:].split(None, 1)
+    return fields[0].decode() if fields else ''
+
+
+# iter_fasta() yields (name, sequence) tuples in file order, with names normalised to the first word of the header.
+def iter_fasta(fasta_file):
+    name = None
+    seq = bytearray()
+    with open_binary(fasta_file) as fasta:
+        for line in fasta:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, seq.decode()
+                name = header_name(line)
+                seq = bytearray()
+            else:
+                seq.extend(line.rstrip())
+    if name is not None:
+        yield name, seq.decode()
+
+
+def read_fasta(fasta_file):
+    """Return a list of (name, sequence) tuples in file order"""
+    return list(iter_fasta(fasta_file))
+
+
+# iter_fastq() yields (name, sequence, quality) tuples from a plain or gzipped four-line FASTQ file.
+def iter_fastq(fastq_file):
+    with open_binary(fastq_file) as fastq:
+        while True:
+            header = fastq.readline()
+            if not header:
+                break
+            seq = fastq.readline().rstrip()
+            fastq.readline()
+            qual = fastq.readline().rstrip()
+            if not header.startswith(b'@') or len(seq) != len(qual):
+                raise Exception("Malformed FASTQ record '{0}' in {1}".format(header.rstrip().decode(), fastq_file))
+            yield header_name(header), seq.decode(), qual.decode()
+
+
+class FastaWriter(object):
+    def __init__(self, fasta_file, line_width=60):
+        self.handle = open(fasta_file, 'w')
+        self.line_width = line_width
+
+    def write(self, name, seq):
+        self.handle.write('>' + name + '\n')
+        if not self.line_width:
+            self.handle.write(seq + '\n')
+            return
+        for i in range(0, len(seq), self.line_width):
+            self.handle.write(seq[i:i + self.line_width] + '\n')
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def write_fasta(records, fasta_file, line_width=60):
+    with FastaWriter(fasta_file, line_width) as writer:
+        for name, seq in records:
+            writer.write(name, seq)
+
+
+# normalise_fasta() strips header descriptions in one streaming pass, in place when 'out_file' is not given. Sequence
+# lines are copied unchanged.
+def normalise_fasta(fasta_file, out_file=None):
+    target = out_file if out_file is not None else fasta_file + '.tmp'
+    with open_binary(fasta_file) as fasta, open(target, 'wb') as out:
+        for line in fasta:
+            if line.startswith(b'>'):
+                line = b'>' + header_name(line).encode() + b'\n'
+            out.write(line)
+    if out_file is None:
+        os.replace(target, fasta_file)
+    return out_file if out_file is not None else fasta_file
+
+
+# build_fai() writes a samtools-compatible .fai index (name, length, offset, bases per line, bytes per line) for
+# 'fasta_file' in one pass. Like samtools faidx it requires every line of a record but the last to be the same length.
+def build_fai(fasta_file, fai_file):
+    entries = []
+    entry = None
+    offset = 0
+    short_line = False
+    with open(fasta_file, 'rb') as fasta:
+        for line in fasta:
+            offset += len(line)
+            if line.startswith(b'>'):
+                entry = [header_name(line), 0, offset, 0, 0]
+                entries.append(entry)
+                short_line = False
+                continue
+            bases = len(line.rstrip(b'\r\n'))
+            if entry is None or bases == 0:
+                continue
+            if entry[3] == 0:
+                entry[3] = bases
+                entry[4] = len(line)
+            elif short_line or bases > entry[3]:
+                raise Exception("Different line lengths in record {0} of {1}; cannot index".format(entry[0],
+                                                                                                    fasta_file))
+            short_line = bases < entry[3]
+            entry[1] += bases
+    with open(fai_file, 'w') as fai:
+        for name, length, seq_offset, line_bases, line_width in entries:
+            fai.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(name, length, seq_offset, line_bases, line_width))
+    return fai_file
+
+
+class FastaIndex(object):
+    """Random access to the records of an uncompressed FASTA file through its .fai index and mmap"""
+
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        fai_file = fasta_file + '.fai'
+        if not os.path.isfile(fai_file) or os.path.getmtime(fai_file) < os.path.getmtime(fasta_file):
+            build_fai(fasta_file, fai_file)
+        self.names = []
+        self.entries = {}
+        with open(fai_file) as fai:
+            for line in fai:
+                name, length, offset, line_bases, line_width = line.split('\t')[:5]
+                self.names.append(name)
+                self.entries[name] = (int(length), int(offset), int(line_bases), int(line_width))
+        self.handle = open(fasta_file, 'rb')
+        self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fasta_file) else b''
+
+    def length(self, name):
+        return self.entries[name][0]
+
+    def byte_offset(self, name, position):
+        length, offset, line_bases, line_width = self.entries[name]
+        if line_bases == 0:
+            return offset
+        return offset + (position // line_bases) * line_width + position % line_bases
+
+    def fetch(self, name, start=0, end=None):
+        """Return bases [start, end) of record 'name' (0-based, half-open)"""
+        length = self.entries[name][0]
+        end = length if end is None else min(end, length)
+        start = max(0, min(start, end))
+        chunk = self.map[self.byte_offset(name, start):self.byte_offset(name, end)]
+        return chunk.replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 
 import sys
+import shlex
 import subprocess
 import os
 import argparse
+import concurrent.futures
+import variants
+import telemetry
+import resources
+from fasta_io import FastaIndex, FastaWriter, write_fasta, open_binary
+from read_qc import pair_key
+from coverage_runs import read_coverage, coverage_from_bam
 
 # filters VCF file so that only alleles with a high frequency are included in output file
 def filter_vcf(in_file, out_file):
@@ -11,164 +19,157 @@ def filter_vcf(in_file, out_file):
         for line in vcf:
             if line.startswith('#'):
                 out.write(line)
-            else:
-                chrom, pos, id, ref, alt, qual, filt, info, form, unk = line.split()
-                #if len(ref) != len(alt):
-                for i in info.split(';'):
-                    if i.startswith('AF1='):
-                        if float(i.split('=')[1]) > 0.9:
-                            out.write(line)
-                            continue
+            elif variants.passes_allele_frequency(variants.parse_record(line)):
+                out.write(line)
+
+# index_reference() indexes 'ref_file' for bwa and samtools faidx, through 'index_cache' when one is given so that a
+# region that has been seen before is not re-indexed. Returns the reference path to pass to bwa mem and bcftools.
+def index_reference(ref_file, index_cache=None, bwa_path='bwa'):
+    if index_cache is None:
+        telemetry.run([bwa_path, 'index', ref_file])
+        telemetry.run(['samtools', 'faidx', ref_file])
+        return ref_file
+    index_cache.bwa_index(bwa_path, ref_file)
+    return index_cache.faidx('samtools', ref_file)
+
+# align_sorted() pipes bwa mem straight into samtools sort, so the alignments are written once, as a sorted BAM, with
+# the sort's temporary files next to it. The threads are split between bwa and the sort, and 'sort_memory' (GB, shared
+# by the sort threads) sets samtools sort '-m'. Paths are quoted for the shell.
+def align_sorted(ref_index, read_file, bam_file, no_of_threads, sort_memory=None, bwa_path='bwa'):
+    bwa_threads, sort_threads = resources.split_threads(no_of_threads, 'bwa', 'samtools_sort')
+    telemetry.Popen('set -o pipefail; ' + shlex.quote(bwa_path) + ' mem -t ' + bwa_threads + ' ' + \
+                    shlex.quote(ref_index) + ' ' + shlex.quote(read_file) + ' | samtools sort -@ ' + sort_threads + \
+                    ' -m ' + resources.sort_memory(sort_threads, sort_memory) + ' -T ' + shlex.quote(bam_file + '.tmp') + \
+                    ' -o ' + shlex.quote(bam_file) + ' -', shell=True, executable='/bin/bash').wait()
+
+# call_consensus() maps the reads to the regions in 'work_dir'/ref.fa, calls variants and returns 'sequences' (a dict of
+# region name -> sequence, as written to ref.fa) with the high frequency variants applied. The bcftools calls are read
+# once as they stream out and filtered and applied in memory. The sorted alignment is kept as 'work_dir'/ref.sort.bam.
+def call_consensus(work_dir, read_file, no_of_threads, sequences, index_cache=None, bwa_path='bwa'):
+    ref_index = index_reference(work_dir + '/ref.fa', index_cache, bwa_path)
+    align_sorted(ref_index, read_file, work_dir + '/ref.sort.bam', no_of_threads, bwa_path=bwa_path)
+    telemetry.run(['samtools', 'index', work_dir + '/ref.sort.bam'])
+    caller = telemetry.Popen('set -o pipefail; bcftools mpileup -L100000 -d100000 -f ' + shlex.quote(ref_index) + \
+                              ' ' + shlex.quote(work_dir + '/ref.sort.bam') + ' | bcftools call --ploidy 1 -cv -Ov',
+                              shell=True, executable='/bin/bash', stdout=subprocess.PIPE, universal_newlines=True)
+    calls = variants.read_variants(caller.stdout)
+    caller.stdout.close()
+    caller.wait()
+    sys.stdout.write('Applying ' + str(sum(len(v) for v in calls.values())) + ' variant(s) to ' + str(len(sequences)) + ' region(s)\n')
+    return variants.apply_consensus(sequences, calls)
+
+# recruit_reads() writes the read pairs of 'read_file' (interleaved) of which either mate has a primary alignment to a
+# low coverage region in the first pass to 'working_dir'/recruited.fastq. A repeat read that also fits another region
+# is recruited through its primary alignment, and keeping both mates adds reads from up to an insert size around the
+# regions. Reads with no alignment in the first pass (e.g. ones that only fit a region once its consensus has
+# changed) are not recruited; the per-region re-polish uses this subset rather than aligning every read to each region.
+def recruit_reads(working_dir, read_file):
+    names = set()
+    aligned = telemetry.Popen(['samtools', 'view', '-F', '0x904', working_dir + '/ref.sort.bam'],
+                              stdout=subprocess.PIPE)
+    for line in aligned.stdout:
+        if not line.startswith(b'@'):
+            names.add(pair_key(b'@' + line.split(b'\t', 1)[0])[0])
+    aligned.stdout.close()
+    aligned.wait()
+    recruited = 0
+    with open_binary(read_file) as reads, open(working_dir + '/recruited.fastq', 'wb') as out:
+        while True:
+            pair = [reads.readline(), reads.readline(), reads.readline(), reads.readline()]
+            if not pair[0]:
+                break
+            pair += [reads.readline(), reads.readline(), reads.readline(), reads.readline()]
+            if pair_key(pair[0])[0] in names or (pair[4] and pair_key(pair[4])[0] in names):
+                out.write(b''.join(pair))
+                recruited += 1
+    sys.stdout.write('Recruited ' + str(recruited) + ' read pair(s) for the per-region re-polish\n')
+    return working_dir + '/recruited.fastq'
+
+# repolish_region() re-polishes a single low coverage region in its own directory and returns the new sequence
+def repolish_region(region_name, region_seq, read_file, region_dir, no_of_threads, index_cache=None, bwa_path='bwa'):
+    if not os.path.isdir(region_dir):
+        os.makedirs(region_dir)
+    write_fasta([(region_name, region_seq)], region_dir + '/ref.fa', line_width=None)
+    return call_consensus(region_dir, read_file, no_of_threads, {region_name: region_seq}, index_cache,
+                          bwa_path)[region_name]
 
 # corrects low coverage regions
-def correct_regions(fasta_file, read_file, coverage_file, working_dir, out_file, read_length, no_of_threads):
-    low_cov = {}
-    with open(coverage_file) as cov:
-        # gets coverage and stores in dictionary with entry for each reference
-        cov_dict = {}
-        cov_vals = []
-        for line in cov:
-            ref, pos, cov = line.split()
-            if not ref in cov_dict:
-                cov_dict[ref] = []
-            cov_dict[ref].append(int(cov))
-            cov_vals.append(int(cov))
-        cov_vals.sort()
-	# As initially coded, will return a float value if len(cov_vals) is odd
-        median_cov = cov_vals[round(len(cov_vals)/2)] # finds the median coverage and determines a cutoff to identify low coverage regions for remapping
-        cov_cutoff = int(round(median_cov / 8))
-        sys.stdout.write('Using a coverage cutoff of ' + str(cov_cutoff) + '\n')
-        for i in cov_dict: # find regions in assembly with low coverage
-            low_cov[i] = []
-            minval = None
-            maxval = None
-            for pos, j in enumerate(cov_dict[i]):
-                if j < cov_cutoff:
-                    if minval is None and pos > read_length:
-                        minval = pos - read_length
-                    if not minval is None:
-                        maxval = pos
-                else:
-                    if not maxval is None and pos > maxval + 2 * read_length:
-                        low_cov[i].append((minval, maxval + read_length))
-                        minval = None
-                        maxval = None
-    with open(fasta_file) as fasta: # read in reference fasta and store sequence in a dictionary
-        seqDict = {}
-        for line in fasta:
-            if line.startswith('>'):
-                name = line.rstrip()[1:]
-                seqDict[name] = ''
-            else:
-                seqDict[name] += line.rstrip()
+def correct_regions(fasta_file, read_file, coverage_file, working_dir, out_file, read_length, no_of_threads,
+                    index_cache=None, workers=None, bwa_path='bwa'):
+    # coverage_file may be 'bedtools genomecov' output (-bga bedGraph or per-base -d) or a sorted BAM file
+    if coverage_file.endswith('.bam'):
+        coverage = coverage_from_bam(coverage_file)
+    else:
+        coverage = read_coverage(coverage_file)
+    median_cov = coverage.median() # finds the median coverage and determines a cutoff to identify low coverage regions for remapping
+    cov_cutoff = int(round(median_cov / 8))
+    sys.stdout.write('Using a coverage cutoff of ' + str(cov_cutoff) + '\n')
+    low_cov = coverage.low_coverage_regions(cov_cutoff, read_length) # find regions in assembly with low coverage
     split_seq = {}
-    for i in low_cov: # for each reference, split the sequence into high coverage (even) and low coverage (regions to be corrected, odd)
-        last_pos = 0
-        split_seq[i] = []
-        for j in low_cov[i]:
-            split_seq[i].append(seqDict[i][last_pos:j[0]])
-            split_seq[i].append(seqDict[i][j[0]:j[1]])
-            last_pos = j[1]
-        split_seq[i].append(seqDict[i][last_pos:])
+    with FastaIndex(fasta_file) as fasta: # slice the reference through its .fai index rather than reading it into memory
+        for i in low_cov: # for each reference, split the sequence into high coverage (even) and low coverage (regions to be corrected, odd)
+            last_pos = 0
+            split_seq[i] = []
+            for j in low_cov[i]:
+                split_seq[i].append(fasta.fetch(i, last_pos, j[0]))
+                split_seq[i].append(fasta.fetch(i, j[0], j[1]))
+                last_pos = j[1]
+            split_seq[i].append(fasta.fetch(i, last_pos))
     there_is_a_low_cov = False
-    with open(working_dir + '/ref.fa', 'w') as ref, open(working_dir + '/ref.genome', 'w') as gf:
+    with FastaWriter(working_dir + '/ref.fa') as ref, open(working_dir + '/ref.genome', 'w') as gf:
         # write the low coverage (odd) sequences to a new FASTA file for mapping
         for i in split_seq:
             for num, j in enumerate(split_seq[i]):
                 if num % 2 == 1:
                     there_is_a_low_cov = True
-                    ref.write('>' + i + '_' + str(num) + '\n') # store the index of the sequence in the FASTA header
+                    ref.write(i + '_' + str(num), j) # store the index of the sequence in the FASTA header
                     gf.write(i + '_' + str(num) + '\t' + str(len(j)) + '\n')
-                    for k in range(0, len(j), 60):
-                        ref.write(j[k:k+60] + '\n')
     if there_is_a_low_cov:
-        subprocess.Popen('bwa index ' + working_dir + '/ref.fa', shell=True).wait()
-        subprocess.Popen('bwa mem -t ' + no_of_threads + ' ' + working_dir + '/ref.fa ' + read_file + ' > ' + working_dir + '/ref.aln.sam', shell=True).wait()
-        subprocess.Popen('samtools faidx ' + working_dir + '/ref.fa ', shell=True).wait()
-        subprocess.Popen('samtools view -bS -t ' + no_of_threads + ' ' + working_dir + '/ref.aln.sam > ' + working_dir + '/ref.aln.bam', shell=True).wait()
-        subprocess.Popen('samtools sort -@ ' + no_of_threads + ' ' + working_dir + '/ref.aln.bam > ' + working_dir + '/ref.sort.bam', shell=True).wait()
-        subprocess.Popen('samtools index ' + working_dir + '/ref.sort.bam', shell=True).wait()
-        subprocess.Popen('bcftools mpileup -L100000 -d100000 -f "' + working_dir + '/ref.fa" ' + working_dir + \
-                         '/ref.sort.bam | bcftools call --ploidy 1 -cv -Ob > "' + working_dir + '/ref.bcf"', shell=True).wait()
-        subprocess.Popen('bcftools view "' + working_dir + '/ref.bcf" | vcfutils.pl varFilter -w 0 -W 0 > "' + working_dir + '/ref.vcf"', shell=True).wait()
-        filter_vcf(working_dir + '/ref.vcf', working_dir + '/ref2.vcf')
-        subprocess.Popen('bgzip -c "' + working_dir + '/ref2.vcf" > "' + working_dir + '/ref2.vcf.gz"', shell=True).wait()
-        subprocess.Popen('tabix -p vcf "' + working_dir + '/ref2.vcf.gz"', shell=True).wait()
-        subprocess.Popen('cat "' + working_dir + '/ref.fa" | vcf-consensus "' + working_dir + '/ref2.vcf.gz" > "' + working_dir + '/new_ref.fasta"', shell=True).wait()
+        regions = {}
+        for i in split_seq:
+            for num in range(1, len(split_seq[i]), 2):
+                regions[i + '_' + str(num)] = split_seq[i][num]
+        consensus = call_consensus(working_dir, read_file, no_of_threads, regions, index_cache, bwa_path)
     # once the consensus is called, replace all the low coverage regions with the new consensus sequence
-        with open(working_dir + '/new_ref.fasta') as fasta:
-            seq = None
-            for line in fasta:
-                if line.startswith('>'):
-                    name = '_'.join(line.rstrip()[1:].split('_')[:-1])
-                    num = int(line.rstrip().split('_')[-1])
-                    split_seq[name][num] = ''
-                    if seq == '':
-                        sys.exit('Something went wrong with bwa/samtools.. exiting\n')
-                    seq = ''
-                else:
-                    seq += line.rstrip()
-                    split_seq[name][num] += line.rstrip()
-            if seq == '' or seq is None:
+        for region, seq in consensus.items():
+            if seq == '':
                 sys.exit('Something went wrong with bwa/samtools.. exiting\n')
+            name = '_'.join(region.split('_')[:-1])
+            num = int(region.split('_')[-1])
+            split_seq[name][num] = seq
     # Check that reads have mapped to each of the low coverage regions
-    subprocess.Popen('bedtools genomecov -d -ibam ' + working_dir + '/ref.sort.bam -g ' + working_dir + '/ref.genome > ' + working_dir + '/ref.cov', shell=True).wait()
     redo = set()
-    # if coverage has not improved, redo alignment and consensus calling sequentially
-    with open(working_dir + '/ref.cov') as cov:
-        cov_dict = {}
-        for line in cov:
-            ref, pos, cov = line.split()
-            if not ref in cov_dict:
-                cov_dict[ref] = []
-            cov_dict[ref].append(int(cov))
-        for i in cov_dict:
-            for j in cov_dict[i][read_length-10:-read_length+10]:
-                if j < cov_cutoff:
-                    redo.add(i)
-                    continue
-    for i in redo:
-        with open(working_dir + '/ref.fa', 'w') as ref:
-            name = '_'.join(i.split('_')[:-1])
-            num = int(i.split('_')[-1])
-            ref.write('>' + i + '\n')
-            ref.write(split_seq[name][num])
-        os.remove(working_dir + '/new_ref.fasta')
-        os.remove(working_dir + '/ref.aln.sam')
-        os.remove(working_dir + '/ref.aln.bam')
-        os.remove(working_dir + '/ref.sort.bam')
-        os.remove(working_dir + '/ref.bcf')
-        os.remove(working_dir + '/ref.vcf')
-        os.remove(working_dir + '/ref2.vcf')
-        os.remove(working_dir + '/ref2.vcf.gz')
-        subprocess.Popen('bwa index ' + working_dir + '/ref.fa', shell=True).wait()
-        subprocess.Popen('bwa mem -t ' + no_of_threads + ' ' + working_dir + '/ref.fa ' + read_file + ' > ' + working_dir + '/ref.aln.sam', shell=True).wait()
-        subprocess.Popen('samtools faidx ' + working_dir + '/ref.fa ', shell=True).wait()
-        subprocess.Popen('samtools view -bS -t ' + no_of_threads + ' ' + working_dir + '/ref.aln.sam > ' + working_dir + '/ref.aln.bam', shell=True).wait()
-        subprocess.Popen('samtools sort -@ ' + no_of_threads + ' ' + working_dir + '/ref.aln.bam > ' + working_dir + '/ref.sort.bam', shell=True).wait()
-        subprocess.Popen('samtools index ' + working_dir + '/ref.sort.bam', shell=True).wait()
-        subprocess.Popen('bcftools mpileup -L100000 -d100000 -f "' + working_dir + '/ref.fa" ' + working_dir + \
-                         '/ref.sort.bam | bcftools call --ploidy 1 -cv -Ob > "' + working_dir + '/ref.bcf"', shell=True).wait()
-        subprocess.Popen('bcftools view "' + working_dir + '/ref.bcf" | vcfutils.pl varFilter -w 0 -W 0 > "' + working_dir + '/ref.vcf"', shell=True).wait()
-        filter_vcf(working_dir + '/ref.vcf', working_dir + '/ref2.vcf')
-        subprocess.Popen('bgzip -c "' + working_dir + '/ref2.vcf" > "' + working_dir + '/ref2.vcf.gz"', shell=True).wait()
-        subprocess.Popen('tabix -p vcf "' + working_dir + '/ref2.vcf.gz"', shell=True).wait()
-        subprocess.Popen('cat "' + working_dir + '/ref.fa" | vcf-consensus "' + working_dir + '/ref2.vcf.gz" > "' + working_dir + '/new_ref.fasta"', shell=True).wait()
-        with open(working_dir + '/new_ref.fasta') as fasta:
-            seq = ''
-            for line in fasta:
-                if not line.startswith('>'):
-                    seq += line.rstrip()
-            if seq == '':
-                sys.exit('Something went wrong with bwa/samtools.. exiting\n')
-        split_seq[name][num] = seq
+    # if coverage has not improved, redo alignment and consensus calling for each region on its own
+    if there_is_a_low_cov:
+        region_coverage = coverage_from_bam(working_dir + '/ref.sort.bam', genome=working_dir + '/ref.genome')
+        for i, contig in region_coverage.contigs.items():
+            start, end = slice(read_length - 10, -read_length + 10).indices(contig.length())[:2]
+            if start < end and contig.any_below(cov_cutoff, start, end):
+                redo.add(i)
+    if redo:
+        # the regions are re-polished from the read pairs that aligned to a low coverage region in the pass above
+        # (see recruit_reads()), concurrently, each in its own directory
+        recruited = recruit_reads(working_dir, read_file)
+        if workers is None:
+            workers = min(len(redo), int(no_of_threads))
+        workers = max(1, min(workers, len(redo)))
+        region_threads = str(max(1, int(no_of_threads) // workers))
+        sys.stdout.write('Re-polishing ' + str(len(redo)) + ' region(s) with ' + str(workers) + ' worker(s)\n')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for i in sorted(redo):
+                name = '_'.join(i.split('_')[:-1])
+                num = int(i.split('_')[-1])
+                futures[pool.submit(telemetry.in_current_stage(repolish_region), i, split_seq[name][num], recruited,
+                                    working_dir + '/region_' + i, region_threads, index_cache, bwa_path)] = (name, num)
+            for future in concurrent.futures.as_completed(futures):
+                name, num = futures[future]
+                seq = future.result()
+                if seq == '':
+                    sys.exit('Something went wrong with bwa/samtools.. exiting\n')
+                split_seq[name][num] = seq
     # write new consensus to out
-    with open(out_file, 'w') as out:
-        for i in split_seq:
-            out.write('>' + i + '\n')
-            seq = ''.join(split_seq[i])
-            for j in range(0, len(seq), 80):
-                out.write(seq[j:j+80] + '\n')
+    write_fasta(((i, ''.join(split_seq[i])) for i in split_seq), out_file, line_width=80)
 
 parser = argparse.ArgumentParser(prog='Fix_repeats_ill.py', formatter_class=argparse.RawDescriptionHelpFormatter, description='''
 fix_repeats_ill is a script for correcting repetitive elements in pacbio assemblies with Illumina data
@@ -176,14 +177,14 @@ fix_repeats_ill.py
 This script maps (single-end) Illumina reads back to repetitive regions with no Illumina coverage
 and corrects the errors found.
 USAGE: python fix_repeats_ill.py -c <coverage.txt> -g <genome.fa> -r <reads.fq> -w <working_dir> -o <out_file>
-Where coverage.txt is a bed file of the coverage at all bases
-(can be generated using genomeCoverageBed -d -ibam aln.sorted.bam -g ref.fasta > coverage.txt)
+Where coverage.txt is a bedGraph or per-base file of the coverage at all bases
+(can be generated using genomeCoverageBed -bga -ibam aln.sorted.bam > coverage.txt), or the sorted BAM itself
 genome.fa is the reference to be corrected
 reads.fq are the illumina reads (can be gzipped)
 working_dir is where to put intermediate files
 and out_file is the place to write the corrected genome
 ''', epilog="Thanks for using fix_repeats_ill.py")
-parser.add_argument('-c', '--coverage', action='store', help='bed file of coverage at each base')
+parser.add_argument('-c', '--coverage', action='store', help='bedGraph/per-base coverage file or sorted BAM')
 parser.add_argument('-r', '--read_file', action='store', help='read file (.fastq, .fastq.gz)')
 parser.add_argument('-r2', '--read_file_2', default=None, action='store', help='read file (.fastq, .fastq.gz)')
 parser.add_argument('-g', '--genome', action='store', help='FASTA file of genome to be corrected')
@@ -1,14 +1,36 @@
 #!/usr/bin/env python
 
 import os
+import re
+import sys
 import subprocess
+import time
+import shutil
 import argparse
 import fix_repeats
+import telemetry
+import executor
+import resources
+from stages import Stage, run_stages, select_stages, set_timeouts, probe_tool_version
+from scheduler import BatchScheduler, SampleJob
+from contig_polish import polish_per_contig
+from convergence import ConvergenceLog, run_adaptive_rounds
+from index_cache import IndexCache
+from fasta_io import normalise_fasta
+from subsample import subsample_reads, parse_genome_size
+from start_genes import fix_start
+from realign import align_incrementally
+from read_qc import ReadQCError, run_read_qc, load_parameters, report_path
+from interleave import interleave_reads
+from medaka_batch import MedakaJob, run_medaka_batch
+from polish_profile import run_polish_profile, batch_profile, PROFILE_JSON
+from scratch import ScratchMonitor, make_scratch_dir, scratch_dir, compressor, remove_scratch, checkpoint
 
 """Notes for an eventual protocol for this pipeline"""
 # Note that you need a local install of flye to properly run the make_flye_command() function.
 # Note that you need a local install of berokka to properly run the make_berokka_command() function.
-# Note that you need a local install of circlator to properly run the circlator_fixstart_command() function.
+# Note that you need a local install of circlator to properly run the circlator_fixstart_command() function
+# ('--start_locator circlator'); the default built-in locator optionally uses prodigal.
 # Note that you need a local install of bwa to properly run the racon_command() function.
 # Note that you need a local install of racon to properly run the racon_command() function.
 # Note that you need a local install of minimap2 to properly run the minimap2_command() function.
@@ -27,77 +49,252 @@ def create_directory(outdir):
     if os.path.isdir(outdir):
         raise Exception("Directory already exists")
     if not os.path.isdir(outdir):
-        os.system("mkdir -p %s" % outdir)
+        os.makedirs(outdir)
     return
 
+# stream_command() runs an external command with its stdout written directly into 'out_path' so that large outputs
+# (SAM alignments, consensus FASTA) are never held in memory. Returns the number of bytes streamed.
+def stream_command(cmd, out_path):
+    with open(out_path, 'wb') as out_handle:
+        telemetry.run(cmd, stdout=out_handle)
+    executor.validate_output(out_path)
+    return os.path.getsize(out_path)
+
+# stop_process() kills a command whose output will no longer be read, if it is still running, and reaps it so that it
+# does not block on a full pipe and its resource use is still recorded. Its own failure is not raised.
+def stop_process(process):
+    process.check = False
+    if process.stdout is not None:
+        process.stdout.close()
+    try:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    except executor.ToolError:
+        pass
+
+# pipe_command() runs 'cmd' with its stdout piped through 'filter_cmd' (e.g. a compressor) into 'out_path'. If the
+# filter fails, 'cmd' is stopped before the error is raised. Returns the number of bytes written.
+def pipe_command(cmd, filter_cmd, out_path):
+    with open(out_path, 'wb') as out_handle:
+        producer = telemetry.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            consumer = telemetry.Popen(filter_cmd, stdin=producer.stdout, stdout=out_handle)
+            producer.stdout.close()
+            consumer.wait()
+        except BaseException:
+            stop_process(producer)
+            raise
+        producer.wait()
+    executor.validate_output(out_path)
+    return os.path.getsize(out_path)
+
+# pump_stream() copies a pipe into a file descriptor in fixed-size chunks, keeping memory flat whatever the output
+# size. Returns the number of bytes copied.
+def pump_stream(source, dest_fd, chunk_size=1 << 20):
+    streamed = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            written = os.write(dest_fd, view)
+            view = view[written:]
+        streamed += len(chunk)
+    source.close()
+    return streamed
+
+# open_fifo_writer() opens the write end of a named pipe once its reader ('reader_process') has opened the other end.
+# Returns None if the reader exits first, rather than blocking forever.
+def open_fifo_writer(fifo_path, reader_process, poll_interval=0.1):
+    while reader_process.poll() is None:
+        try:
+            fifo_fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            time.sleep(poll_interval)
+            continue
+        os.set_blocking(fifo_fd, True)
+        return fifo_fd
+    return None
+
+def format_bytes(n_bytes):
+    n_bytes = float(n_bytes)
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if unit == 'B' and n_bytes < 1024:
+            return "{0:.0f} B".format(n_bytes)
+        if n_bytes < 1024 or unit == 'TB':
+            return "{0:.1f} {1}".format(n_bytes, unit)
+        n_bytes /= 1024.0
+
 # make_flye_command() passes 7 arguments, creates a simple flye command to be executed through the os by the subprocess
 # module, and sends output into the outdir provided in the command prompt.
 
-def make_flye_command(flye_path, long_reads, outdir, sample_name, threads):
+def make_flye_command(flye_path, long_reads, outdir, sample_name, threads, genome_size=None, read_mode='nano-raw'):
     # Fix the random seed so the program produces the same output every time it's run.
     # random.seed(1987)
     # Note, in order to use subprocess, you cannot use integer or float arguments, thus all arguments passed to subprocess
     # must be strings
-    flye_cmd = [flye_path, "--nano-raw", long_reads, "-o", "{0}/flye_assembly".format(outdir), "--threads", threads]
+    flye_cmd = [flye_path, "--" + read_mode, long_reads, "-o", "{0}/flye_assembly".format(outdir), "--threads", threads]
+    if genome_size is not None:
+        flye_cmd += ["--genome-size", genome_size]
     print("Performing Flye Assembly")
-    subprocess.run(flye_cmd)
+    telemetry.run(flye_cmd)
     print("Flye Assembly Finished")
     flye_directory = "{0}/flye_assembly".format(outdir)
     return flye_directory
 
-def make_flye_command_alt(flye_path, long_reads, outdir, sample_name, threads):
+def make_flye_command_alt(flye_path, long_reads, outdir, sample_name, threads, genome_size=None,
+                          read_mode='nano-raw'):
     # Fix the random seed so the program produces the same output every time it's run.
     # random.seed(1987)
     # Note, in order to use subprocess, you cannot use integer or float arguments, thus all arguments passed to subprocess
     # must be strings
-    flye_cmd = [flye_path, "--nano-raw", long_reads, "-o", "{0}/flye_assembly".format(outdir), "--plasmids", "--meta", "--threads", threads]
+    flye_cmd = [flye_path, "--" + read_mode, long_reads, "-o", "{0}/flye_assembly".format(outdir), "--plasmids", "--meta", "--threads", threads]
+    if genome_size is not None:
+        flye_cmd += ["--genome-size", genome_size]
     print("Performing Flye Assembly")
-    subprocess.run(flye_cmd)
+    telemetry.run(flye_cmd)
     print("Flye Assembly Finished")
     flye_directory = "{0}/flye_assembly".format(outdir)
     return flye_directory
 
+# flye_read_mode() returns the Flye read type: '--flye_mode', or else the one the read QC stage derived from the read
+# quality. Flye releases before 2.9 have no --nano-hq mode and get --nano-raw.
+def flye_read_mode(args, qc_report):
+    if args.flye_mode != 'auto':
+        return args.flye_mode
+    read_mode = load_parameters(qc_report)['flye_mode']
+    version = re.match(r'(\d+)\.(\d+)', probe_tool_version('flye', args.flye_path))
+    if read_mode == 'nano-hq' and version is not None and (int(version.group(1)), int(version.group(2))) < (2, 9):
+        print("Flye {0} has no --nano-hq mode; using --nano-raw".format(version.group(0)))
+        return 'nano-raw'
+    return read_mode
+
+
 # simple execution of berokka through subprocess module
 def make_berokka_command(berokka_path, infile, outdir):
-    berokka_command = [berokka_path, infile, '--outdir', '{0}/berokka_results'.format(outdir)]
-    subprocess.run(berokka_command)
+    berokka_command = [berokka_path, '--force', infile, '--outdir', '{0}/berokka_results'.format(outdir)]
+    telemetry.run(berokka_command)
     return
 
 
-def make_minimap2_command(minimap2_path, reference, long_reads, threads, outdir, racon_polish_number):
-    minimap2_cmd = ['{0}'.format(minimap2_path), '-t', threads, '-ax', 'map-ont', reference, long_reads]
-    result = subprocess.run(minimap2_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    minimap2 = result.stdout.decode('utf-8')
-    minimap2_align = "{0}/align_{1}.sam".format(outdir, racon_polish_number)
-    minimap2_align_file = open(minimap2_align, 'w')
-    minimap2_align_file.write(minimap2)
-    minimap2_align_file.close()
-    return
+def make_minimap2_command(minimap2_path, reference, long_reads, threads, outdir, racon_polish_number,
+                          alignment_format='sam', index_cache=None):
+    # minimap2 output is compressed on the fly into a gzipped SAM/PAF file in 'outdir' (the scratch directory) rather
+    # than buffered in memory or written uncompressed, since SAM output for high-depth ONT runs can be tens of GB.
+    # racon reads gzipped overlaps directly.
+    minimap2_align = "{0}/align_{1}.{2}.gz".format(outdir, racon_polish_number, alignment_format)
+    if index_cache is not None:
+        reference = index_cache.minimap2_index(minimap2_path, reference)
+    align_threads, compress_threads = resources.split_threads(threads, 'minimap2', 'pigz')
+    minimap2_cmd = make_minimap2_args(minimap2_path, reference, long_reads, align_threads, alignment_format)
+    streamed = pipe_command(minimap2_cmd, compressor(compress_threads), minimap2_align)
+    print("Streamed {0} of compressed minimap2 alignments to {1}".format(format_bytes(streamed), minimap2_align))
+    return minimap2_align
+
+
+def make_minimap2_args(minimap2_path, reference, long_reads, threads, alignment_format):
+    if alignment_format == 'paf':
+        return ['{0}'.format(minimap2_path), '-t', threads, '-x', 'map-ont', reference, long_reads]
+    return ['{0}'.format(minimap2_path), '-t', threads, '-ax', 'map-ont', reference, long_reads]
+
+
+def make_racon_longRead_args(racon_path, long_reads, overlaps, target_sequences, threads, window=500):
+    return ['{0}'.format(racon_path), '-t', threads, '-m', '8', '-x', '-6', '-g', '-8', '-w', str(window),
+            long_reads, overlaps, target_sequences]
 
 
 def make_racon_longRead_command(racon_path, long_reads, overlaps, target_sequences, outdir,
-                                sample_name, threads, racon_polish_number):
-    racon_cwd = ['{0}'.format(racon_path), '-t', threads, '-m', '8', '-x', '-6', '-g', '-8', '-w', '500',
-                 long_reads, overlaps, target_sequences]
-    result = subprocess.run(racon_cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    racon = result.stdout.decode('utf-8')
+                                sample_name, threads, racon_polish_number, window=500):
+    racon_cwd = make_racon_longRead_args(racon_path, long_reads, overlaps, target_sequences, threads, window)
     racon_fasta = "{0}/longRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon_polish_number)
-    racon_fasta_file = open(racon_fasta, 'w')
-    racon_fasta_file.write(racon)
-    racon_fasta_file.close()
-    return
+    streamed = stream_command(racon_cwd, racon_fasta)
+    print("Streamed {0} of racon consensus to {1}".format(format_bytes(streamed), racon_fasta))
+    return racon_fasta
+
+
+# run_racon_through_fifo() runs 'racon_cmd', whose overlap file is the named pipe 'fifo_path', with 'align_cmd'
+# streaming its alignments into the pipe, so that the alignments never touch the disk. racon picks the overlap format
+# from the file extension, hence the FIFO is named align_N.sam/.paf. Returns the number of alignment bytes streamed.
+def run_racon_through_fifo(align_cmd, racon_cmd, fifo_path, racon_fasta):
+    os.mkfifo(fifo_path)
+    racon = None
+    aligner = None
+    fifo_fd = None
+    try:
+        with open(racon_fasta, 'wb') as racon_handle:
+            racon = telemetry.Popen(racon_cmd, stdout=racon_handle)
+        fifo_fd = open_fifo_writer(fifo_path, racon)
+        if fifo_fd is None:
+            raise Exception("racon exited before opening the alignment stream {0}".format(fifo_path))
+        aligner = telemetry.Popen(align_cmd, stdout=subprocess.PIPE)
+        streamed = pump_stream(aligner.stdout, fifo_fd)
+        os.close(fifo_fd)
+        fifo_fd = None
+        aligner.wait()
+        racon.wait()
+    except BaseException:
+        if fifo_fd is not None:
+            os.close(fifo_fd)
+        for process in (aligner, racon):
+            if process is not None and process.returncode is None:
+                stop_process(process)
+        raise
+    finally:
+        os.remove(fifo_path)
+    executor.validate_output(racon_fasta)
+    return streamed
+
+
+def make_minimap2_racon_fifo_command(minimap2_path, racon_path, reference, long_reads, outdir, scratch, sample_name,
+                                     threads, racon_polish_number, alignment_format='sam', index_cache=None,
+                                     window=500):
+    fifo_path = "{0}/align_{1}.{2}".format(scratch, racon_polish_number, alignment_format)
+    racon_fasta = "{0}/longRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon_polish_number)
+    minimap2_reference = reference
+    if index_cache is not None:
+        minimap2_reference = index_cache.minimap2_index(minimap2_path, reference)
+    minimap2_cmd = make_minimap2_args(minimap2_path, minimap2_reference, long_reads, threads, alignment_format)
+    racon_cwd = make_racon_longRead_args(racon_path, long_reads, fifo_path, reference, threads, window)
+    streamed = run_racon_through_fifo(minimap2_cmd, racon_cwd, fifo_path, racon_fasta)
+    print("Streamed {0} of minimap2 alignments into racon".format(format_bytes(streamed)))
+    print("Streamed {0} of racon consensus to {1}".format(format_bytes(os.path.getsize(racon_fasta)), racon_fasta))
+    return racon_fasta
 
 
 # circlator fixstart execution through subprocess module
 def make_circlator_fixstart_command(circlator_path, dnaA_file, infile, sample_name):
     circlator_fixstart_command = [circlator_path, 'fixstart', '--genes_fa', dnaA_file, infile, sample_name, '--verbose']
-    subprocess.run(circlator_fixstart_command)
+    telemetry.run(circlator_fixstart_command)
     return
 
 
+# start_gene_file() is the start-site database of '--dnaA_file', or the bundled default when none is given.
+def start_gene_file(dnaA_file=None):
+    if dnaA_file is not None:
+        return dnaA_file
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), './../db/uniprot_dnaA.nucleotides.fa')
+
+
+# run_fixstart() rotates the contigs of 'infile' to their start genes into 'prefix'.fasta, with the built-in locator
+# (start_genes.py) or circlator fixstart depending on '--start_locator'.
+def run_fixstart(args, dnaA_file, infile, prefix):
+    if args.start_locator == 'circlator':
+        make_circlator_fixstart_command(args.circlator_path, dnaA_file, infile, prefix)
+    else:
+        fix_start(infile, dnaA_file, prefix, args.start_min_id, args.prodigal_path)
+
+
+def fixstart_tools(args):
+    if args.start_locator == 'circlator':
+        return {'circlator': args.circlator_path}
+    return {}
+
+
 def make_circlator_clean_command(circlator_path, infile, sample_name):
     circlator_clean_command = [circlator_path, 'clean', '--min_contig_length', '500', '--verbose', infile, sample_name]
-    subprocess.run(circlator_clean_command)
+    telemetry.run(circlator_clean_command)
     return
 
 
@@ -110,36 +307,369 @@ def make_medaka_command(medaka_path, long_reads, contigs, outdir, threads):
 # Add This '-m' parameter as arugment and set 'r941_min_high' as default, which is the medaka default as well and what
 # we usually use to train our algorithms.
     medaka_cmd = ['{0}'.format(medaka_path), '-i', long_reads, '-d', contigs, '-o',
-                  '{0}/medaka_results'.format(outdir), '-m', 'r941_min_high_g360', '-t', threads]
-    subprocess.run(medaka_cmd)
+                  '{0}/medaka_results'.format(outdir), '-m', 'r941_min_high_g360', '-t',
+                  resources.tool_threads('medaka', threads)]
+    telemetry.run(medaka_cmd)
     return
 
 
-def make_bwa_command(bwa_path, assembly_reference, pe_reads, outdir, threads, racon_polish_number):
+def bwa_index_prefix(bwa_path, assembly_reference, index_cache=None):
     print("Indexing assembly reference for bwa alignment")
+    if index_cache is not None:
+        return index_cache.bwa_index(bwa_path, assembly_reference)
     bwa_index_cmd = ['{0}'.format(bwa_path), 'index', assembly_reference]
-    subprocess.run(bwa_index_cmd)
+    telemetry.run(bwa_index_cmd)
+    return assembly_reference
+
+
+# make_bwa_command() aligns the short reads into a gzipped SAM file in 'outdir' (the scratch directory), compressed as
+# bwa writes it. Returns the alignment path.
+def make_bwa_command(bwa_path, assembly_reference, pe_reads, outdir, threads, racon_polish_number, index_cache=None):
+    bwa_prefix = bwa_index_prefix(bwa_path, assembly_reference, index_cache)
     print("bwa-mem alignment with assembly reference and paired-end short-reads")
-    bwa_align_cmd = ['{0}'.format(bwa_path), 'mem', '-t', threads, '-o',
-                     '{0}/align_{1}.sam'.format(outdir, racon_polish_number), assembly_reference, pe_reads]
-    subprocess.run(bwa_align_cmd)
-    return
+    align_threads, compress_threads = resources.split_threads(threads, 'bwa', 'pigz')
+    bwa_align_cmd = ['{0}'.format(bwa_path), 'mem', '-t', align_threads, bwa_prefix, pe_reads]
+    sam_file = '{0}/align_{1}.sam.gz'.format(outdir, racon_polish_number)
+    streamed = pipe_command(bwa_align_cmd, compressor(compress_threads), sam_file)
+    print("Streamed {0} of compressed bwa alignments to {1}".format(format_bytes(streamed), sam_file))
+    return sam_file
 
 
 def make_racon_shortRead_command(racon_path, pe_reads, overlaps, target_sequences, outdir, sample_name,
                                  threads, racon_polish_number):
     racon_cwd = ['{0}'.format(racon_path), '-t', threads, pe_reads, overlaps, target_sequences]
-    result = subprocess.run(racon_cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    racon = result.stdout.decode('utf-8')
     racon_fasta = "{0}/shortRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon_polish_number)
-    racon_fasta_file = open(racon_fasta, 'w')
-    racon_fasta_file.write(racon)
-    racon_fasta_file.close()
-    return
+    streamed = stream_command(racon_cwd, racon_fasta)
+    print("Streamed {0} of racon consensus to {1}".format(format_bytes(streamed), racon_fasta))
+    return racon_fasta
+
+
+# index_cache_for() returns the shared bwa/minimap2/faidx index cache, or None if caching is switched off.
+def index_cache_for(args):
+    if args.index_cache is None:
+        return None
+    return IndexCache(args.index_cache, args.index_cache_size)
+
+
+# run_longRead_racon_round() performs one minimap2 + racon long-read polish, either through a compressed alignment file
+# in the scratch directory that is removed afterwards or, with '--stream_mode fifo', through a named pipe. Long reads
+# are always aligned afresh: a real racon round edits nearly every ONT read's span, so '--incremental_alignment' would
+# only add a lift-over scan to the full re-alignment. Returns the polished FASTA path.
+def run_longRead_racon_round(args, reference, racon_polish_number, threads):
+    scratch = make_scratch_dir(args)
+    window = load_parameters(args.read_qc_report)['racon_window']
+    if args.stream_mode == 'fifo':
+        return make_minimap2_racon_fifo_command(args.minimap2_path, args.racon_path, reference, args.long_reads,
+                                                args.outdir, scratch, args.sample_name, threads, racon_polish_number,
+                                                args.alignment_format, index_cache_for(args), window)
+    index_cache = index_cache_for(args)
+    def align(reads, label):
+        return make_minimap2_command(args.minimap2_path, reference, reads, threads, scratch, label,
+                                     args.alignment_format, index_cache)
+    align_file = align(args.long_reads, racon_polish_number)
+    racon_fasta = make_racon_longRead_command(args.racon_path, args.long_reads, align_file, reference, args.outdir,
+                                              args.sample_name, threads, racon_polish_number, window)
+    checkpoint()
+    os.remove(align_file)
+    return racon_fasta
+
+
+# run_shortRead_racon_round() performs one bwa + racon short-read polish, in the same modes.
+def run_shortRead_racon_round(args, reference, racon_polish_number, threads):
+    scratch = make_scratch_dir(args)
+    if args.stream_mode == 'fifo':
+        bwa_prefix = bwa_index_prefix(args.bwa_path, reference, index_cache_for(args))
+        bwa_align_cmd = [args.bwa_path, 'mem', '-t', threads, bwa_prefix, args.pe_reads]
+        fifo_path = "{0}/align_{1}.sam".format(scratch, racon_polish_number)
+        racon_fasta = "{0}/shortRead_polish_results/{1}_racon{2}.fasta".format(args.outdir, args.sample_name,
+                                                                               racon_polish_number)
+        racon_cwd = [args.racon_path, '-t', threads, args.pe_reads, fifo_path, reference]
+        print("bwa-mem alignment with assembly reference and paired-end short-reads, streamed into racon")
+        streamed = run_racon_through_fifo(bwa_align_cmd, racon_cwd, fifo_path, racon_fasta)
+        print("Streamed {0} of bwa alignments into racon".format(format_bytes(streamed)))
+        return racon_fasta
+    index_cache = index_cache_for(args)
+    def align(reads, label):
+        return make_bwa_command(args.bwa_path, reference, reads, scratch, threads, label, index_cache)
+    if args.incremental_alignment:
+        sam_file = align_incrementally('short', scratch, reference, args.pe_reads, 'sam', racon_polish_number, align)
+    else:
+        sam_file = align(args.pe_reads, racon_polish_number)
+    racon_fasta = make_racon_shortRead_command(args.racon_path, args.pe_reads, sam_file, reference, args.outdir,
+                                               args.sample_name, threads, racon_polish_number)
+    checkpoint()
+    if not args.incremental_alignment:
+        os.remove(sam_file)
+    return racon_fasta
+
+
+# Memory in GB of the fix_repeats stage; what bwa does not need goes to samtools sort.
+FIX_REPEATS_MEMORY = 8.0
+
+
+# run_fix_repeats() maps the short reads back to the final racon polish and re-polishes low coverage (repeat) regions
+# with fix_repeats.correct_regions().
+def run_fix_repeats(args, infile, outfile, threads, memory=FIX_REPEATS_MEMORY):
+    index_cache = index_cache_for(args)
+    bwa_prefix = bwa_index_prefix(args.bwa_path, infile, index_cache)
+    scratch = make_scratch_dir(args)
+    bam_infile = "{0}/{1}_sort.bam".format(scratch, os.path.splitext(os.path.basename(infile))[0])
+    fix_repeats.align_sorted(bwa_prefix, args.pe_reads, bam_infile, threads,
+                             memory - resources.tool_memory('bwa'), args.bwa_path)
+    tmp_directory = "{0}/fix_repeats_tmp".format(scratch)
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    read_length = load_parameters(args.read_qc_report)['read_length']
+    fix_repeats.correct_regions(infile, args.pe_reads, bam_infile, tmp_directory, outfile, read_length, threads,
+                                index_cache, bwa_path=args.bwa_path)
+    checkpoint()
+    shutil.rmtree(tmp_directory)
+    os.remove(bam_infile)
+    return outfile
+
+
+# fix_repeats_stage_for() declares the final stage, which corrects low coverage regions of the last racon polish.
+def fix_repeats_stage_for(args, racon4):
+    shortRead_polish_outdir = "{0}/shortRead_polish_results".format(args.outdir)
+    final = "{0}/{1}_final.fasta".format(shortRead_polish_outdir, args.sample_name)
+    memory = min(FIX_REPEATS_MEMORY, args.max_memory)
+    def fix_repeats_stage(threads):
+        print("Executing fix repeat script for final assembly")
+        run_fix_repeats(args, racon4, final, threads, memory)
+    return Stage('fix_repeats', fix_repeats_stage, inputs=[racon4, args.pe_reads, args.read_qc_report],
+                 outputs=[final],
+                 tools={'bwa': args.bwa_path, 'samtools': 'samtools', 'bedtools': 'bedtools', 'bcftools': 'bcftools'},
+                 memory=memory)
+
+
+# polish_profile_stage_for() declares the report stage that counts the edits each polishing stage in 'steps' (stage
+# name, input, output) made and joins them with the stage's CPU time.
+def polish_profile_stage_for(args, steps):
+    profile = os.path.join(args.outdir, PROFILE_JSON)
+    def polish_profile(threads):
+        print("Profiling the edits and CPU time of each polishing stage")
+        run_polish_profile(args.outdir, steps)
+    inputs = [steps[0][1]] + [after for name, before, after in steps]
+    return Stage('polish_profile', polish_profile, inputs=inputs, outputs=[profile],
+                 params={'stages': [name for name, before, after in steps]}, max_threads=1, memory=1.0)
+
+
+# build_stages() lays out the pipeline as a list of stages. The de novo and '--existing_contigs' runs only differ in
+# where the first set of contigs comes from, so both share the same polishing stages.
+def build_stages(args):
+    outdir = args.outdir
+    sample_name = args.sample_name
+    dnaA_file = start_gene_file(args.dnaA_file)
+    dnaA_inputs = [dnaA_file] if os.path.isfile(dnaA_file) else []
+    fixstart_params = {'dnaA_file': dnaA_file, 'start_locator': args.start_locator, 'start_min_id': args.start_min_id}
+    longRead_outdir = '{0}/longRead_polish_results'.format(outdir)
+    shortRead_polish_outdir = "{0}/shortRead_polish_results".format(outdir)
+    stages = []
+    # in adaptive mode the later rounds of each phase depend on how much the first round changed the assembly
+    adaptive_params = {}
+    if args.adaptive_polish:
+        adaptive_params = {'max_long_rounds': args.max_long_rounds, 'max_short_rounds': args.max_short_rounds,
+                           'convergence_threshold': args.convergence_threshold}
+    def adaptive_inputs(first_reference, first_polished):
+        return [first_reference, first_polished] if args.adaptive_polish else []
+
+    # separate R1/R2 files are interleaved once into the scratch directory, and every later stage reads that file
+    if getattr(args, 'pe_reads_2', None) is not None:
+        args = argparse.Namespace(**vars(args))
+        pe_pair = [args.pe_reads, args.pe_reads_2]
+        args.pe_reads = os.path.join(scratch_dir(args), 'pe_reads_interleaved.fastq.gz')
+        args.pe_reads_2 = None
+        def interleave(threads):
+            print("Interleaving paired-end reads {0} and {1}".format(*pe_pair))
+            interleave_reads(pe_pair[0], pe_pair[1], args.pe_reads, threads)
+        stages.append(Stage('interleave', interleave, inputs=pe_pair, outputs=[args.pe_reads], max_threads=4,
+                            memory=0.5))
+
+    # the read QC report supplies the Flye mode, racon window and repeat read length of the later stages; per-contig
+    # jobs use the report of their sample
+    if getattr(args, 'read_qc_report', None) is None:
+        args = argparse.Namespace(**vars(args))
+        args.read_qc_report = report_path(outdir, sample_name)
+        genome_size = parse_genome_size(args.genome_size) if args.genome_size is not None else None
+        qc_inputs = [args.long_reads, args.pe_reads]
+        def read_qc(threads):
+            print("Checking the long and paired-end reads")
+            run_read_qc(qc_inputs[0], qc_inputs[1], args.read_qc_report, threads, genome_size,
+                        args.min_long_depth, args.min_short_depth, args.min_long_n50)
+        stages.append(Stage('read_qc', read_qc, inputs=qc_inputs, outputs=[args.read_qc_report],
+                            params={'genome_size': genome_size, 'min_long_depth': args.min_long_depth,
+                                    'min_short_depth': args.min_short_depth, 'min_long_n50': args.min_long_n50},
+                            max_threads=2, memory=1.0))
+    qc_report = args.read_qc_report
+
+    if args.genome_size is not None and args.target_depth > 0:
+        all_long_reads = args.long_reads
+        subsampled = "{0}/subsampled_reads/{1}_long_reads.fastq".format(outdir, sample_name)
+        def subsample(threads):
+            print("Subsampling long reads to {0}x of a {1} genome".format(args.target_depth, args.genome_size))
+            subsample_reads(all_long_reads, subsampled, parse_genome_size(args.genome_size), args.target_depth)
+        stages.append(Stage('subsample', subsample, inputs=[all_long_reads, qc_report], outputs=[subsampled],
+                            params={'genome_size': args.genome_size, 'target_depth': args.target_depth},
+                            max_threads=1, memory=1.0))
+        # every later stage reads the subsampled set
+        args = argparse.Namespace(**vars(args))
+        args.long_reads = subsampled
 
+    if args.existing_contigs:
+        assembly = args.contigs
+    else:
+        assembly = "{0}/flye_assembly/{1}_assembly.fasta".format(outdir, sample_name)
+
+        def flye(threads):
+            read_mode = flye_read_mode(args, qc_report)
+            if args.mp is True:
+                make_flye_command_alt(args.flye_path, args.long_reads, outdir, sample_name, threads, args.genome_size,
+                                      read_mode)
+            else:
+                make_flye_command(args.flye_path, args.long_reads, outdir, sample_name, threads, args.genome_size,
+                                  read_mode)
+            os.replace("{0}/flye_assembly/assembly.fasta".format(outdir), assembly)
+        stages.append(Stage('flye', flye, inputs=[args.long_reads, qc_report], outputs=[assembly],
+                            params={'meta_plasmids': bool(args.mp), 'genome_size': args.genome_size,
+                                    'flye_mode': args.flye_mode},
+                            tools={'flye': args.flye_path},
+                            min_threads=4, memory=16.0))
+
+    trimmed = "{0}/berokka_results/02.trimmed.fa".format(outdir)
+    def berokka(threads):
+        print("Circularization check with berokka and creating input for long-read initial round of polishing")
+        make_berokka_command(args.berokka_path, assembly, outdir)
+    stages.append(Stage('berokka', berokka, inputs=[assembly], outputs=[trimmed],
+                        tools={'berokka': args.berokka_path}, max_threads=1))
 
-def get_arguments():
-    """Parse assembler arguments"""
+    clean_prefix = "{0}/berokka_results/{1}_clean".format(outdir, sample_name)
+    clean = clean_prefix + ".fasta"
+    def circlator_clean(threads):
+        print("Removing potential self-contained contigs")
+        make_circlator_clean_command(args.circlator_path, trimmed, clean_prefix)
+    stages.append(Stage('circlator_clean', circlator_clean, inputs=[trimmed], outputs=[clean],
+                        tools={'circlator': args.circlator_path}, max_threads=1, memory=2.0))
+
+    racon4 = "{0}/{1}_racon4.fasta".format(shortRead_polish_outdir, sample_name)
+    if args.per_contig:
+        def per_contig_polish(threads):
+            print("Polishing each contig as an independent job")
+            os.makedirs(shortRead_polish_outdir, exist_ok=True)
+            polish_per_contig(build_stages, args, clean, racon4, threads, args.polish_workers)
+        stages.append(Stage('per_contig_polish', per_contig_polish,
+                            inputs=[clean, args.long_reads, args.pe_reads, qc_report],
+                            outputs=[racon4], params={'alignment_format': args.alignment_format,
+                                                      'incremental_alignment': args.incremental_alignment,
+                                                      'model': 'r941_min_high_g360', **fixstart_params},
+                            tools=dict(fixstart_tools(args), minimap2=args.minimap2_path, racon=args.racon_path,
+                                       medaka_consensus=args.medaka_path, bwa=args.bwa_path), memory=16.0))
+        fix_repeats_stage = fix_repeats_stage_for(args, racon4)
+        steps = [('per_contig_polish', clean, racon4), ('fix_repeats', racon4, fix_repeats_stage.outputs[0])]
+        return set_timeouts(stages + [fix_repeats_stage, polish_profile_stage_for(args, steps)], args.stage_timeout)
+
+    racon1 = "{0}/{1}_racon1.fasta".format(longRead_outdir, sample_name)
+    def racon1_polish(threads):
+        print("Performing iterative long-read polishes with contig turning using fixstart")
+        print("Perform Racon Polish #1")
+        os.makedirs(longRead_outdir, exist_ok=True)
+        start = time.time()
+        run_longRead_racon_round(args, clean, 1, threads)
+        if args.adaptive_polish:
+            ConvergenceLog(outdir).record_round('long1', 'long', clean, racon1, time.time() - start)
+    stages.append(Stage('racon1', racon1_polish, inputs=[clean, args.long_reads, qc_report], outputs=[racon1],
+                        params={'alignment_format': args.alignment_format},
+                        tools={'minimap2': args.minimap2_path, 'racon': args.racon_path}, memory=8.0))
+
+    circlator_prefix = "{0}/{1}_circlator".format(longRead_outdir, sample_name)
+    circlator_outfile = circlator_prefix + ".fasta"
+    def fixstart1(threads):
+        print("Executing fixstart ({0}) to obtain start position(s)".format(args.start_locator))
+        run_fixstart(args, dnaA_file, racon1, circlator_prefix)
+    stages.append(Stage('fixstart1', fixstart1, inputs=[racon1] + dnaA_inputs, outputs=[circlator_outfile],
+                        params=fixstart_params, tools=fixstart_tools(args),
+                        max_threads=1, memory=2.0))
+
+    racon2 = "{0}/{1}_racon2.fasta".format(longRead_outdir, sample_name)
+    def racon2_polish(threads):
+        if args.adaptive_polish:
+            def long_round(reference, polish_round, threads):
+                print("Perform adaptive long-read Racon Polish #{0}".format(polish_round))
+                return run_longRead_racon_round(args, reference, 'L{0}'.format(polish_round), threads)
+            run_adaptive_rounds(ConvergenceLog(outdir), 'long', clean, racon1, circlator_outfile, racon2, long_round,
+                                args.max_long_rounds, args.convergence_threshold, threads)
+            return
+        print("Perform Racon Polish #2")
+        run_longRead_racon_round(args, circlator_outfile, 2, threads)
+    stages.append(Stage('racon2', racon2_polish,
+                        inputs=[circlator_outfile, args.long_reads, qc_report] + adaptive_inputs(clean, racon1),
+                        outputs=[racon2], params=dict(adaptive_params, alignment_format=args.alignment_format),
+                        tools={'minimap2': args.minimap2_path, 'racon': args.racon_path}, memory=8.0))
+
+    medaka_outdir = "{0}/medaka_results".format(outdir)
+    consensus = "{0}/consensus.fasta".format(medaka_outdir)
+    def medaka(threads):
+        print("Perform long read polishes with Medaka")
+        # medaka_consensus re-uses intermediate files found in an existing output directory, so start clean
+        shutil.rmtree(medaka_outdir, ignore_errors=True)
+        make_medaka_command(args.medaka_path, args.long_reads, racon2, outdir, threads)
+    medaka_batch = None
+    if args.medaka_batch > 1 and getattr(args, 'batch_outdir', None) is not None:
+        medaka_batch = (run_medaka_batch, MedakaJob(sample_name, outdir, args.batch_outdir, racon2, args.long_reads,
+                                                    consensus, args.medaka_path, 'r941_min_high_g360',
+                                                    args.medaka_batch_size))
+    stages.append(Stage('medaka', medaka, inputs=[racon2, args.long_reads], outputs=[consensus],
+                        params={'model': 'r941_min_high_g360'}, tools={'medaka_consensus': args.medaka_path},
+                        max_threads=resources.max_threads('medaka'), memory=8.0, batch=medaka_batch))
+
+    racon3 = "{0}/{1}_racon3.fasta".format(shortRead_polish_outdir, sample_name)
+    def racon3_polish(threads):
+        print("Executing shortRead polishes with Racon")
+        os.makedirs(shortRead_polish_outdir, exist_ok=True)
+        print("Executing Racon for third round of polishing")
+        start = time.time()
+        run_shortRead_racon_round(args, consensus, 3, threads)
+        if args.adaptive_polish:
+            ConvergenceLog(outdir).record_round('short1', 'short', consensus, racon3, time.time() - start)
+    stages.append(Stage('racon3', racon3_polish, inputs=[consensus, args.pe_reads], outputs=[racon3],
+                        tools={'bwa': args.bwa_path, 'racon': args.racon_path}, memory=4.0))
+
+    circlator_prefix2 = "{0}/{1}_circlator2".format(shortRead_polish_outdir, sample_name)
+    circlator_outfile2 = circlator_prefix2 + ".fasta"
+    def fixstart2(threads):
+        print("Executing fixstart ({0}) to rotate #2 and orient properly".format(args.start_locator))
+        run_fixstart(args, dnaA_file, racon3, circlator_prefix2)
+    stages.append(Stage('fixstart2', fixstart2, inputs=[racon3] + dnaA_inputs, outputs=[circlator_outfile2],
+                        params=fixstart_params, tools=fixstart_tools(args),
+                        max_threads=1, memory=2.0))
+
+    def racon4_polish(threads):
+        if args.adaptive_polish:
+            def short_round(reference, polish_round, threads):
+                print("Executing adaptive short-read Racon polish #{0}".format(polish_round))
+                return run_shortRead_racon_round(args, reference, 'S{0}'.format(polish_round), threads)
+            run_adaptive_rounds(ConvergenceLog(outdir), 'short', consensus, racon3, circlator_outfile2, racon4,
+                                short_round, args.max_short_rounds, args.convergence_threshold, threads)
+        else:
+            print("Executing Racon for fourth round of polishing")
+            run_shortRead_racon_round(args, circlator_outfile2, 4, threads)
+        # strip header descriptions here so that the recorded output matches what fix_repeats reads
+        normalise_fasta(racon4)
+    stages.append(Stage('racon4', racon4_polish,
+                        inputs=[circlator_outfile2, args.pe_reads] + adaptive_inputs(consensus, racon3),
+                        outputs=[racon4],
+                        params=dict(adaptive_params, incremental_alignment=args.incremental_alignment),
+                        tools={'bwa': args.bwa_path, 'racon': args.racon_path}, memory=4.0))
+
+    stages.append(fix_repeats_stage_for(args, racon4))
+    steps = [('racon1', clean, racon1), ('fixstart1', racon1, circlator_outfile), ('racon2', circlator_outfile, racon2),
+             ('medaka', racon2, consensus), ('racon3', consensus, racon3), ('fixstart2', racon3, circlator_outfile2),
+             ('racon4', circlator_outfile2, racon4), ('fix_repeats', racon4, stages[-1].outputs[0])]
+    stages.append(polish_profile_stage_for(args, steps))
+    return set_timeouts(stages, args.stage_timeout)
+
+
+def get_arguments(argv=None):
+    """Parse assembler arguments (from the command line, or from 'argv')"""
     parser = argparse.ArgumentParser(description="ONT plus Illumina consensus assembler", add_help=False)
 
     # Help arguments
@@ -150,14 +680,19 @@ def get_arguments():
 
     # input_arguments
     input_group = parser.add_argument_group("Inputs")
-    input_group.add_argument('-pe', '--pe_reads', required=True, help='interleave paired-end reads', type=str,
-                             default=None)
-    input_group.add_argument('-l', '--long_reads', required=True, help="Path to the ONT long reads", type=str,
+    input_group.add_argument('-pe', '--pe_reads', required=False, nargs='+', type=str, default=None,
+                             help="Interleaved paired-end reads, or separate R1 and R2 files, which are interleaved "
+                             "(and their headers made racon-safe) by the pipeline")
+    input_group.add_argument('-l', '--long_reads', required=False, help="Path to the ONT long reads", type=str,
                              default=None)
     input_group.add_argument('-d', '--dnaA_file', required=False, help="dnaA (default) start sites", type=str,
                             default=None)
     input_group.add_argument('-o', '--outdir', required=True, help="Name of the output directory", type=str,
                                 default=None)
+    input_group.add_argument('--samplesheet', required=False, type=str, default=None,
+                             help="Tab- or comma-separated file with columns sample_name, long_reads, pe_reads and "
+                             "optionally pe_reads_2 (R2 file) and contigs, to assemble many samples at once (replaces "
+                             "-s, -l, -pe and -c)")
     
     # Optional arguments
     optional_group = parser.add_argument_group("Optional inputs")
@@ -169,17 +704,77 @@ def get_arguments():
                              default=False)
     optional_group.add_argument('-c', '--contigs', required=False, help="existing contigs fasta file", type=str,
                              default=None)
-    optional_group.add_argument('-t', '--threads', required=False, help="Number of threads to run program", type=str,
-                                default='1')
+    optional_group.add_argument('-t', '--threads', required=False, type=str, default='1',
+                                help="Number of threads to run program, or 'auto' for every core available to it "
+                                "(within its cgroup CPU quota)")
+    optional_group.add_argument('--genome_size', required=False, type=str, default=None,
+                                help="Estimated genome size (e.g. 5.3m); passed to Flye and used to subsample the long "
+                                "reads to --target_depth")
+    optional_group.add_argument('--target_depth', required=False, type=float, default=100.0,
+                                help="With --genome_size, keep the longest, highest-quality long reads up to this "
+                                "depth before Flye and polishing; 0 keeps every read")
+    optional_group.add_argument('--min_long_depth', required=False, type=float, default=20.0,
+                                help="With --genome_size, reject samples whose long reads give less than this depth "
+                                "before any assembly or polishing stage runs")
+    optional_group.add_argument('--min_short_depth', required=False, type=float, default=20.0,
+                                help="With --genome_size, reject samples whose paired-end reads give less than this "
+                                "depth")
+    optional_group.add_argument('--min_long_n50', required=False, type=int, default=0,
+                                help="Reject samples whose long-read N50 is below this many bp (e.g. 1000); off by "
+                                "default")
+    optional_group.add_argument('--per_contig', required=False, action='store_true', default=False,
+                                help="After circlator clean, polish each contig (replicon) as an independent job in "
+                                "a process pool with the reads assigned to it")
+    optional_group.add_argument('--polish_workers', required=False, type=int, default=None,
+                                help="Number of contigs polished at once with --per_contig (default: one per "
+                                "thread, up to the number of contigs)")
+    optional_group.add_argument('--adaptive_polish', required=False, action='store_true', default=False,
+                                help="Only run the second and later racon rounds of the long-read and short-read "
+                                "phases while the previous round still changes the assembly")
+    optional_group.add_argument('--convergence_threshold', required=False, type=float, default=5.0,
+                                help="With --adaptive_polish, stop a polishing phase once a round makes fewer than "
+                                "this many edits per Mbp")
+    optional_group.add_argument('--max_long_rounds', required=False, type=int, default=2,
+                                help="With --adaptive_polish, maximum number of long-read racon rounds")
+    optional_group.add_argument('--max_short_rounds', required=False, type=int, default=2,
+                                help="With --adaptive_polish, maximum number of short-read racon rounds")
+    optional_group.add_argument('--index_cache', required=False, type=str, default=None,
+                                help="Directory of the bwa/minimap2/faidx index cache shared by all stages and "
+                                "samples (default: outdir/index_cache)")
+    optional_group.add_argument('--index_cache_size', required=False, type=float, default=20.0,
+                                help="Size limit of the index cache in GB; least recently used indices are evicted")
+    optional_group.add_argument('--no_index_cache', required=False, action='store_true', default=False,
+                                help="Index every reference in place instead of using the index cache")
+    optional_group.add_argument('--max_memory', required=False, type=float, default=None,
+                                help="Memory budget in GB shared by all samples in --samplesheet mode and used to size "
+                                "samtools sort (default: the memory available, within its cgroup limit)")
+    optional_group.add_argument('--stage_timeout', required=False, type=str, default=None,
+                                help="Time limit in hours for the external tools of each stage, e.g. "
+                                "'flye=12,medaka=6', or a single number for every stage; tools still running then "
+                                "are stopped and the sample fails")
+    optional_group.add_argument('--progress', required=False, action='store_true', default=False,
+                                help="Show a live status line with the running stage(s) and their elapsed time")
     # Pipeline arguments
     pipeline_group = parser.add_argument_group("Pipeline Arguments")
     pipeline_group.add_argument('--flye_path', required=False, help="Path to flye executable; please use \'flye\' if"
                                 "with path", type=str, default='flye')
+    pipeline_group.add_argument('--flye_mode', required=False, choices=['auto', 'nano-raw', 'nano-hq'],
+                                default='auto',
+                                help="Flye read type; 'auto' picks --nano-hq for long reads of mean quality Q15 or "
+                                "more (Flye 2.9 or later) and --nano-raw otherwise")
     pipeline_group.add_argument('--berokka_path', required=False, help="Path to berokka executable. Please use "
                                 "\'berokka\' with path", type=str, default='berokka')
     pipeline_group.add_argument('--circlator_path', required=False, help="Path to circlator executable; "
                                 "only for use to fix start position. Please use \'circlator\' in the pathway",
                                 type=str, default='circlator')
+    pipeline_group.add_argument('--start_locator', required=False, choices=['native', 'circlator'], default='native',
+                                help="Rotate contigs to their dnaA/rep start gene with the built-in k-mer locator or "
+                                "with circlator fixstart")
+    pipeline_group.add_argument('--start_min_id', required=False, type=float, default=70.0,
+                                help="Minimum percent identity of a start gene hit with the built-in locator")
+    pipeline_group.add_argument('--prodigal_path', required=False, type=str, default='prodigal',
+                                help="Path to prodigal, used by the built-in locator to pick a start on contigs "
+                                "without a start gene hit (as circlator does); skipped if not installed")
     pipeline_group.add_argument('--minimap2_path', required=False, help='Path to minimap2 executable. Need to include'
                                 '\'minimap2\' in pathway', type=str, default='minimap2')
     pipeline_group.add_argument('--bwa_path', required=False, help="Path to bwa executable. Please use \'bwa\' in "
@@ -188,192 +783,170 @@ def get_arguments():
                                 '\'racon\' in the pathway', type=str, default='racon')
     pipeline_group.add_argument('--medaka_path', required=False, help='Path to medaka executable. Please use'
                                 '\'medaka_consensus\' in the pathway', type=str, default='medaka_consensus')
+    pipeline_group.add_argument('--medaka_batch', required=False, type=int, default=1,
+                                help="In --samplesheet mode, polish up to this many samples with one medaka consensus "
+                                "run, loading the model once (mini_align and medaka >= 1.1 must be installed next to "
+                                "--medaka_path); 1 runs medaka_consensus for each sample")
+    pipeline_group.add_argument('--medaka_batch_size', required=False, type=int, default=100,
+                                help="Inference batch size of the shared medaka consensus run with --medaka_batch")
+    pipeline_group.add_argument('--alignment_format', required=False, choices=['sam', 'paf'], default='sam',
+                                help="Format of the long-read minimap2 alignments handed to racon; PAF is much "
+                                "smaller than SAM")
+    pipeline_group.add_argument('--scratch', required=False, type=str, default=None,
+                                help="Directory for intermediate alignments and sort files, ideally on fast local "
+                                "disk (NVMe, tmpfs); each sample uses scratch/sample_name, removed when it finishes "
+                                "(default: outdir/scratch)")
+    pipeline_group.add_argument('--stream_mode', required=False, choices=['file', 'fifo'], default='file',
+                                help="Stream long- and short-read alignments to a compressed file in --scratch or "
+                                "through a named pipe directly into racon")
+    pipeline_group.add_argument('--incremental_alignment', required=False, action='store_true', default=False,
+                                help="Keep each short-read racon round's alignments in --scratch and carry them over "
+                                "to the next short-read round, re-aligning only reads that overlap the bases the "
+                                "round changed or the new origin after fixstart (file stream mode only). Long-read "
+                                "rounds always align every read")
+    # Resume arguments
+    resume_group = parser.add_argument_group("Resume Arguments")
+    resume_group.add_argument('--resume', required=False, action='store_true', default=False,
+                              help="Re-use an existing outdir, skipping stages whose inputs, parameters and tool "
+                              "versions are unchanged since they last completed")
+    resume_group.add_argument('--from_stage', '--from-stage', required=False, type=str, default=None,
+                              help="First stage to run; earlier stages must have completed previously")
+    resume_group.add_argument('--to_stage', '--to-stage', required=False, type=str, default=None,
+                              help="Last stage to run")
+    resume_group.add_argument('--list_stages', '--list-stages', required=False, action='store_true', default=False,
+                              help="Print the stages of the pipeline in order and exit")
+
+
+    args = parser.parse_args(argv)
+    args.pe_reads_2 = None
+    if args.pe_reads is not None:
+        if len(args.pe_reads) > 2:
+            parser.error("--pe_reads takes one interleaved file or an R1 and an R2 file")
+        args.pe_reads, args.pe_reads_2 = (args.pe_reads + [None])[:2]
+    if args.threads != 'auto' and not args.threads.isdigit():
+        parser.error("--threads takes a number or 'auto'")
+    args.threads = str(resources.resolve_threads(args.threads))
+    args.max_memory = resources.resolve_memory(args.max_memory)
+    return args
 
 
-    args = parser.parse_args()
-    return args
+# read_samplesheet() parses the batch samplesheet into one dict per sample. The header line names the columns; the
+# delimiter is a tab unless the header contains a comma.
+def read_samplesheet(samplesheet):
+    samples = []
+    with open(samplesheet) as sheet:
+        lines = [line.rstrip('\n') for line in sheet if line.strip() and not line.startswith('#')]
+    delimiter = ',' if ',' in lines[0] else '\t'
+    header = [column.strip() for column in lines[0].split(delimiter)]
+    for column in ('sample_name', 'long_reads', 'pe_reads'):
+        if column not in header:
+            raise Exception("Samplesheet {0} is missing the '{1}' column".format(samplesheet, column))
+    for line in lines[1:]:
+        values = [value.strip() for value in line.split(delimiter)]
+        sample = dict(zip(header, values))
+        for column in ('contigs', 'pe_reads_2'):
+            if not sample.get(column):
+                sample[column] = None
+        samples.append(sample)
+    names = [sample['sample_name'] for sample in samples]
+    if len(set(names)) != len(names):
+        raise Exception("Samplesheet {0} contains duplicate sample names".format(samplesheet))
+    return samples
+
+
+# sample_arguments() derives the arguments of a single sample from the batch arguments and a samplesheet row.
+def sample_arguments(args, sample):
+    sample_args = argparse.Namespace(**vars(args))
+    sample_args.sample_name = sample['sample_name']
+    sample_args.long_reads = sample['long_reads']
+    sample_args.pe_reads = sample['pe_reads']
+    sample_args.pe_reads_2 = sample['pe_reads_2']
+    sample_args.contigs = sample['contigs']
+    sample_args.existing_contigs = sample['contigs'] is not None
+    sample_args.outdir = os.path.join(args.outdir, sample['sample_name'])
+    sample_args.samplesheet = None
+    sample_args.batch_outdir = os.path.abspath(args.outdir)
+    return sample_args
+
+
+# resolve_index_cache() fixes the cache location before per-sample or per-contig arguments are derived from 'args', so
+# that they all share one cache.
+def resolve_index_cache(args):
+    if args.no_index_cache:
+        args.index_cache = None
+    elif args.index_cache is None:
+        args.index_cache = os.path.join(args.outdir, 'index_cache')
+    if args.index_cache is not None:
+        args.index_cache = os.path.abspath(args.index_cache)
+
+
+def run_batch(args):
+    samples = read_samplesheet(args.samplesheet)
+    if not args.resume:
+        create_directory(args.outdir)
+    resolve_index_cache(args)
+    jobs = []
+    all_sample_args = []
+    for sample in samples:
+        sample_args = sample_arguments(args, sample)
+        os.makedirs(sample_args.outdir, exist_ok=args.resume)
+        stages = select_stages(build_stages(sample_args), args.from_stage, args.to_stage)
+        jobs.append(SampleJob(sample_args.sample_name, sample_args.outdir, stages, resume=args.resume))
+        all_sample_args.append(sample_args)
+    scheduler = BatchScheduler(jobs, int(args.threads), args.max_memory, batch_sizes={'medaka': args.medaka_batch})
+    with ScratchMonitor() as monitor:
+        for sample_args in all_sample_args:
+            monitor.watch(scratch_dir(sample_args), sample_args.outdir)
+        scheduler.run()
+    for job, sample_args in zip(jobs, all_sample_args):
+        if job.failed is None:
+            remove_scratch(sample_args)
+    scheduler.report(os.path.join(args.outdir, 'batch_report.tsv'))
+    batch_profile(args.outdir, [sample_args.outdir for sample_args in all_sample_args])
+    failed = [job.sample_name for job in jobs if job.failed is not None]
+    if failed:
+        raise Exception("{0} sample(s) failed: {1}".format(len(failed), ', '.join(failed)))
+
+
+# run_sample() runs the pipeline for the single sample described by 'args' (or lists its stages). Raises on failure.
+def run_sample(args):
+    if args.long_reads is None or args.pe_reads is None:
+        raise Exception("--long_reads and --pe_reads are required unless --samplesheet is given")
+    if args.existing_contigs and args.contigs is None:
+        raise Exception("--existing_contigs requires the contigs fasta file given with -c/--contigs")
+    if args.genome_size is not None:
+        parse_genome_size(args.genome_size)
+    resolve_index_cache(args)
+    stages = build_stages(args)
+    if args.list_stages:
+        for stage in stages:
+            print(stage.name)
+        return
+    if not (args.resume or args.from_stage):
+        create_directory(args.outdir)
+    elif not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    with ScratchMonitor() as monitor:
+        monitor.watch(scratch_dir(args), args.outdir)
+        run_stages(stages, args.outdir, args.threads, resume=args.resume, from_stage=args.from_stage,
+                   to_stage=args.to_stage)
+    remove_scratch(args)
 
 
 # Main function that takes argparse arguments and can be passed via a command line prompt.
 def run_conditions():
     args = get_arguments()
-    long_reads = args.long_reads
-    outdir = args.outdir
-    sample_name = args.sample_name
-    threads = args.threads
-    pe_reads = args.pe_reads
-    create_directory(args.outdir)
-    dir = os.path.dirname(__file__)
-    default_db = os.path.join(dir, './../db/uniprot_dnaA.nucleotides.fa')
-
-    # conditional argument that executes assembly + circularization check
-    if not args.existing_contigs:
-        if args.mp is True:
-            make_flye_command_alt(args.flye_path, long_reads, outdir, sample_name, threads)
-            os.system("mv %s %s" % ("{0}/flye_assembly/assembly.fasta".format(outdir, sample_name),
-                                    "{0}/flye_assembly/{1}_assembly.fasta".format(outdir, sample_name)))
-            infile0 = "{0}/flye_assembly/{1}_assembly.fasta".format(outdir, sample_name)
-        else:
-            make_flye_command(args.flye_path, long_reads, outdir, sample_name, threads)
-            os.system("mv %s %s" % ("{0}/flye_assembly/assembly.fasta".format(outdir, sample_name),
-                                "{0}/flye_assembly/{1}_assembly.fasta".format(outdir, sample_name)))
-            infile0 = "{0}/flye_assembly/{1}_assembly.fasta".format(outdir, sample_name)
-        print("Circularization check with berokka and creating input for long-read initial round of polishing")
-        make_berokka_command(args.berokka_path, infile0, args.outdir)
-        infile1 = "{0}/berokka_results/02.trimmed.fa".format(outdir)
-        print("Removing potential self-contained contigs")
-        circlator_clean_outfile_prefix = "{0}/berokka_results/{1}_clean".format(outdir, sample_name)
-        make_circlator_clean_command(args.circlator_path, infile1, circlator_clean_outfile_prefix)
-        infile2 = "{0}/berokka_results/{1}_clean.fasta".format(outdir, sample_name)
-        print("Performing iterative long-read polishes with contig turning using Circlator Fixstart")
-        print("Perform Racon Polish #1")
-        longRead_outdir = '{0}/longRead_polish_results'.format(outdir)
-        create_directory(longRead_outdir)
-        racon1_polish = 1
-        make_minimap2_command(args.minimap2_path, infile2, long_reads, threads, longRead_outdir, racon1_polish)
-        sam_file1 = '{0}/longRead_polish_results/align_{1}.sam'.format(outdir, racon1_polish)
-        make_racon_longRead_command(args.racon_path, long_reads, sam_file1, infile2, outdir, sample_name, threads,
-                                    racon1_polish)
-        infile3 = "{0}/longRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon1_polish)
-        os.system('rm -r %s' % sam_file1)
-        print("Executing Circlator Fixstart to obtain start position(s)")
-        circlator_outfile_prefix = "{0}/longRead_polish_results/{1}_circlator".format(outdir, sample_name)
-        circlator_outfile = "{0}/longRead_polish_results/{1}_circlator.fasta".format(outdir, sample_name)
-        if args.dnaA_file is None:
-            make_circlator_fixstart_command(args.circlator_path, default_db, infile3, circlator_outfile_prefix)
-        else:
-            make_circlator_fixstart_command(args.circlator_path, args.dnaA_file, infile3, circlator_outfile_prefix)
-        print("Perform Racon Polish #2")
-        racon2_polish = 2
-        make_minimap2_command(args.minimap2_path, circlator_outfile, long_reads, threads, longRead_outdir,
-                              racon2_polish)
-        sam_file2 = '{0}/longRead_polish_results/align_{1}.sam'.format(outdir, racon2_polish)
-        make_racon_longRead_command(args.racon_path, long_reads, sam_file2, circlator_outfile, outdir, sample_name,
-                                    threads, racon2_polish)
-        os.system('rm -r %s' % sam_file2)
-        print("Perform long read polishes with Medaka")
-        medaka_input = "{0}/longRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon2_polish)
-        make_medaka_command(args.medaka_path, long_reads, medaka_input, outdir, threads)
-        print("Executing shortRead polishes with Racon")
-        infile4 = "{0}/medaka_results/consensus.fasta".format(outdir)
-        shortRead_polish_outdir = "{0}/shortRead_polish_results".format(outdir)
-        create_directory(shortRead_polish_outdir)
-        racon3_polish = 3
-        make_bwa_command(args.bwa_path, infile4, pe_reads, shortRead_polish_outdir, threads, racon3_polish)
-        print("Executing Racon for third round of polishing")
-        sam_file3 = "{0}/shortRead_polish_results/align_{1}.sam".format(outdir, racon3_polish)
-        make_racon_shortRead_command(args.racon_path, pe_reads, sam_file3, infile4, outdir, sample_name,
-                                     threads, racon3_polish)
-        os.system('rm -r %s' % sam_file3)
-        infile5 = "{0}/shortRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon3_polish)
-        print("Executing circulating fixstart to rotate #2 and orient properly")
-        circlator_outfile_prefix2 = "{0}/shortRead_polish_results/{1}_circlator2".format(outdir, sample_name)
-        circlator_outfile2 = "{0}/shortRead_polish_results/{1}_circlator2.fasta".format(outdir, sample_name)
-        if args.dnaA_file is None:
-            make_circlator_fixstart_command(args.circlator_path, default_db, infile5, circlator_outfile_prefix2)
-        else:
-            make_circlator_fixstart_command(args.circlator_path, args.dnaA_file, infile5, circlator_outfile_prefix2)
-        print("Executing Racon for fourth round of polishing")
-        racon4_polish = 4
-        make_bwa_command(args.bwa_path, circlator_outfile2, pe_reads, shortRead_polish_outdir, threads, racon4_polish)
-        sam_file4 = "{0}/shortRead_polish_results/align_{1}.sam".format(outdir, racon4_polish)
-        make_racon_shortRead_command(args.racon_path, pe_reads, sam_file4, circlator_outfile2, outdir, sample_name,
-                                     threads, racon4_polish)
-        os.system('rm -r %s' % sam_file4)
-        infile6 = "{0}/shortRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon4_polish)
-        print("Executing fix repeat script for final assembly")
-        subprocess.Popen("sed '/^>/ s/ .*//' -i " + infile6, shell=True).wait()
-        subprocess.Popen('bwa index ' + infile6, shell=True).wait()
-        bam_infile6 = "{0}/shortRead_polish_results/{1}_racon{2}_sort.bam".format(outdir, sample_name, racon4_polish)
-        subprocess.Popen('bwa mem -t ' + threads + ' ' + infile6 + ' ' + pe_reads + \
-                         ' | samtools sort -@ ' + threads + ' > ' + bam_infile6, shell=True).wait()
-        coverage_file = "{0}/shortRead_polish_results/coverage.txt".format(outdir)
-        subprocess.Popen('bedtools genomecov -d -ibam ' + bam_infile6 + ' > ' + coverage_file, shell=True).wait()
-        infile7 = "{0}/shortRead_polish_results/{1}_final.fasta".format(outdir, sample_name)
-        tmp_directory = "{0}/shortRead_polish_results/tmp".format(outdir)
-        os.makedirs(tmp_directory)
-        read_length = 300
-        fix_repeats.correct_regions(infile6, pe_reads, coverage_file, tmp_directory, infile7, read_length, threads)
-        os.system('rm -r %s' % tmp_directory)
+    if args.progress:
+        telemetry.progress.enable()
+    if args.samplesheet is not None:
+        run_batch(args)
         print("Fin! Enjoy your day!")
-    if args.existing_contigs:
-        print("Circularization check with berokka and creating input for long-read initial round of polishing")
-        make_berokka_command(args.berokka_path, args.contigs, args.outdir)
-        infile1 = "{0}/berokka_results/02.trimmed.fa".format(outdir)
-        print("Removing potential self-contained contigs")
-        circlator_clean_outfile_prefix = "{0}/berokka_results/{1}_clean".format(outdir, sample_name)
-        make_circlator_clean_command(args.circlator_path, infile1, circlator_clean_outfile_prefix)
-        infile2 = "{0}/berokka_results/{1}_clean.fasta".format(outdir, sample_name)
-        print("Performing iterative long-read polishes with contig turning using Circlator Fixstart")
-        print("Perform Racon Polish #1")
-        longRead_outdir = '{0}/longRead_polish_results'.format(outdir)
-        create_directory(longRead_outdir)
-        racon1_polish = 1
-        make_minimap2_command(args.minimap2_path, infile2, long_reads, threads, longRead_outdir, racon1_polish)
-        sam_file1 = '{0}/longRead_polish_results/align_{1}.sam'.format(outdir, racon1_polish)
-        make_racon_longRead_command(args.racon_path, long_reads, sam_file1, infile2, outdir, sample_name, threads,
-                                    racon1_polish)
-        infile3 = "{0}/longRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon1_polish)
-        os.system('rm -r %s' % sam_file1)
-        print("Executing Circlator Fixstart to obtain start position(s)")
-        circlator_outfile_prefix = "{0}/longRead_polish_results/{1}_circlator".format(outdir, sample_name)
-        circlator_outfile = "{0}/longRead_polish_results/{1}_circlator.fasta".format(outdir, sample_name)
-        if args.dnaA_file is None:
-            make_circlator_fixstart_command(args.circlator_path, default_db, infile3, circlator_outfile_prefix)
-        else:
-            make_circlator_fixstart_command(args.circlator_path, args.dnaA_file, infile3, circlator_outfile_prefix)
-        print("Perform Racon Polish #2")
-        racon2_polish = 2
-        make_minimap2_command(args.minimap2_path, circlator_outfile, long_reads, threads, longRead_outdir,
-                              racon2_polish)
-        sam_file2 = '{0}/longRead_polish_results/align_{1}.sam'.format(outdir, racon2_polish)
-        make_racon_longRead_command(args.racon_path, long_reads, sam_file2, circlator_outfile, outdir, sample_name,
-                                    threads, racon2_polish)
-        os.system('rm -r %s' % sam_file2)
-        print("Perform long read polishes with Medaka")
-        medaka_input = "{0}/longRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon2_polish)
-        make_medaka_command(args.medaka_path, long_reads, medaka_input, outdir, threads)
-        print("Executing shortRead polishes with Racon")
-        infile4 = "{0}/medaka_results/consensus.fasta".format(outdir)
-        shortRead_polish_outdir = "{0}/shortRead_polish_results".format(outdir)
-        create_directory(shortRead_polish_outdir)
-        racon3_polish = 3
-        make_bwa_command(args.bwa_path, infile4, pe_reads, shortRead_polish_outdir, threads, racon3_polish)
-        print("Executing Racon for third round of polishing")
-        sam_file3 = "{0}/shortRead_polish_results/align_{1}.sam".format(outdir, racon3_polish)
-        make_racon_shortRead_command(args.racon_path, pe_reads, sam_file3, infile4, outdir, sample_name,
-                                     threads, racon3_polish)
-        os.system('rm -r %s' % sam_file3)
-        infile5 = "{0}/shortRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon3_polish)
-        print("Executing circulating fixstart to rotate #2 and orient properly")
-        circlator_outfile_prefix2 = "{0}/shortRead_polish_results/{1}_circlator2".format(outdir, sample_name)
-        circlator_outfile2 = "{0}/shortRead_polish_results/{1}_circlator2.fasta".format(outdir, sample_name)
-        if args.dnaA_file is None:
-            make_circlator_fixstart_command(args.circlator_path, default_db, infile5, circlator_outfile_prefix2)
-        else:
-            make_circlator_fixstart_command(args.circlator_path, args.dnaA_file, infile5, circlator_outfile_prefix2)
-        print("Executing Racon for fourth round of polishing")
-        racon4_polish = 4
-        make_bwa_command(args.bwa_path, circlator_outfile2, pe_reads, shortRead_polish_outdir, threads, racon4_polish)
-        sam_file4 = "{0}/shortRead_polish_results/align_{1}.sam".format(outdir, racon4_polish)
-        make_racon_shortRead_command(args.racon_path, pe_reads, sam_file4, circlator_outfile2, outdir, sample_name,
-                                     threads, racon4_polish)
-        os.system('rm -r %s' % sam_file4)
-        infile6 = "{0}/shortRead_polish_results/{1}_racon{2}.fasta".format(outdir, sample_name, racon4_polish)
-        print("Executing fix repeat script for final assembly")
-        subprocess.Popen("sed '/^>/ s/ .*//' -i " + infile6, shell=True).wait()
-        subprocess.Popen('bwa index ' + infile6, shell=True).wait()
-        bam_infile6 = "{0}/shortRead_polish_results/{1}_racon{2}_sort.bam".format(outdir, sample_name, racon4_polish)
-        subprocess.Popen('bwa mem -t ' + threads + ' ' + infile6 + ' ' + pe_reads + \
-                         ' | samtools sort -@ ' + threads + ' > ' + bam_infile6, shell=True).wait()
-        coverage_file = "{0}/shortRead_polish_results/coverage.txt".format(outdir)
-        subprocess.Popen('bedtools genomecov -d -ibam ' + bam_infile6 + ' > ' + coverage_file, shell=True).wait()
-        infile7 = "{0}/shortRead_polish_results/{1}_final.fasta".format(outdir, sample_name)
-        tmp_directory = "{0}/shortRead_polish_results/tmp".format(outdir)
-        os.makedirs(tmp_directory)
-        read_length = 300
-        fix_repeats.correct_regions(infile6, pe_reads, coverage_file, tmp_directory, infile7, read_length, threads)
-        os.system('rm -r %s' % tmp_directory)
+        return
+    try:
+        run_sample(args)
+    except (executor.ToolError, ReadQCError) as e:
+        sys.exit("Sample {0} failed: {1}".format(args.sample_name, e))
+    if not args.list_stages:
         print("Fin! Enjoy your day!")
 
 if __name__ == '__main__': run_conditions()
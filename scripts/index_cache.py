@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+
+import telemetry
+
+"""Content-addressed cache of bwa, minimap2 and samtools faidx indices"""
+# Each reference FASTA is keyed on the SHA-256 of its content. The first request for an index copies the FASTA into
+# <cache_dir>/<hash>/ref.fa and builds the index next to it; later requests for any file with the same content (the
+# same assembly in another stage, a reused '--existing_contigs' reference, a rerun of the same sample, or an identical
+# region in fix_repeats) return the cached paths without re-indexing. Callers use the cached ref.fa as the reference
+# given to the aligner. The cache is kept under a size limit by evicting the least recently used entries.
+
+# Entries used more recently than this are never evicted, as a running stage may still be reading them.
+EVICTION_GRACE_SECONDS = 3600
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class IndexCache(object):
+    def __init__(self, cache_dir, max_size_gb=20.0):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry(self, fasta):
+        """Return the cache directory for 'fasta', creating it with a copy of the FASTA if needed"""
+        key = sha256_file(fasta)
+        entry_dir = os.path.join(self.cache_dir, key)
+        reference = os.path.join(entry_dir, 'ref.fa')
+        with self.lock(key):
+            if not os.path.isfile(reference):
+                os.makedirs(entry_dir, exist_ok=True)
+                shutil.copyfile(fasta, reference + '.tmp')
+                os.replace(reference + '.tmp', reference)
+        return key, entry_dir, reference
+
+    def lock(self, key):
+        return FileLock(os.path.join(self.cache_dir, key + '.lock'))
+
+    def build(self, fasta, marker, build_cmd):
+        """Run 'build_cmd(reference)' once per reference content; returns the cached reference path"""
+        key, entry_dir, reference = self.entry(fasta)
+        done = os.path.join(entry_dir, marker)
+        with self.lock(key):
+            if os.path.isfile(done):
+                print("Re-using cached {0} index for {1}".format(marker.lstrip('.').split('_')[0], fasta))
+            else:
+                telemetry.run(build_cmd(reference))
+                open(done, 'w').close()
+        self.touch(entry_dir)
+        self.evict(keep=key)
+        return reference
+
+    def bwa_index(self, bwa_path, fasta):
+        """Return a bwa index prefix for the content of 'fasta'"""
+        return self.build(fasta, '.bwa_done', lambda reference: [bwa_path, 'index', reference])
+
+    def minimap2_index(self, minimap2_path, fasta, preset='map-ont'):
+        """Return the path of a minimap2 .mmi index for the content of 'fasta'"""
+        reference = self.build(fasta, '.mmi_{0}_done'.format(preset),
+                               lambda reference: [minimap2_path, '-x', preset, '-d',
+                                                  '{0}.{1}.mmi'.format(reference, preset), reference])
+        return '{0}.{1}.mmi'.format(reference, preset)
+
+    def faidx(self, samtools_path, fasta):
+        """Return a FASTA path with the content of 'fasta' that has a .fai index next to it"""
+        return self.build(fasta, '.fai_done', lambda reference: [samtools_path, 'faidx', reference])
+
+    def touch(self, entry_dir):
+        with open(os.path.join(entry_dir, '.last_used'), 'w') as stamp:
+            stamp.write(str(time.time()))
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in its size limit"""
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(entry_dir):
+                continue
+            stamp = os.path.join(entry_dir, '.last_used')
+            last_used = os.path.getmtime(stamp) if os.path.exists(stamp) else 0
+            size = directory_size(entry_dir)
+            total += size
+            entries.append((last_used, key, entry_dir, size))
+        now = time.time()
+        for last_used, key, entry_dir, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep or now - last_used < EVICTION_GRACE_SECONDS:
+                continue
+            with self.lock(key):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            print("Evicted cached index {0} ({1:.1f} MB)".format(key[:12], size / 1024.0 ** 2))
+
+
+# FileLock() serialises index builds of the same reference between processes and threads.
+class FileLock(object):
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a')
+        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+        return False
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import shutil
+import subprocess
+
+import telemetry
+from fasta_io import open_binary
+from read_qc import pair_key
+from realign import read_name
+
+"""Streaming interleaving of paired-end reads"""
+# '--pe_reads R1 R2' replaces the 'reformat.sh ... underscore=t' pre-processing step. The 'interleave' stage streams
+# both files record by record, each through its own 'pigz -dc' process when the input is gzipped (so decompression of
+# R1 and R2 runs in parallel, off the Python thread), checks that the mates are in step, and writes read 1 followed by
+# read 2 with whitespace in the headers replaced by underscores, as racon needs. Mates that would still share the name
+# the aligners report (which drop a trailing /1 or /2) are renamed to 'name_1' and 'name_2'. The result is a single
+# gzipped FASTQ (compressed at level 1 by pigz when it is installed) in the sample's scratch directory, written once and
+# read by read QC, every bwa alignment, both short-read racon rounds and correct_regions(); bwa and racon read gzipped
+# FASTQ as they are. A named pipe would have to be re-created for each of these readers, so the reads would be
+# decompressed and interleaved again for every one.
+
+
+# open_reads() returns a binary stream of the decompressed reads and the pigz process behind it (or None).
+def open_reads(path, threads=1):
+    stream = open_binary(path)
+    if shutil.which('pigz') is None or not isinstance(stream, gzip.GzipFile):
+        return stream, None
+    stream.close()
+    process = telemetry.Popen(['pigz', '-dc', '-p', str(threads), path], stdout=subprocess.PIPE)
+    return process.stdout, process
+
+
+# compress_to() returns a binary stream that writes gzipped data to 'path' and the pigz process behind it (or None).
+def compress_to(path, threads=1):
+    if shutil.which('pigz') is None:
+        return gzip.open(path, 'wb', compresslevel=1), None
+    with open(path, 'wb') as out:
+        process = telemetry.Popen(['pigz', '-c', '-1', '-p', str(threads)], stdin=subprocess.PIPE, stdout=out)
+    return process.stdin, process
+
+
+def fastq_records(stream, path):
+    while True:
+        record = [stream.readline() for _ in range(4)]
+        if not record[0]:
+            return
+        if not record[0].startswith(b'@') or not record[2].startswith(b'+') or not record[3]:
+            raise Exception("Malformed FASTQ record '{0}' in {1}".format(record[0].rstrip().decode('utf-8', 'replace'),
+                                                                          path))
+        yield record
+
+
+def normalise_header(header):
+    """The header with each run of whitespace replaced by one underscore"""
+    return b'@' + b'_'.join(header[1:].split()) + b'\n'
+
+
+# interleave_pairs() yields the mates of 'r1' and 'r2' as interleaved FASTQ records with normalised headers.
+def interleave_pairs(r1_stream, r2_stream, r1, r2):
+    records_2 = fastq_records(r2_stream, r2)
+    pairs = 0
+    for record_1 in fastq_records(r1_stream, r1):
+        record_2 = next(records_2, None)
+        if record_2 is None:
+            raise Exception("{0} has more reads than {1}".format(r1, r2))
+        pairs += 1
+        if pair_key(record_1[0])[0] != pair_key(record_2[0])[0]:
+            raise Exception("Read pair {0} does not match: '{1}' in {2}, '{3}' in {4}".format(
+                pairs, record_1[0].rstrip().decode('utf-8', 'replace'), r1,
+                record_2[0].rstrip().decode('utf-8', 'replace'), r2))
+        header_1 = normalise_header(record_1[0])
+        header_2 = normalise_header(record_2[0])
+        if read_name(header_1) == read_name(header_2):
+            header_1 = b'@' + read_name(header_1) + b'_1\n'
+            header_2 = b'@' + read_name(header_2) + b'_2\n'
+        yield header_1 + b''.join(record_1[1:])
+        yield header_2 + b''.join(record_2[1:])
+    if next(records_2, None) is not None:
+        raise Exception("{0} has more reads than {1}".format(r2, r1))
+
+
+# interleave_reads() writes the interleaved reads of 'r1' and 'r2', gzipped, to 'out_path'. Returns the number of pairs.
+def interleave_reads(r1, r2, out_path, threads=1):
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    decompress_threads = max(1, int(threads) // 2)
+    r1_stream, r1_process = open_reads(r1, decompress_threads)
+    r2_stream, r2_process = open_reads(r2, decompress_threads)
+    out, out_process = compress_to(out_path + '.tmp', threads)
+    records = 0
+    try:
+        for record in interleave_pairs(r1_stream, r2_stream, r1, r2):
+            out.write(record)
+            records += 1
+    finally:
+        out.close()
+        r1_stream.close()
+        r2_stream.close()
+        for process in (r1_process, r2_process, out_process):
+            if process is not None:
+                process.wait()
+    os.replace(out_path + '.tmp', out_path)
+    print("Interleaved {0} read pairs into {1}".format(records // 2, out_path))
+    return records // 2
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+
+import telemetry
+import resources
+from fasta_io import read_fasta, write_fasta
+
+"""Cross-sample medaka batching"""
+# medaka_consensus loads its model and starts TensorFlow once per sample; on CPU-only nodes that fixed cost dominates
+# the polishing of small genomes. With '--medaka_batch N' in --samplesheet mode, the scheduler holds each sample's
+# medaka stage back until N samples (or every sample still to get there) are ready and runs them with one call of
+# run_medaka_batch():
+# 1. each sample's reads are aligned to its own draft with mini_align, its contigs renamed '<sample>|<contig>' so that
+#    names are unique within the batch;
+# 2. the alignments are merged and 'medaka consensus' runs once over all of them, loading the model once, with
+#    '--medaka_batch_size' as its inference batch size;
+# 3. 'medaka stitch' builds the consensus of the combined draft, which is split back into each sample's
+#    medaka_results/consensus.fasta under the original contig names.
+# The alignments are recorded under each sample's medaka stage. The shared steps are recorded in
+# outdir/medaka_batches/<batch>/run_metrics.json, and their CPU time is added to the samples' medaka stages in
+# proportion to draft length. mini_align and medaka are taken from the directory of --medaka_path; 'medaka stitch'
+# with a draft needs medaka >= 1.1.
+
+BATCH_DIR = "medaka_batches"
+SEPARATOR = "|"
+
+
+# MedakaJob() is one sample's part of a batched medaka stage: its draft and long reads, and where the consensus goes.
+class MedakaJob(object):
+    def __init__(self, sample_name, outdir, batch_outdir, draft, reads, consensus, medaka_path, model, batch_size,
+                 stage_name='medaka'):
+        self.sample_name = sample_name
+        self.outdir = outdir
+        self.batch_outdir = batch_outdir
+        self.draft = draft
+        self.reads = reads
+        self.consensus = consensus
+        self.medaka_path = medaka_path
+        self.model = model
+        self.batch_size = batch_size
+        self.stage_name = stage_name
+
+
+def medaka_tool(medaka_path, tool):
+    """Path of another medaka executable ('medaka', 'mini_align') installed next to medaka_consensus"""
+    return os.path.join(os.path.dirname(medaka_path), tool)
+
+
+# split_consensus() writes each job's part of the stitched consensus under its original contig names. Contigs that
+# medaka left out (no reads aligned to them) are copied from the draft.
+def split_consensus(consensus, names, jobs):
+    records = dict((job.sample_name, []) for job in jobs)
+    polished = set()
+    for name, seq in read_fasta(consensus):
+        base = name if name in names else name.split('_segment')[0]
+        job, contig = names[base]
+        records[job.sample_name].append((contig + name[len(base):], seq))
+        polished.add(base)
+    for job in jobs:
+        for name, seq in read_fasta(job.draft):
+            if "{0}{1}{2}".format(job.sample_name, SEPARATOR, name) not in polished:
+                print("[{0}] No medaka consensus for {1}; keeping the draft sequence".format(job.sample_name, name))
+                records[job.sample_name].append((name, seq))
+        os.makedirs(os.path.dirname(job.consensus), exist_ok=True)
+        write_fasta(records[job.sample_name], job.consensus)
+
+
+# run_medaka_batch() polishes the drafts of 'jobs' with a single medaka consensus run (see above).
+def run_medaka_batch(jobs, threads, timeout=None):
+    first = jobs[0]
+    work_dir = os.path.join(first.batch_outdir, BATCH_DIR, "{0}_{1}".format(first.sample_name, len(jobs)))
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    medaka = medaka_tool(first.medaka_path, 'medaka')
+    names = {}
+    combined = []
+    alignments = []
+    shares = []
+    for job in jobs:
+        records = [("{0}{1}{2}".format(job.sample_name, SEPARATOR, name), seq) for name, seq in read_fasta(job.draft)]
+        names.update((batch_name, (job, batch_name[len(job.sample_name) + 1:])) for batch_name, seq in records)
+        combined.extend(records)
+        draft = os.path.join(work_dir, "{0}_draft.fasta".format(job.sample_name))
+        write_fasta(records, draft)
+        prefix = os.path.join(work_dir, "{0}_calls_to_draft".format(job.sample_name))
+        with telemetry.stage_context(job.outdir, job.stage_name, job.sample_name, timeout):
+            # as with medaka_consensus, start from an empty output directory
+            shutil.rmtree(os.path.dirname(job.consensus), ignore_errors=True)
+            telemetry.run([medaka_tool(job.medaka_path, 'mini_align'), '-i', job.reads, '-r', draft, '-m', '-p', prefix,
+                           '-t', threads])
+        alignments.append(prefix + '.bam')
+        shares.append((job.outdir, job.stage_name, sum(len(seq) for name, seq in records)))
+    draft = os.path.join(work_dir, 'draft.fasta')
+    write_fasta(combined, draft)
+    merged = os.path.join(work_dir, 'calls_to_draft.bam')
+    probabilities = os.path.join(work_dir, 'consensus_probs.hdf')
+    consensus = os.path.join(work_dir, 'consensus.fasta')
+    print("Running one medaka consensus for {0} samples: {1}".format(len(jobs), ', '.join(j.sample_name for j in jobs)))
+    with telemetry.stage_context(work_dir, 'medaka_batch', 'medaka batch', timeout):
+        telemetry.run(['samtools', 'merge', '-f', '-@', threads, merged] + alignments)
+        telemetry.run(['samtools', 'index', merged])
+        telemetry.run([medaka, 'consensus', merged, probabilities, '--model', first.model, '--batch_size',
+                       str(first.batch_size), '--threads', resources.tool_threads('medaka', threads)])
+        telemetry.run([medaka, 'stitch', probabilities, draft, consensus])
+    telemetry.share_stage(work_dir, 'medaka_batch', shares)
+    split_consensus(consensus, names, jobs)
+    for path in alignments + [merged, merged + '.bai', probabilities]:
+        if os.path.exists(path):
+            os.remove(path)
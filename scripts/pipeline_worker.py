@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+import os
+import json
+import glob
+import time
+import socket
+import argparse
+import traceback
+import concurrent.futures
+
+import telemetry
+import executor
+import flye_pipeline
+from start_genes import load_index
+
+"""Long-running pipeline worker with a local job spool"""
+# 'serve' keeps one process running that takes job manifests from a spool directory and runs them, at most
+# '--max_jobs' at a time, through the same code as a command-line run of flye_pipeline.py. What a fresh process would
+# rebuild for every sample stays warm between jobs: tool version probes, the start-gene k-mer index and the
+# bwa/minimap2/faidx index cache (spool/index_cache, unless a job names its own). 'submit' checks a job's pipeline
+# arguments and queues it; 'status' prints the queue depth, running jobs and the throughput of recent jobs.
+#
+# Spool layout:
+#   queue/<job_id>.json        submitted jobs, oldest first; a worker claims one by renaming it into jobs/, so several
+#                              workers can share a spool
+#   jobs/<job_id>/job.json     the job's pipeline arguments and the directory they were given in
+#   jobs/<job_id>/status.json  state (running, done or failed), times, error and a summary of its run metrics
+#   jobs/<job_id>/error.txt    traceback of a failed job
+#   workers/<host>_<pid>.json  heartbeat of each worker
+
+QUEUE_DIR = "queue"
+JOBS_DIR = "jobs"
+WORKERS_DIR = "workers"
+# Pipeline options holding paths, made absolute against the submitter's working directory.
+PATH_OPTIONS = ('outdir', 'long_reads', 'pe_reads', 'pe_reads_2', 'contigs', 'samplesheet', 'dnaA_file', 'scratch',
+                'index_cache')
+
+
+def write_json(path, data):
+    with open(path + '.tmp', 'w') as handle:
+        json.dump(data, handle, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def read_json(path):
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def make_spool(spool):
+    for name in (QUEUE_DIR, JOBS_DIR, WORKERS_DIR):
+        os.makedirs(os.path.join(spool, name), exist_ok=True)
+
+
+# pipeline_arguments() parses a job's flye_pipeline.py arguments, with relative paths resolved against 'cwd'.
+def pipeline_arguments(argv, cwd):
+    args = flye_pipeline.get_arguments(argv)
+    for option in PATH_OPTIONS:
+        value = getattr(args, option, None)
+        if value is not None and not os.path.isabs(value):
+            setattr(args, option, os.path.join(cwd, value))
+    if args.samplesheet is None and (args.long_reads is None or args.pe_reads is None):
+        raise Exception("--long_reads and --pe_reads are required unless --samplesheet is given")
+    return args
+
+
+def submit(spool, argv, job_id=None):
+    """Queue a run of flye_pipeline.py with arguments 'argv'; returns the job id"""
+    make_spool(spool)
+    args = pipeline_arguments(argv, os.getcwd())
+    if job_id is None:
+        name = args.sample_name if args.samplesheet is None else \
+            os.path.splitext(os.path.basename(args.samplesheet))[0]
+        job_id = "{0}_{1}_{2}".format(name, time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    if os.path.exists(os.path.join(spool, JOBS_DIR, job_id)) or \
+            os.path.exists(os.path.join(spool, QUEUE_DIR, job_id + '.json')):
+        raise Exception("Job {0} already exists in {1}".format(job_id, spool))
+    write_json(os.path.join(spool, QUEUE_DIR, job_id + '.json'),
+               {'job_id': job_id, 'args': argv, 'cwd': os.getcwd(), 'submitted': time.time()})
+    return job_id
+
+
+def queued_jobs(spool):
+    paths = glob.glob(os.path.join(spool, QUEUE_DIR, '*.json'))
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+
+# claim_next() moves the oldest queued job into jobs/ and returns its id, or None if the queue is empty.
+def claim_next(spool):
+    for path in queued_jobs(spool):
+        job_id = os.path.basename(path)[:-len('.json')]
+        job_dir = os.path.join(spool, JOBS_DIR, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        try:
+            os.rename(path, os.path.join(job_dir, 'job.json'))
+        except FileNotFoundError:
+            continue
+        return job_id
+    return None
+
+
+# metrics_summary() adds up the run metrics of a job's sample(s).
+def metrics_summary(outdir):
+    paths = [os.path.join(outdir, telemetry.METRICS_JSON)] + \
+        glob.glob(os.path.join(outdir, '*', telemetry.METRICS_JSON))
+    summary = {'samples': 0, 'tool_cpu_seconds': 0.0, 'python_cpu_seconds': 0.0, 'max_rss_mb': 0}
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        stages = read_json(path).get('stages', {})
+        summary['samples'] += 1
+        for stage in stages.values():
+            summary['tool_cpu_seconds'] += stage['tool_cpu_seconds']
+            summary['python_cpu_seconds'] += stage['python_cpu_seconds']
+            summary['max_rss_mb'] = max(summary['max_rss_mb'], stage['max_rss_mb'])
+    summary['tool_cpu_seconds'] = round(summary['tool_cpu_seconds'], 2)
+    summary['python_cpu_seconds'] = round(summary['python_cpu_seconds'], 2)
+    return summary
+
+
+# run_job() runs one claimed job and keeps its status.json up to date. Returns True if the job succeeded.
+def run_job(spool, job_id, worker_name, index_cache):
+    job_dir = os.path.join(spool, JOBS_DIR, job_id)
+    manifest = read_json(os.path.join(job_dir, 'job.json'))
+    status_path = os.path.join(job_dir, 'status.json')
+    status = {'job_id': job_id, 'state': 'running', 'submitted': manifest['submitted'], 'started': time.time(),
+              'worker': worker_name}
+    write_json(status_path, status)
+    outdir = None
+    try:
+        args = pipeline_arguments(manifest['args'], manifest['cwd'])
+        outdir = os.path.abspath(args.outdir)
+        status['outdir'] = outdir
+        if args.index_cache is None and not args.no_index_cache:
+            args.index_cache = index_cache
+        # a re-submitted sample starts from a clean slate in this process
+        executor.supervisor().clear(outdir)
+        telemetry.release(outdir)
+        print("[{0}] Starting job".format(job_id))
+        if args.samplesheet is not None:
+            flye_pipeline.run_batch(args)
+        else:
+            flye_pipeline.run_sample(args)
+        status['state'] = 'done'
+    except SystemExit as e:
+        status['state'] = 'failed'
+        status['error'] = "invalid pipeline arguments (exit status {0})".format(e.code)
+    except Exception as e:
+        status['state'] = 'failed'
+        status['error'] = str(e)
+        with open(os.path.join(job_dir, 'error.txt'), 'w') as handle:
+            handle.write(traceback.format_exc())
+    finally:
+        status['finished'] = time.time()
+        status['wall_seconds'] = round(status['finished'] - status['started'], 2)
+        if outdir is not None:
+            status['metrics'] = metrics_summary(outdir)
+            telemetry.release(outdir)
+        write_json(status_path, status)
+    print("[{0}] Job {1} after {2:.0f} s".format(job_id, status['state'], status['wall_seconds']))
+    return status['state'] == 'done'
+
+
+# serve() runs queued jobs until interrupted, or until the queue is empty with 'exit_when_idle'.
+def serve(spool, max_jobs, poll_interval, index_cache=None, exit_when_idle=False):
+    make_spool(spool)
+    spool = os.path.abspath(spool)
+    index_cache = os.path.abspath(index_cache or os.path.join(spool, 'index_cache'))
+    worker_name = "{0}_{1}".format(socket.gethostname(), os.getpid())
+    heartbeat = os.path.join(spool, WORKERS_DIR, worker_name + '.json')
+    start_db = flye_pipeline.start_gene_file()
+    if os.path.isfile(start_db):
+        load_index(start_db, spool)
+    else:
+        print("No default start-site database at {0} to warm; jobs index their '--dnaA_file' on first use".format(
+            os.path.normpath(start_db)))
+    counts = {'done': 0, 'failed': 0}
+    started = time.time()
+    running = {}
+    stopping = False
+    print("Worker {0} serving {1} with up to {2} job(s) at a time".format(worker_name, spool, max_jobs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as pool:
+        try:
+            while True:
+                for future in [future for future in running if future.done()]:
+                    counts['done' if future.result() else 'failed'] += 1
+                    del running[future]
+                while not stopping and len(running) < max_jobs:
+                    job_id = claim_next(spool)
+                    if job_id is None:
+                        break
+                    running[pool.submit(run_job, spool, job_id, worker_name, index_cache)] = job_id
+                write_json(heartbeat, {'worker': worker_name, 'pid': os.getpid(), 'started': started,
+                                       'heartbeat': time.time(), 'max_jobs': max_jobs,
+                                       'running': sorted(running.values()), 'done': counts['done'],
+                                       'failed': counts['failed']})
+                if not running and (stopping or (exit_when_idle and not queued_jobs(spool))):
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("Stopping: waiting for {0} running job(s); queued jobs are left for the next worker".format(
+                len(running)))
+            stopping = True
+            concurrent.futures.wait(list(running))
+        finally:
+            if os.path.isfile(heartbeat):
+                os.remove(heartbeat)
+    print("Worker {0} finished {1} job(s), {2} failed".format(worker_name, counts['done'] + counts['failed'],
+                                                             counts['failed']))
+    return counts
+
+
+def job_statuses(spool):
+    statuses = []
+    for path in glob.glob(os.path.join(spool, JOBS_DIR, '*', 'status.json')):
+        try:
+            statuses.append(read_json(path))
+        except ValueError:
+            continue
+    return statuses
+
+
+# status_report() returns the lines printed by 'status': queue depth, workers, running jobs and, over the last
+# 'window' hours, finished jobs, failures and throughput in samples per hour.
+def status_report(spool, window=24.0, recent=10):
+    now = time.time()
+    lines = ["Queue: {0} job(s) waiting".format(len(queued_jobs(spool)))]
+    for path in sorted(glob.glob(os.path.join(spool, WORKERS_DIR, '*.json'))):
+        worker = read_json(path)
+        lines.append("Worker {0}: {1}/{2} job(s) running, {3} done, {4} failed, last seen {5:.0f} s ago".format(
+            worker['worker'], len(worker['running']), worker['max_jobs'], worker['done'], worker['failed'],
+            now - worker['heartbeat']))
+    statuses = job_statuses(spool)
+    for status in sorted([s for s in statuses if s['state'] == 'running'], key=lambda s: s['started']):
+        lines.append("Running {0}: {1:.0f} s".format(status['job_id'], now - status['started']))
+    finished = [s for s in statuses if s['state'] != 'running' and s['finished'] >= now - window * 3600]
+    done = [s for s in finished if s['state'] == 'done']
+    if finished:
+        span_hours = max(now - min(s['started'] for s in finished), 1.0) / 3600
+        samples = sum(s.get('metrics', {}).get('samples', 1) for s in done)
+        lines.append("Last {0:g} h: {1} job(s) done, {2} failed, {3} sample(s) at {4:.2f} samples/hour, mean wall "
+                     "time {5:.0f} s".format(window, len(done), len(finished) - len(done), samples,
+                                             samples / min(span_hours, window),
+                                             sum(s['wall_seconds'] for s in finished) / len(finished)))
+    for status in sorted(statuses, key=lambda s: -s['started'])[:recent]:
+        lines.append("  {0:<40} {1:<8} {2}  {3}".format(
+            status['job_id'], status['state'], time.strftime('%Y-%m-%d %H:%M', time.localtime(status['started'])),
+            status.get('error', '').splitlines()[0] if status.get('error') else ''))
+    return lines
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Run flye_pipeline.py jobs from a local spool directory")
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser('serve', help="Run queued jobs until interrupted")
+    serve_parser.add_argument('--spool', required=True, type=str, help="Spool directory")
+    serve_parser.add_argument('--max_jobs', required=False, type=int, default=1,
+                              help="Number of jobs run at once; each uses the -t threads it was submitted with")
+    serve_parser.add_argument('--poll_interval', required=False, type=float, default=5.0,
+                              help="Seconds between looks at the queue")
+    serve_parser.add_argument('--index_cache', required=False, type=str, default=None,
+                              help="Index cache shared by all jobs that do not name their own (default: "
+                              "spool/index_cache)")
+    serve_parser.add_argument('--exit_when_idle', required=False, action='store_true', default=False,
+                              help="Exit once the queue is empty and no job is running")
+    submit_parser = commands.add_parser('submit', help="Queue a job; arguments after '--' go to flye_pipeline.py")
+    submit_parser.add_argument('--spool', required=True, type=str, help="Spool directory")
+    submit_parser.add_argument('--job_id', required=False, type=str, default=None,
+                               help="Job name (default: sample name, time and process id)")
+    submit_parser.add_argument('pipeline_args', nargs=argparse.REMAINDER, help="flye_pipeline.py arguments")
+    status_parser = commands.add_parser('status', help="Show queue depth, running jobs and throughput")
+    status_parser.add_argument('--spool', required=True, type=str, help="Spool directory")
+    status_parser.add_argument('--job_id', required=False, type=str, default=None,
+                               help="Print the full status of one job")
+    status_parser.add_argument('--window', required=False, type=float, default=24.0,
+                               help="Hours of finished jobs to summarise")
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("choose one of serve, submit or status")
+    return args
+
+
+def main():
+    args = get_arguments()
+    if args.command == 'serve':
+        serve(args.spool, args.max_jobs, args.poll_interval, args.index_cache, args.exit_when_idle)
+    elif args.command == 'submit':
+        pipeline_args = args.pipeline_args[1:] if args.pipeline_args[:1] == ['--'] else args.pipeline_args
+        print(submit(args.spool, pipeline_args, args.job_id))
+    elif args.job_id is not None:
+        print(json.dumps(read_json(os.path.join(args.spool, JOBS_DIR, args.job_id, 'status.json')), indent=2,
+                         sort_keys=True))
+    else:
+        print("\n".join(status_report(args.spool, args.window)))
+
+
+if __name__ == '__main__':
+    main()
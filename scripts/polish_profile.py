@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os
+import json
+
+import telemetry
+from fasta_io import read_fasta
+from seq_diff import EditCounts, diff_sequences
+from realign import contig_map, reverse_complement
+
+"""Polishing impact profiler"""
+# The 'polish_profile' stage, run last, shows which polishing stages earn their compute. For each stage from racon1 to
+# fix_repeats it compares the assembly the stage read with the one it wrote, contig by contig, and counts the
+# substitutions, insertions and deletions the stage made (seq_diff). A contig that fixstart rotated or reverse
+# complemented is first turned to its new orientation (realign.contig_map), so a rotation by itself is not counted as
+# edits. The counts are joined with each stage's CPU time from run_metrics.json (tool plus in-process CPU, including
+# that of the per_contig_polish process pool workers) into edits per CPU-hour, written to outdir/polish_profile.json
+# and polish_profile.tsv. In --samplesheet mode the samples' profiles are added up per stage in
+# outdir/polish_profile_batch.tsv.
+
+PROFILE_JSON = "polish_profile.json"
+PROFILE_TSV = "polish_profile.tsv"
+BATCH_TSV = "polish_profile_batch.tsv"
+TSV_COLUMNS = ('stage', 'contig', 'substitutions', 'insertions', 'deletions', 'total', 'rotated', 'cpu_seconds',
+               'wall_seconds', 'edits_per_cpu_hour')
+
+
+def edits_per_cpu_hour(edits, cpu_seconds):
+    return round(edits / (cpu_seconds / 3600.0), 1) if cpu_seconds else None
+
+
+# oriented_diff() counts the edits turning contig 'old' into 'new' once 'old' is rotated and oriented like 'new'.
+# Returns (EditCounts, whether 'old' was rotated or reverse complemented).
+def oriented_diff(old, new):
+    mapping = contig_map(old, new)
+    if mapping is None or (mapping.shift == 0 and not mapping.reverse):
+        return diff_sequences(old, new), False
+    oriented = reverse_complement(old) if mapping.reverse else old
+    return diff_sequences(oriented[mapping.shift:] + oriented[:mapping.shift], new), True
+
+
+# profile_step() compares the input and output assemblies of one stage. Contigs missing from the output are counted as
+# deleted and new contigs as inserted, as in seq_diff.diff_assemblies().
+def profile_step(before, after):
+    new_sequences = dict(read_fasta(after))
+    old_names = set()
+    contigs = {}
+    for name, seq in read_fasta(before):
+        old_names.add(name)
+        if name in new_sequences:
+            edits, rotated = oriented_diff(seq, new_sequences[name])
+        else:
+            edits, rotated = EditCounts(deletions=len(seq)), False
+        contigs[name] = dict(edits.as_dict(), rotated=rotated)
+    for name, seq in new_sequences.items():
+        if name not in old_names:
+            contigs[name] = dict(EditCounts(insertions=len(seq)).as_dict(), rotated=False)
+    return contigs
+
+
+def stage_cost(outdir, stage_name):
+    """(CPU seconds, wall seconds) of a stage from the sample's run_metrics.json, or (None, None) if not recorded"""
+    summary = telemetry.metrics_for(outdir).stages.get(stage_name)
+    if summary is None:
+        return None, None
+    return round(summary['tool_cpu_seconds'] + summary['python_cpu_seconds'], 2), summary['wall_seconds']
+
+
+# run_polish_profile() profiles 'steps', a list of (stage name, input assembly, output assembly) in pipeline order, and
+# writes the report to 'outdir'. Returns the report.
+def run_polish_profile(outdir, steps):
+    profile = []
+    for stage_name, before, after in steps:
+        contigs = profile_step(before, after)
+        total = EditCounts()
+        for counts in contigs.values():
+            total.add(EditCounts(counts['substitutions'], counts['insertions'], counts['deletions']))
+        cpu_seconds, wall_seconds = stage_cost(outdir, stage_name)
+        profile.append({'stage': stage_name, 'input': before, 'output': after, 'edits': total.as_dict(),
+                        'rotated_contigs': len([name for name in contigs if contigs[name]['rotated']]),
+                        'cpu_seconds': cpu_seconds, 'wall_seconds': wall_seconds,
+                        'edits_per_cpu_hour': edits_per_cpu_hour(total.total(), cpu_seconds), 'contigs': contigs})
+    with open(os.path.join(outdir, PROFILE_JSON + '.tmp'), 'w') as handle:
+        json.dump({'stages': profile}, handle, indent=2, sort_keys=True)
+    os.replace(os.path.join(outdir, PROFILE_JSON + '.tmp'), os.path.join(outdir, PROFILE_JSON))
+    rows = []
+    for step in profile:
+        rows.append(dict(step['edits'], stage=step['stage'], contig='*', rotated=step['rotated_contigs'],
+                         cpu_seconds=step['cpu_seconds'], wall_seconds=step['wall_seconds'],
+                         edits_per_cpu_hour=step['edits_per_cpu_hour']))
+        for name in sorted(step['contigs']):
+            rows.append(dict(step['contigs'][name], stage=step['stage'], contig=name,
+                             rotated=int(step['contigs'][name]['rotated'])))
+    write_tsv(rows, os.path.join(outdir, PROFILE_TSV))
+    print("Polishing profile ({0}):".format(os.path.join(outdir, PROFILE_TSV)))
+    for step in profile:
+        print("  {0:<17} {1:>8} edits {2:>10} CPU s {3:>12} edits/CPU-hour".format(
+            step['stage'], step['edits']['total'], format_value(step['cpu_seconds']),
+            format_value(step['edits_per_cpu_hour'])))
+    return profile
+
+
+def format_value(value):
+    return 'NA' if value is None else str(value)
+
+
+def write_tsv(rows, path, columns=TSV_COLUMNS):
+    with open(path, 'w') as tsv:
+        tsv.write('\t'.join(columns) + '\n')
+        for row in rows:
+            tsv.write('\t'.join(format_value(row.get(column)) for column in columns) + '\n')
+
+
+# batch_profile() adds up the per-stage profiles of the samples in 'sample_outdirs' (those that have one) and writes
+# outdir/polish_profile_batch.tsv. Returns the rows.
+def batch_profile(outdir, sample_outdirs):
+    stages = []
+    totals = {}
+    for sample_outdir in sample_outdirs:
+        path = os.path.join(sample_outdir, PROFILE_JSON)
+        if not os.path.isfile(path):
+            continue
+        with open(path) as handle:
+            for step in json.load(handle)['stages']:
+                if step['stage'] not in totals:
+                    stages.append(step['stage'])
+                    totals[step['stage']] = {'stage': step['stage'], 'samples': 0, 'substitutions': 0,
+                                             'insertions': 0, 'deletions': 0, 'total': 0, 'cpu_seconds': 0.0}
+                row = totals[step['stage']]
+                row['samples'] += 1
+                for key in ('substitutions', 'insertions', 'deletions', 'total'):
+                    row[key] += step['edits'][key]
+                row['cpu_seconds'] = round(row['cpu_seconds'] + (step['cpu_seconds'] or 0.0), 2)
+    rows = [totals[stage] for stage in stages]
+    for row in rows:
+        row['edits_per_sample'] = round(row['total'] / float(row['samples']), 1)
+        row['edits_per_cpu_hour'] = edits_per_cpu_hour(row['total'], row['cpu_seconds'])
+    if rows:
+        write_tsv(rows, os.path.join(outdir, BATCH_TSV), ('stage', 'samples', 'substitutions', 'insertions',
+                                                           'deletions', 'total', 'edits_per_sample', 'cpu_seconds',
+                                                           'edits_per_cpu_hour'))
+    return rows
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import math
+
+import executor
+import telemetry
+from fasta_io import open_binary
+
+"""Streaming read QC and parameter selection"""
+# The 'read_qc' stage reads the long and the paired-end reads once each, in parallel worker processes, before anything
+# else runs. For each file it records the number of reads, yield, length distribution (min/mean/max, N50) and mean
+# quality (the Phred score of the mean per-base error probability). The paired-end file is also checked for what racon
+# and bwa rely on: mates must be interleaved (read 1 directly followed by its read 2) and have distinct names up to the
+# first whitespace, which racon reads as the name (so 'name 1:N:0' headers need their space replaced, e.g. by
+# reformat.sh underscore=t). From the statistics it derives the Flye read mode, the long-read racon window and the read
+# length used by fix_repeats.correct_regions(), which the later stages take from the report
+# (outdir/read_qc/<sample>_read_qc.json). Samples with malformed or non-interleaved short reads, or with too little
+# depth or too short long reads, are rejected with ReadQCError before any heavy stage starts.
+
+REPORT_DIR = "read_qc"
+# Mean long-read Phred quality from which Flye is run in --nano-hq mode (Guppy5+ SUP / Q20 chemistry, under ~5% error).
+HQ_QUALITY = 15.0
+# Probability that a base call is wrong, indexed by its FASTQ (Phred+33) quality character.
+PHRED_ERROR = [min(1.0, 10 ** (-(q - 33) / 10.0)) for q in range(256)]
+RACON_WINDOW = 500
+MIN_RACON_WINDOW = 100
+DEFAULT_READ_LENGTH = 300
+# Casava 1.8 mate names, 'name 1:N:0:...', with the space possibly turned into '_' by reformat.sh.
+CASAVA_NAME = re.compile(rb'^(\S+?)[ _]([12]):[YN]:')
+# 'name/1' mate names, possibly followed by a comment joined on with '_' ('name/1_comment').
+SLASH_NAME = re.compile(rb'^(\S+?)/([12])(?:_|$)')
+# 'name_1' and 'name_2', the names interleave.py gives mates that would otherwise share a name.
+UNDERSCORE_NAME = re.compile(rb'^(\S+)_([12])$')
+
+
+class ReadQCError(Exception):
+    pass
+
+
+def report_path(outdir, sample_name):
+    return os.path.join(outdir, REPORT_DIR, "{0}_read_qc.json".format(sample_name))
+
+
+def pair_key(header):
+    """(name, mate number or None) of a FASTQ header line"""
+    fields = header[1:].split(None, 1)
+    name = fields[0] if fields else b''
+    match = SLASH_NAME.match(name)
+    if match is not None:
+        return match.group(1), match.group(2).decode()
+    match = CASAVA_NAME.match(header[1:])
+    if match is None:
+        match = UNDERSCORE_NAME.match(name)
+    if match is not None:
+        return match.group(1), match.group(2).decode()
+    return name, None
+
+
+def expected_errors(quality):
+    """Expected number of wrong base calls in a FASTQ quality string"""
+    return sum(map(PHRED_ERROR.__getitem__, quality))
+
+
+def n50(lengths, total_bases):
+    """N50 from a dict of read length to number of reads"""
+    covered = 0
+    for length in sorted(lengths, reverse=True):
+        covered += length * lengths[length]
+        if 2 * covered >= total_bases:
+            return length
+    return 0
+
+
+# read_stats() streams a (gzipped) FASTQ file and returns its statistics as a dict. With 'paired', the file is also
+# checked for interleaved mates with distinct names. Problems are listed under 'errors'.
+def read_stats(reads, paired=False):
+    lengths = {}
+    total_bases = 0
+    total_reads = 0
+    error_sum = 0.0
+    errors = []
+    whitespace_headers = 0
+    mismatched_pairs = 0
+    duplicate_names = 0
+    previous = None
+    previous_header = None
+    with open_binary(reads) as fastq:
+        while True:
+            header = fastq.readline()
+            if not header:
+                break
+            seq = fastq.readline().rstrip()
+            plus = fastq.readline()
+            quality = fastq.readline().rstrip()
+            if not header.startswith(b'@') or not plus.startswith(b'+') or len(seq) != len(quality):
+                errors.append("malformed FASTQ record {0} ('{1}')".format(total_reads + 1,
+                                                                          header.rstrip().decode('utf-8', 'replace')))
+                break
+            length = len(seq)
+            lengths[length] = lengths.get(length, 0) + 1
+            total_bases += length
+            total_reads += 1
+            error_sum += expected_errors(quality)
+            if not paired:
+                continue
+            if len(header.rstrip().split(None, 1)) > 1:
+                whitespace_headers += 1
+            if total_reads % 2 == 1:
+                previous = pair_key(header)
+                previous_header = header
+                continue
+            if header.split(None, 1)[0] == previous_header.split(None, 1)[0]:
+                if not duplicate_names:
+                    errors.append("mates '{0}' share their name up to the first whitespace; replace the whitespace "
+                                  "in the headers with underscores (e.g. reformat.sh underscore=t)".format(
+                                      header.rstrip().decode('utf-8', 'replace')))
+                duplicate_names += 1
+            name, mate = pair_key(header)
+            if name != previous[0] or (mate is not None and (previous[1], mate) != ('1', '2')):
+                if not mismatched_pairs:
+                    errors.append("reads {0} and {1} ('{2}', '{3}') are not mates; the paired-end reads must be "
+                                  "interleaved".format(total_reads - 1, total_reads, previous[0].decode('utf-8',
+                                                       'replace'), name.decode('utf-8', 'replace')))
+                mismatched_pairs += 1
+    if paired and total_reads % 2 == 1 and not errors:
+        errors.append("odd number of reads ({0}); the paired-end reads must be interleaved".format(total_reads))
+    if total_reads == 0 and not errors:
+        errors.append("no reads")
+    stats = {'path': os.path.abspath(reads), 'reads': total_reads, 'bases': total_bases,
+             'min_length': min(lengths) if lengths else 0, 'max_length': max(lengths) if lengths else 0,
+             'mean_length': round(total_bases / float(total_reads), 1) if total_reads else 0,
+             'n50': n50(lengths, total_bases),
+             'mean_quality': round(-10 * math.log10(error_sum / total_bases), 2) if total_bases else 0.0,
+             'errors': errors}
+    if paired:
+        stats['pairs'] = total_reads // 2
+        stats['mismatched_pairs'] = mismatched_pairs
+        stats['whitespace_headers'] = whitespace_headers
+        stats['duplicate_names'] = duplicate_names
+    return stats
+
+
+# derive_parameters() picks the Flye read mode, the long-read racon window (no longer than half the long-read N50, so
+# that typical reads span whole windows) and the fix_repeats read length (the span of a read pair, 300 for 2x150).
+def derive_parameters(long_stats, pe_stats):
+    window = max(MIN_RACON_WINDOW, min(RACON_WINDOW, long_stats['n50'] // 2))
+    return {'flye_mode': 'nano-hq' if long_stats['mean_quality'] >= HQ_QUALITY else 'nano-raw',
+            'racon_window': window,
+            'read_length': 2 * pe_stats['max_length'] if pe_stats['max_length'] else DEFAULT_READ_LENGTH}
+
+
+# check_thresholds() returns the reasons to reject a sample. Depth limits only apply when the genome size is known.
+def check_thresholds(long_stats, pe_stats, genome_size, min_long_depth, min_short_depth, min_long_n50):
+    failures = ['long reads: ' + error for error in long_stats['errors']]
+    failures += ['paired-end reads: ' + error for error in pe_stats['errors']]
+    if failures:
+        return failures
+    if long_stats['n50'] < min_long_n50:
+        failures.append("long-read N50 of {0} bp is below {1} bp".format(long_stats['n50'], min_long_n50))
+    if genome_size:
+        for label, stats, minimum in (('long-read', long_stats, min_long_depth),
+                                      ('short-read', pe_stats, min_short_depth)):
+            depth = stats['bases'] / float(genome_size)
+            if depth < minimum:
+                failures.append("{0} depth of {1:.1f}x is below {2}x".format(label, depth, minimum))
+    return failures
+
+
+# run_read_qc() computes the statistics of both read sets in parallel, writes the report to 'out_path' and raises
+# ReadQCError if the sample fails. Returns the report.
+def run_read_qc(long_reads, pe_reads, out_path, threads, genome_size=None, min_long_depth=0, min_short_depth=0,
+                min_long_n50=0):
+    with executor.process_pool(max(1, min(2, int(threads)))) as pool:
+        long_future = pool.submit(telemetry.measured, read_stats, long_reads)
+        pe_future = pool.submit(telemetry.measured, read_stats, pe_reads, True)
+        long_stats = telemetry.worker_result(long_future)
+        pe_stats = telemetry.worker_result(pe_future)
+    failures = check_thresholds(long_stats, pe_stats, genome_size, min_long_depth, min_short_depth, min_long_n50)
+    report = {'long_reads': long_stats, 'pe_reads': pe_stats, 'genome_size': genome_size, 'failures': failures,
+              'parameters': derive_parameters(long_stats, pe_stats) if not failures else {}}
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path + '.tmp', 'w') as handle:
+        json.dump(report, handle, indent=2, sort_keys=True)
+    os.replace(out_path + '.tmp', out_path)
+    for label, stats in (('Long reads', long_stats), ('Paired-end reads', pe_stats)):
+        print("{0}: {1} reads, {2:.1f} Mbp, length {3}-{4} bp (N50 {5} bp), mean quality Q{6}".format(
+            label, stats['reads'], stats['bases'] / 1e6, stats['min_length'], stats['max_length'], stats['n50'],
+            stats['mean_quality']))
+    if failures:
+        raise ReadQCError("Read QC failed ({0}):\n    {1}".format(out_path, "\n    ".join(failures)))
+    print("Read QC parameters: Flye --{flye_mode}, racon window {racon_window}, repeat read length "
+          "{read_length}".format(**report['parameters']))
+    return report
+
+
+def load_parameters(report_file):
+    """The parameters derived by the read QC stage"""
+    with open(report_file) as handle:
+        return json.load(handle)['parameters']
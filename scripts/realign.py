@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import gzip
+import bisect
+
+from fasta_io import read_fasta, open_binary
+from index_cache import sha256_file
+from seq_diff import matching_blocks
+
+"""Incremental re-alignment between polishing rounds"""
+# With '--incremental_alignment', every short-read racon round keeps its compressed alignment file in the scratch
+# directory, and the next short-read round carries it forward instead of mapping every read again. The previous and
+# the new reference are compared contig by contig: a rotation and/or reverse complement by fixstart is found by
+# anchoring k-mers of the new contig in the old one, and the racon edits by the block walk of seq_diff. Alignments
+# lying wholly inside a block that both references share are moved to their new coordinates as they are. Reads with an
+# alignment that overlaps an edit, spans the new origin or has supplementary parts are aligned again, and the two sets
+# are merged into the round's alignment file. Previously unmapped reads are not re-tried. Every read is aligned from
+# scratch for the first round of a phase, when the reads or the previous reference have changed, for FASTA reads, and
+# when more than MAX_STALE_FRACTION of the reads would have to be re-aligned anyway. The long-read rounds always align
+# every read: a long read spans several kb, so after a racon round with real edits nearly every one overlaps an edit.
+
+CARRY_NAME = "carry_{0}.json"
+ANCHOR = 32
+ANCHOR_TRIES = 50
+MAX_STALE_FRACTION = 0.5
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+CIGAR_OPERATION = re.compile(rb'(\d+)([MIDNSHP=X])')
+REFERENCE_OPERATIONS = b'MDN=X'
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+# ContigMap moves coordinates of an old contig onto the new one. The old contig is first oriented (reverse complemented
+# if 'reverse') and rotated left by 'shift'; 'blocks' are the [old_start, new_start, length] runs the rotated old
+# contig shares with the new one.
+class ContigMap(object):
+    def __init__(self, length, new_length, shift, reverse, blocks):
+        self.length = length
+        self.new_length = new_length
+        self.shift = shift
+        self.reverse = reverse
+        self.blocks = blocks
+        self.starts = [block[0] for block in blocks]
+
+    def lift(self, start, end):
+        """New 0-based start of the old span [start, end), or None if the span overlaps an edit or the new origin"""
+        if self.reverse:
+            start, end = self.length - end, self.length - start
+        span = end - start
+        start = (start - self.shift) % self.length
+        if start + span > self.length:
+            return None
+        index = bisect.bisect_right(self.starts, start) - 1
+        if index < 0:
+            return None
+        old_start, new_start, length = self.blocks[index]
+        if start + span > old_start + length:
+            return None
+        return new_start + start - old_start
+
+
+# contig_map() returns the ContigMap of 'old' onto 'new', or None if no k-mer of 'new' is found once in 'old'.
+def contig_map(old, new):
+    if not old or not new:
+        return None
+    if old == new:
+        return ContigMap(len(old), len(new), 0, False, [[0, 0, len(old)]])
+    strands = ((False, old), (True, reverse_complement(old)))
+    circular = [oriented + oriented[:ANCHOR - 1] for reverse, oriented in strands]
+    for offset in range(0, min(len(new) - ANCHOR, ANCHOR * ANCHOR_TRIES) + 1, ANCHOR):
+        anchor = new[offset:offset + ANCHOR]
+        hits = []
+        for reverse, sequence in enumerate(circular):
+            position = sequence.find(anchor)
+            while position != -1 and len(hits) < 2:
+                hits.append((reverse, position))
+                position = sequence.find(anchor, position + 1)
+        if len(hits) != 1:
+            continue
+        reverse, position = hits[0]
+        oriented = strands[reverse][1]
+        shift = (position - offset) % len(oriented)
+        blocks = matching_blocks(oriented[shift:] + oriented[:shift], new)
+        return ContigMap(len(old), len(new), shift, bool(reverse), blocks)
+    return None
+
+
+# reference_maps() returns the ContigMap of every contig of 'old_reference' that is still in 'new_reference', and the
+# (name, length) list of the new contigs.
+def reference_maps(old_reference, new_reference):
+    old_contigs = dict(read_fasta(old_reference))
+    maps = {}
+    lengths = []
+    for name, seq in read_fasta(new_reference):
+        lengths.append((name, len(seq)))
+        if name in old_contigs:
+            maps[name] = contig_map(old_contigs.pop(name), seq)
+    return maps, lengths
+
+
+def reference_span(cigar):
+    return sum(int(count) for count, operation in CIGAR_OPERATION.findall(cigar)
+               if operation in REFERENCE_OPERATIONS)
+
+
+# lift_sam_record() returns the SAM line moved onto the new reference, or None if its read has to be re-aligned.
+# Unmapped records return b'' (dropped, but the read is not re-aligned).
+def lift_sam_record(line, maps):
+    fields = line.rstrip(b'\n').split(b'\t', 9)
+    flag = int(fields[1])
+    if flag & 0x4:
+        return b''
+    if flag & 0x800 or b'\tSA:Z:' in fields[9]:
+        return None
+    contig = maps.get(fields[2].decode())
+    if contig is None:
+        return None
+    start = int(fields[3]) - 1
+    new_start = contig.lift(start, start + reference_span(fields[5]))
+    if new_start is None:
+        return None
+    if flag & 0x1 and fields[6] == b'=':
+        mate = int(fields[7]) - 1
+        new_mate = new_start if flag & 0x8 else contig.lift(mate, mate + 1)
+        # pairs are re-aligned if fixstart turned their contig round or put the origin between the mates
+        if contig.reverse or new_mate is None or (new_mate < new_start) != (mate < start):
+            return None
+        tlen = int(fields[8])
+        if tlen:
+            fields[8] = str(tlen + (new_mate - mate) - (new_start - start)).encode()
+        fields[7] = str(new_mate + 1).encode()
+    elif flag & 0x1 and fields[6] != b'*':
+        return None
+    if contig.reverse:
+        flag ^= 0x10
+        fields[1] = str(flag).encode()
+        fields[5] = b''.join(count + operation for count, operation in
+                             reversed(CIGAR_OPERATION.findall(fields[5])))
+        rest = fields[9].split(b'\t')
+        if rest[0] != b'*':
+            rest[0] = reverse_complement(rest[0].decode()).encode()
+        if rest[1] != b'*':
+            rest[1] = rest[1][::-1]
+        fields[9] = b'\t'.join(tag for tag in rest if not tag.startswith(b'MD:Z:'))
+    fields[3] = str(new_start + 1).encode()
+    return b'\t'.join(fields) + b'\n'
+
+
+# lift_paf_record() does the same for a PAF line.
+def lift_paf_record(line, maps):
+    fields = line.rstrip(b'\n').split(b'\t')
+    contig = maps.get(fields[5].decode())
+    if contig is None:
+        return None
+    start = int(fields[7])
+    end = int(fields[8])
+    new_start = contig.lift(start, end)
+    if new_start is None:
+        return None
+    fields[6] = str(contig.new_length).encode()
+    fields[7] = str(new_start).encode()
+    fields[8] = str(new_start + end - start).encode()
+    if contig.reverse:
+        fields[4] = b'-' if fields[4] == b'+' else b'+'
+        fields = [field for field in fields if not field.startswith((b'cg:Z:', b'cs:Z:'))]
+    return b'\t'.join(fields) + b'\n'
+
+
+# stale_reads() returns the names of the reads with a record that cannot be lifted, and the number of mapped reads.
+def stale_reads(alignment, maps, lift):
+    stale = set()
+    mapped = set()
+    with open_binary(alignment) as records:
+        for line in records:
+            if line.startswith(b'@'):
+                continue
+            lifted = lift(line, maps)
+            name = line.split(b'\t', 1)[0]
+            if lifted is None:
+                stale.add(name)
+            elif lifted:
+                mapped.add(name)
+    return stale, len(stale | mapped)
+
+
+def read_name(header):
+    """First word of a FASTQ header line without a /1 or /2 mate suffix, as the aligners report it"""
+    fields = header[1:].split(None, 1)
+    name = fields[0] if fields else b''
+    if name.endswith((b'/1', b'/2')):
+        name = name[:-2]
+    return name
+
+
+# select_reads() copies the FASTQ records of 'reads' named in 'names' to 'out_path'. Returns the number written.
+def select_reads(reads, names, out_path):
+    written = 0
+    with open_binary(reads) as fastq, open(out_path, 'wb') as out:
+        while True:
+            record = [fastq.readline() for _ in range(4)]
+            if not record[0]:
+                break
+            if read_name(record[0]) in names:
+                out.write(b''.join(record))
+                written += 1
+    return written
+
+
+def is_fastq(reads):
+    with open_binary(reads) as handle:
+        return handle.read(1) == b'@'
+
+
+def carry_path(scratch, phase):
+    return os.path.join(scratch, CARRY_NAME.format(phase))
+
+
+def reads_identity(reads):
+    status = os.stat(reads)
+    return [os.path.abspath(reads), status.st_size, status.st_mtime]
+
+
+# load_carry() returns the alignment kept by the previous round of 'phase', or None if it cannot be carried forward.
+def load_carry(scratch, phase, reads, alignment_format):
+    path = carry_path(scratch, phase)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as handle:
+        carry = json.load(handle)
+    if carry['reads'] != reads_identity(reads) or carry['format'] != alignment_format or \
+            not os.path.isfile(carry['alignment']) or not os.path.isfile(carry['reference']) or \
+            sha256_file(carry['reference']) != carry['sha256']:
+        return None
+    return carry
+
+
+# save_carry() keeps 'alignment' of 'reference' for the next round of 'phase' and removes the one it replaces.
+def save_carry(scratch, phase, reference, reads, alignment_format, alignment):
+    path = carry_path(scratch, phase)
+    if os.path.isfile(path):
+        with open(path) as handle:
+            previous = json.load(handle)['alignment']
+        if previous != alignment and os.path.isfile(previous):
+            os.remove(previous)
+    carry = {'reference': os.path.abspath(reference), 'sha256': sha256_file(reference),
+             'reads': reads_identity(reads), 'format': alignment_format, 'alignment': alignment}
+    with open(path + '.tmp', 'w') as handle:
+        json.dump(carry, handle)
+    os.replace(path + '.tmp', path)
+
+
+# carry_forward() writes the alignments of the previous round, lifted onto 'reference', together with new alignments of
+# the stale reads to 'out_path'. Returns False (having written nothing) if too many reads are stale.
+def carry_forward(carry, reference, reads, alignment_format, out_path, label, align, scratch):
+    maps, lengths = reference_maps(carry['reference'], reference)
+    lift = lift_sam_record if alignment_format == 'sam' else lift_paf_record
+    stale, mapped = stale_reads(carry['alignment'], maps, lift)
+    if mapped == 0 or len(stale) > MAX_STALE_FRACTION * mapped:
+        print("{0} of {1} reads overlap edits since the last round; aligning every read".format(len(stale), mapped))
+        return False
+    stale_fastq = os.path.join(scratch, 'stale_reads_{0}.fastq'.format(label))
+    selected = select_reads(reads, stale, stale_fastq)
+    realigned = align(stale_fastq, '{0}_stale'.format(label)) if selected else None
+    with gzip.open(out_path, 'wb', compresslevel=1) as out:
+        if alignment_format == 'sam':
+            out.write(b'@HD\tVN:1.6\tSO:unsorted\n')
+            for name, length in lengths:
+                out.write('@SQ\tSN:{0}\tLN:{1}\n'.format(name, length).encode())
+        with open_binary(carry['alignment']) as records:
+            for line in records:
+                if line.startswith(b'@') or line.split(b'\t', 1)[0] in stale:
+                    continue
+                out.write(lift(line, maps))
+        if realigned is not None:
+            with open_binary(realigned) as records:
+                for line in records:
+                    if not line.startswith(b'@'):
+                        out.write(line)
+    os.remove(stale_fastq)
+    if realigned is not None:
+        os.remove(realigned)
+    print("Carried the alignments of {0} of {1} reads forward; re-aligned {2} reads".format(mapped - len(stale),
+                                                                                           mapped, len(stale)))
+    return True
+
+
+# align_incrementally() returns the gzipped alignment file ('out_path') of 'reads' against 'reference' for a round of
+# 'phase' ('long' or 'short'), carried forward from the phase's previous round where possible. align(reads, label)
+# must align a read file against 'reference' into scratch/align_<label>.<format>.gz and return that path. The
+# alignment is kept for the next round, so the caller must not remove it.
+def align_incrementally(phase, scratch, reference, reads, alignment_format, label, align):
+    out_path = os.path.join(scratch, 'align_{0}.{1}.gz'.format(label, alignment_format))
+    carry = load_carry(scratch, phase, reads, alignment_format) if is_fastq(reads) else None
+    if carry is None or not carry_forward(carry, reference, reads, alignment_format, out_path, label, align, scratch):
+        out_path = align(reads, label)
+    save_carry(scratch, phase, reference, reads, alignment_format, out_path)
+    return out_path
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import math
+
+"""Core and memory detection and per-tool resource profiles"""
+# '-t auto' uses every core this process may run on and '--max_memory' defaults to the memory it may use, both within
+# the limits of its cgroup (Slurm, Docker and Kubernetes jobs are often given fewer cores and less memory than the node
+# has). The external tools scale differently: medaka stops getting faster at about 4 threads, pigz at a handful, and
+# samtools sort needs a memory budget ('-m', per thread) more than threads. TOOL_PROFILES records where each tool stops
+# scaling, so that a stage is only given the cores its tools can use (the batch scheduler hands the rest to other
+# samples), and how to share the cores of a piped stage such as 'bwa mem | samtools sort' between the tool producing
+# the stream and the one consuming it, rather than starting both with every core.
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# 'max_threads': beyond this the tool stops getting faster (None: it scales with every core). 'pipe_share': the fraction
+# of a piped stage's cores given to the tool when it consumes another tool's output. 'memory': GB the tool needs, for a
+# bacterial genome, whatever its thread count.
+TOOL_PROFILES = {
+    'flye': {'max_threads': None},
+    'minimap2': {'max_threads': None},
+    'racon': {'max_threads': None},
+    'bwa': {'max_threads': None, 'memory': 1.0},
+    'medaka': {'max_threads': 4},
+    'samtools_sort': {'max_threads': 8, 'pipe_share': 0.25},
+    'pigz': {'max_threads': 4, 'pipe_share': 0.2},
+}
+# samtools sort memory per thread in GB: its own default (768M), and the range used when a budget is given.
+SORT_MEMORY_PER_THREAD = 0.768
+MIN_SORT_MEMORY_PER_THREAD = 0.1
+MAX_SORT_MEMORY_PER_THREAD = 2.0
+
+
+def read_fields(path):
+    try:
+        with open(path) as handle:
+            return handle.read().split()
+    except (IOError, OSError):
+        return None
+
+
+# cgroup_dirs() lists the cgroup directories of this process for 'controller' (cgroup v1) or of the unified hierarchy
+# (cgroup v2), from its own group up to the root, since a limit set on any ancestor applies too.
+def cgroup_dirs(controller):
+    dirs = []
+    try:
+        with open('/proc/self/cgroup') as handle:
+            lines = handle.read().splitlines()
+    except (IOError, OSError):
+        return dirs
+    for line in lines:
+        fields = line.split(':', 2)
+        if len(fields) != 3:
+            continue
+        hierarchy, controllers, path = fields
+        if hierarchy == '0' and controllers == '':
+            root = CGROUP_ROOT
+        elif controller in controllers.split(','):
+            root = os.path.join(CGROUP_ROOT, controllers)
+        else:
+            continue
+        path = path.strip('/')
+        while True:
+            dirs.append(os.path.join(root, path))
+            if not path:
+                break
+            path = os.path.dirname(path)
+    return dirs
+
+
+def cgroup_cores():
+    """The cgroup CPU quota in cores (rounded up), or None if there is none"""
+    limits = []
+    for directory in cgroup_dirs('cpu'):
+        quota = read_fields(os.path.join(directory, 'cpu.max'))
+        if quota is not None and quota[0] != 'max':
+            limits.append(int(quota[0]) / float(quota[1]))
+        quota = read_fields(os.path.join(directory, 'cpu.cfs_quota_us'))
+        period = read_fields(os.path.join(directory, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None and int(quota[0]) > 0:
+            limits.append(int(quota[0]) / float(period[0]))
+    return int(math.ceil(min(limits))) if limits else None
+
+
+def cgroup_memory():
+    """The cgroup memory limit in GB, or None if there is none"""
+    limits = []
+    for directory in cgroup_dirs('memory'):
+        for name in ('memory.max', 'memory.limit_in_bytes'):
+            limit = read_fields(os.path.join(directory, name))
+            # cgroup v1 reports 'no limit' as a number close to 2^63
+            if limit is not None and limit[0].isdigit() and int(limit[0]) < 1 << 60:
+                limits.append(int(limit[0]) / float(1 << 30))
+    return min(limits) if limits else None
+
+
+def detect_cores():
+    """The number of cores this process may use: its CPU affinity, within any cgroup quota"""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    quota = cgroup_cores()
+    return max(1, min(cores, quota) if quota is not None else cores)
+
+
+def detect_memory():
+    """The memory in GB this process may use: the machine's memory, within any cgroup limit"""
+    total = None
+    meminfo = read_fields('/proc/meminfo') or []
+    if 'MemTotal:' in meminfo:
+        total = int(meminfo[meminfo.index('MemTotal:') + 1]) / float(1 << 20)
+    limit = cgroup_memory()
+    values = [value for value in (total, limit) if value is not None]
+    return round(min(values), 1) if values else None
+
+
+# resolve_threads() turns '-t' ('auto' or a number) into a number of threads. 'auto' is the detected cores; a number is
+# used as given, with a warning if it is more than the detected cores.
+def resolve_threads(threads):
+    if str(threads) == 'auto':
+        return detect_cores()
+    cores = detect_cores()
+    if int(threads) > cores:
+        print("Warning: {0} threads requested but only {1} core(s) are available".format(threads, cores))
+    return int(threads)
+
+
+# resolve_memory() returns '--max_memory' in GB, defaulting to the detected memory. A budget that is given is used as
+# is, with a warning if it is more than the detected memory.
+def resolve_memory(memory):
+    available = detect_memory()
+    if memory is None:
+        return available if available is not None else 64.0
+    if available is not None and memory > available:
+        print("Warning: --max_memory {0} GB requested but only {1} GB is available".format(memory, available))
+    return memory
+
+
+def max_threads(tool):
+    """The number of threads beyond which 'tool' stops getting faster, or None"""
+    return TOOL_PROFILES.get(tool, {}).get('max_threads')
+
+
+def tool_memory(tool):
+    """The memory in GB 'tool' needs, or 0 if not known"""
+    return TOOL_PROFILES.get(tool, {}).get('memory', 0.0)
+
+
+def tool_threads(tool, threads):
+    """'threads' (as given to the stage) capped at what 'tool' can use, as a string for the command line"""
+    limit = max_threads(tool)
+    return str(int(threads) if limit is None else min(int(threads), limit))
+
+
+# split_threads() divides a piped stage's threads between the producing and the consuming tool, giving the consumer
+# its 'pipe_share' (at least one thread, at most its 'max_threads') and the producer the rest. With a single thread
+# both get one. Returns (producer threads, consumer threads) as strings.
+def split_threads(threads, producer, consumer):
+    threads = int(threads)
+    consumer_threads = max(1, int(round(threads * TOOL_PROFILES[consumer].get('pipe_share', 0.5))))
+    consumer_threads = int(tool_threads(consumer, consumer_threads))
+    producer_threads = int(tool_threads(producer, max(1, threads - consumer_threads)))
+    return str(producer_threads), str(consumer_threads)
+
+
+def sort_memory(threads, budget=None):
+    """The samtools sort '-m' value for 'threads' threads sharing 'budget' GB (samtools' default without a budget)"""
+    per_thread = SORT_MEMORY_PER_THREAD
+    if budget is not None:
+        per_thread = min(MAX_SORT_MEMORY_PER_THREAD, max(MIN_SORT_MEMORY_PER_THREAD, budget / float(threads)))
+    return "{0}M".format(int(per_thread * 1024))
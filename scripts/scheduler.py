@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import threading
+import traceback
+
+from stages import Manifest, MANIFEST_NAME, execute_stage, execute_stage_batch
+from executor import ToolError
+from read_qc import ReadQCError
+
+"""Core-budgeted scheduler for running many samples at once"""
+# Each sample is a chain of stages that must run in order, but stages of different samples are independent. The
+# scheduler keeps a single pool of cores and memory for the whole batch and, whenever resources are released, hands them
+# to whichever stages are runnable: single-threaded stages (berokka, circlator, fixstart) take one core, and the rest of
+# the budget is shared between the multi-threaded stages (flye, minimap2/racon, medaka, bwa) that are ready to go.
+# Stages that can be batched across samples (Stage 'batch', e.g. medaka with --medaka_batch) are held back until
+# 'batch_sizes[stage name]' samples are waiting at that stage, or no other sample can still get there, and then run
+# together as one stage.
+
+
+class SampleJob(object):
+    def __init__(self, sample_name, outdir, stages, resume=False):
+        self.sample_name = sample_name
+        self.outdir = outdir
+        self.stages = stages
+        self.resume = resume
+        self.manifest = Manifest(os.path.join(outdir, MANIFEST_NAME))
+        self.next_stage = 0
+        self.running = False
+        self.failed = None
+        self.start_time = None
+        self.end_time = None
+        self.stage_log = []
+
+    def finished(self):
+        return self.failed is not None or self.next_stage >= len(self.stages)
+
+    def runnable(self):
+        return not self.running and not self.finished()
+
+    def current_stage(self):
+        return self.stages[self.next_stage]
+
+
+class BatchScheduler(object):
+    def __init__(self, jobs, threads, memory, batch_sizes=None):
+        self.jobs = jobs
+        self.batch_sizes = batch_sizes or {}
+        self.threads = threads
+        self.memory = memory
+        self.free_threads = threads
+        self.free_memory = memory
+        self.condition = threading.Condition()
+        self.core_seconds = 0.0
+        self.start_time = None
+        self.end_time = None
+
+    # allocate() decides how many threads the stage at the head of 'job' gets, or returns None if it should wait for
+    # resources to be released. Spare cores are split evenly between the multi-threaded stages that are waiting.
+    def allocate(self, job, waiting_multithreaded, nothing_running):
+        stage = job.current_stage()
+        memory = min(stage.memory, self.memory)
+        if memory > self.free_memory and not nothing_running:
+            return None
+        if stage.max_threads == 1:
+            wanted = 1
+        else:
+            share = max(1, self.free_threads // max(1, waiting_multithreaded))
+            wanted = share if stage.max_threads is None else min(share, stage.max_threads)
+        min_threads = min(stage.min_threads, self.threads)
+        if wanted < min_threads:
+            if not nothing_running:
+                return None
+            wanted = min(self.free_threads, min_threads)
+        if wanted < 1 or wanted > self.free_threads:
+            return None
+        return wanted
+
+    def batched(self, job):
+        """Whether the next stage of 'job' waits to run together with the same stage of other samples"""
+        stage = job.current_stage()
+        return stage.batch is not None and self.batch_sizes.get(stage.name, 1) > 1
+
+    # ready_batches() groups the jobs waiting at a batched stage into batches that can start: full ones, and the rest
+    # once no other job can still reach that stage.
+    def ready_batches(self):
+        waiting = [job for job in self.jobs if job.runnable() and self.batched(job)]
+        batches = []
+        for name in sorted(set(job.current_stage().name for job in waiting)):
+            group = [job for job in waiting if job.current_stage().name == name]
+            size = self.batch_sizes[name]
+            arriving = [job for job in self.jobs if not job.finished() and job not in group and
+                        name in [stage.name for stage in job.stages[job.next_stage:]]]
+            while len(group) >= size or (group and not arriving):
+                batches.append(group[:size])
+                group = group[size:]
+        return batches
+
+    def dispatch(self):
+        """Start as many runnable stages as the free cores and memory allow. Called with the condition held"""
+        runnable = [[job] for job in self.jobs if job.runnable() and not self.batched(job)] + self.ready_batches()
+        waiting_multithreaded = len([jobs for jobs in runnable if jobs[0].current_stage().max_threads != 1])
+        for jobs in runnable:
+            nothing_running = self.free_threads == self.threads
+            threads = self.allocate(jobs[0], waiting_multithreaded, nothing_running)
+            if jobs[0].current_stage().max_threads != 1:
+                waiting_multithreaded -= 1
+            if threads is None:
+                continue
+            memory = min(jobs[0].current_stage().memory, self.memory)
+            self.free_threads -= threads
+            self.free_memory -= memory
+            for job in jobs:
+                job.running = True
+                if job.start_time is None:
+                    job.start_time = time.time()
+            worker = threading.Thread(target=self.run_stage, args=(jobs, threads, memory))
+            worker.daemon = True
+            worker.start()
+
+    # run_stage() runs the current stage of 'jobs': one job, or several whose stage runs as one batch.
+    def run_stage(self, jobs, threads, memory):
+        stage = jobs[0].current_stage()
+        label = ', '.join(job.sample_name for job in jobs)
+        start = time.time()
+        error = None
+        try:
+            if len(jobs) == 1:
+                executed = [execute_stage(stage, jobs[0].manifest, threads, jobs[0].resume, label=label)]
+            else:
+                executed = execute_stage_batch([(job.current_stage(), job.manifest, job.sample_name) for job in jobs],
+                                               threads, jobs[0].resume)
+        except (ToolError, ReadQCError) as e:
+            executed = [True] * len(jobs)
+            error = "{0}: {1}".format(stage.name, str(e).splitlines()[0])
+            sys.stderr.write("[{0}] Stage '{1}' failed: {2}\n".format(label, stage.name, e))
+        except Exception as e:
+            executed = [True] * len(jobs)
+            error = "{0}: {1}".format(stage.name, e)
+            sys.stderr.write("[{0}] Stage '{1}' failed\n{2}".format(label, stage.name, traceback.format_exc()))
+        elapsed = time.time() - start
+        with self.condition:
+            self.free_threads += threads
+            self.free_memory += memory
+            if any(executed):
+                self.core_seconds += threads * elapsed
+            for job, job_executed in zip(jobs, executed):
+                if job_executed:
+                    job.stage_log.append((stage.name, threads / float(sum(executed)), elapsed))
+                job.running = False
+                if error is not None:
+                    job.failed = error
+                else:
+                    job.next_stage += 1
+                if job.finished():
+                    job.end_time = time.time()
+            self.condition.notify_all()
+
+    def run(self):
+        self.start_time = time.time()
+        with self.condition:
+            while not all(job.finished() for job in self.jobs):
+                self.dispatch()
+                self.condition.wait()
+        self.end_time = time.time()
+        return self.jobs
+
+    def utilisation(self):
+        wall = max(self.end_time - self.start_time, 1e-9)
+        return self.core_seconds / (self.threads * wall)
+
+    def report(self, report_path=None):
+        lines = ["sample\tstatus\twall_time_s\tcore_seconds"]
+        for job in self.jobs:
+            status = 'failed ({0})'.format(job.failed) if job.failed is not None else 'ok'
+            wall = (job.end_time - job.start_time) if job.start_time is not None else 0.0
+            core_seconds = sum(threads * elapsed for name, threads, elapsed in job.stage_log)
+            lines.append("{0}\t{1}\t{2:.1f}\t{3:.1f}".format(job.sample_name, status, wall, core_seconds))
+        summary = "Batch wall time {0:.1f}s, {1} thread budget, utilisation {2:.1%}".format(
+            self.end_time - self.start_time, self.threads, self.utilisation())
+        print('\n'.join(lines))
+        print(summary)
+        if report_path is not None:
+            with open(report_path, 'w') as report:
+                report.write('\n'.join(lines) + '\n')
+                report.write('# ' + summary + '\n')
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import threading
+
+import telemetry
+from index_cache import directory_size
+
+"""Scratch space for intermediate files"""
+# Alignments, sort temporaries and the fix_repeats working directory of each sample are written below
+# '--scratch'/<sample> (default: outdir/scratch), which can point at fast local disk such as NVMe or tmpfs instead of
+# shared NFS, and are removed once the sample has finished. Aligner output is piped straight into its consumer
+# (samtools sort, racon through a named pipe) or compressed on the fly, so no uncompressed SAM is written.
+# ScratchMonitor samples the size of each sample's scratch directory and records the peak in its run_metrics.json;
+# checkpoint() takes an extra sample just before intermediates are deleted, so that short-lived peaks are not missed.
+
+_monitors = []
+
+
+def scratch_dir(args):
+    """The scratch directory of the sample (or contig) described by 'args'"""
+    if args.scratch is None:
+        return os.path.join(os.path.abspath(args.outdir), 'scratch')
+    return os.path.join(os.path.abspath(args.scratch), args.sample_name)
+
+
+def make_scratch_dir(args):
+    path = scratch_dir(args)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def compressor(threads):
+    """Fast gzip compression command for streamed intermediates: pigz when installed, else gzip"""
+    if shutil.which('pigz') is not None:
+        return ['pigz', '-1', '-p', str(threads)]
+    return ['gzip', '-1']
+
+
+def checkpoint():
+    for monitor in list(_monitors):
+        monitor.measure()
+
+
+def remove_scratch(args):
+    shutil.rmtree(scratch_dir(args), ignore_errors=True)
+
+
+# ScratchMonitor samples the size of every watched scratch directory every 'interval' seconds in a background thread.
+# On stop(), the peak of each directory is printed and saved to the run metrics of the sample's output directory.
+class ScratchMonitor(object):
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.peaks = {}
+        self.outdirs = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def watch(self, path, outdir):
+        with self.lock:
+            self.peaks.setdefault(path, 0)
+            self.outdirs[path] = outdir
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.sample_sizes)
+            self.thread.daemon = True
+            self.thread.start()
+            _monitors.append(self)
+
+    def sample_sizes(self):
+        while not self.stopped.wait(self.interval):
+            self.measure()
+
+    def measure(self):
+        with self.lock:
+            paths = list(self.peaks)
+        for path in paths:
+            size = directory_size(path) if os.path.isdir(path) else 0
+            with self.lock:
+                self.peaks[path] = max(self.peaks[path], size)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            _monitors.remove(self)
+        self.measure()
+        for path, peak in sorted(self.peaks.items()):
+            telemetry.metrics_for(self.outdirs[path]).record_scratch(path, peak)
+            print("Peak scratch use of {0}: {1:.1f} MB".format(path, peak / float(1 << 20)))
+        return self.peaks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
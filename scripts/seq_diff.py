@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""Edit counting between consecutive polishing rounds"""
+# Consecutive polishes of the same assembly differ at a few hundred to a few thousand positions out of several Mb, so
+# rather than a full alignment the two sequences are walked in parallel: identical stretches are skipped in large blocks
+# with plain string comparisons, and at each difference the walk re-synchronises on the next shared k-mer. Only the
+# short gap between the difference and the re-synchronisation point is aligned base by base.
+
+# Gaps longer than this on either side are not aligned base by base; they are counted as substitutions over the shorter
+# side and insertions/deletions over the length difference.
+MAX_ALIGNED_GAP = 200
+
+
+class EditCounts(object):
+    def __init__(self, substitutions=0, insertions=0, deletions=0):
+        self.substitutions = substitutions
+        self.insertions = insertions
+        self.deletions = deletions
+
+    def total(self):
+        return self.substitutions + self.insertions + self.deletions
+
+    def add(self, other):
+        self.substitutions += other.substitutions
+        self.insertions += other.insertions
+        self.deletions += other.deletions
+        return self
+
+    def as_dict(self):
+        return {'substitutions': self.substitutions, 'insertions': self.insertions, 'deletions': self.deletions,
+                'total': self.total()}
+
+    def __repr__(self):
+        return "EditCounts(substitutions={0}, insertions={1}, deletions={2})".format(
+            self.substitutions, self.insertions, self.deletions)
+
+
+# align_gap() returns the edit operations turning 'old' into 'new' by a Levenshtein alignment with traceback. Insertions
+# are bases present only in 'new', deletions bases present only in 'old'.
+def align_gap(old, new):
+    if len(old) > MAX_ALIGNED_GAP or len(new) > MAX_ALIGNED_GAP:
+        shorter = min(len(old), len(new))
+        return EditCounts(shorter, max(0, len(new) - len(old)), max(0, len(old) - len(new)))
+    rows = len(old) + 1
+    cols = len(new) + 1
+    score = [[0] * cols for _ in range(rows)]
+    for i in range(rows):
+        score[i][0] = i
+    for j in range(cols):
+        score[0][j] = j
+    for i in range(1, rows):
+        for j in range(1, cols):
+            diagonal = score[i - 1][j - 1] + (old[i - 1] != new[j - 1])
+            score[i][j] = min(diagonal, score[i - 1][j] + 1, score[i][j - 1] + 1)
+    edits = EditCounts()
+    i = rows - 1
+    j = cols - 1
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and score[i][j] == score[i - 1][j - 1] + (old[i - 1] != new[j - 1]):
+            if old[i - 1] != new[j - 1]:
+                edits.substitutions += 1
+            i -= 1
+            j -= 1
+        elif i > 0 and score[i][j] == score[i - 1][j] + 1:
+            edits.deletions += 1
+            i -= 1
+        else:
+            edits.insertions += 1
+            j -= 1
+    return edits
+
+
+def common_prefix_length(old, new, i, j, limit):
+    """Length of the longest common prefix of old[i:] and new[j:], up to 'limit', by bisection"""
+    if old[i:i + limit] == new[j:j + limit]:
+        return limit
+    low = 0
+    high = limit
+    while high - low > 1:
+        middle = (low + high) // 2
+        if old[i:i + middle] == new[j:j + middle]:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+# resynchronise() finds the closest point after a difference at which both sequences share a k-mer again. Returns the
+# positions (i, j) of that k-mer in 'old' and 'new', or None if there is none within 'window' bases.
+def resynchronise(old, new, i, j, kmer, window):
+    for offset in range(0, window):
+        anchor = old[i + offset:i + offset + kmer]
+        if len(anchor) < kmer:
+            return None
+        position = new.find(anchor, j, j + offset + window + kmer)
+        if position != -1:
+            return i + offset, position
+    return None
+
+
+# diff_sequences() counts the substitutions, insertions and deletions that turn 'old' into 'new'.
+def diff_sequences(old, new, kmer=24, window=2000, block=4096):
+    edits = EditCounts()
+    i = 0
+    j = 0
+    while i < len(old) and j < len(new):
+        limit = min(block, len(old) - i, len(new) - j)
+        matched = common_prefix_length(old, new, i, j, limit)
+        i += matched
+        j += matched
+        if matched == limit:
+            continue
+        sync = resynchronise(old, new, i, j, kmer, window)
+        if sync is None:
+            break
+        edits.add(align_gap(old[i:sync[0]], new[j:sync[1]]))
+        i, j = sync
+    edits.add(align_gap(old[i:], new[j:]))
+    return edits
+
+
+# matching_blocks() returns, in order, the [old_start, new_start, length] runs of bases that 'old' and 'new' share,
+# found by the same walk as diff_sequences(). Positions outside every block were changed.
+def matching_blocks(old, new, kmer=24, window=2000, block=4096):
+    blocks = []
+    i = 0
+    j = 0
+    while i < len(old) and j < len(new):
+        limit = min(block, len(old) - i, len(new) - j)
+        matched = common_prefix_length(old, new, i, j, limit)
+        if matched:
+            last = blocks[-1] if blocks else None
+            if last is not None and last[0] + last[2] == i and last[1] + last[2] == j:
+                last[2] += matched
+            else:
+                blocks.append([i, j, matched])
+        i += matched
+        j += matched
+        if matched == limit:
+            continue
+        sync = resynchronise(old, new, i, j, kmer, window)
+        if sync is None:
+            break
+        i, j = sync
+    return blocks
+
+
+# diff_assemblies() compares two lists of (name, sequence) records contig by contig. Contigs missing from 'new' (e.g.
+# dropped by racon) are counted as deleted and new contigs as inserted. Returns a dict of contig name to EditCounts.
+def diff_assemblies(old_records, new_records):
+    new_sequences = dict(new_records)
+    old_names = set(name for name, seq in old_records)
+    contig_edits = {}
+    for name, seq in old_records:
+        if name in new_sequences:
+            contig_edits[name] = diff_sequences(seq, new_sequences[name])
+        else:
+            contig_edits[name] = EditCounts(deletions=len(seq))
+    for name, seq in new_records:
+        if name not in old_names:
+            contig_edits[name] = EditCounts(insertions=len(seq))
+    return contig_edits
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import hashlib
+import subprocess
+
+import telemetry
+import executor
+
+"""Stage engine for the assembly pipeline"""
+# Every step of the pipeline is described as a Stage that declares the files it reads, the files it writes, the
+# parameters that change its output and the external tools it calls. After a stage finishes, a record of the content
+# hashes of its inputs and outputs is written to a manifest in the output directory. A resumed run compares the current
+# inputs, parameters and tool versions against that record and only re-executes stages that are stale.
+
+MANIFEST_NAME = "pipeline_manifest.json"
+
+# Some tools do not understand '--version'; these are probed with the arguments listed here instead.
+TOOL_VERSION_ARGS = {
+    'bwa': [],
+    'samtools': ['--version'],
+    'bcftools': ['--version'],
+    'racon': ['--version'],
+    'minimap2': ['--version'],
+    'medaka_consensus': ['-h'],
+}
+
+_tool_versions = {}
+
+
+class StageError(Exception):
+    pass
+
+
+# Stage() holds the declaration of one pipeline step. 'action' is called with the number of threads to use, 'inputs'
+# and 'outputs' are file paths, 'params' is a JSON-serialisable dict of settings that affect the output and 'tools' maps
+# a tool name to the executable path used by the stage. 'min_threads', 'max_threads' (None for no limit) and
+# 'memory' (GB) describe the resources the stage can use, for the batch scheduler. 'timeout' (seconds, None for no
+# limit) bounds the stage's external tools. 'batch' is an optional (function, item) pair: the batch scheduler may run
+# the same stage of several samples as one call of function([item, ...], threads, timeout), which writes every
+# sample's outputs, instead of calling each stage's 'action'.
+class Stage(object):
+    def __init__(self, name, action, inputs=(), outputs=(), params=None, tools=None, min_threads=1, max_threads=None,
+                 memory=1.0, timeout=None, batch=None):
+        self.name = name
+        self.action = action
+        self.inputs = [os.path.abspath(i) for i in inputs if i is not None]
+        self.outputs = [os.path.abspath(o) for o in outputs]
+        self.params = params or {}
+        self.tools = tools or {}
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.memory = memory
+        self.timeout = timeout
+        self.batch = batch
+
+    def dependencies(self, stages):
+        """Return the names of earlier stages whose outputs this stage reads"""
+        dependencies = []
+        for stage in stages:
+            if stage is self:
+                break
+            if set(stage.outputs) & set(self.inputs):
+                dependencies.append(stage.name)
+        return dependencies
+
+    def __repr__(self):
+        return "Stage({0})".format(self.name)
+
+
+# probe_tool_version() returns the first line of a tool's version output. Results are cached for the lifetime of the
+# process since every stage of every sample asks for the same handful of tools.
+def probe_tool_version(tool_name, tool_path):
+    if tool_path in _tool_versions:
+        return _tool_versions[tool_path]
+    version_args = TOOL_VERSION_ARGS.get(tool_name, ['--version'])
+    try:
+        result = subprocess.run([tool_path] + version_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                timeout=60)
+        output = result.stdout.decode('utf-8', 'replace')
+    except (OSError, subprocess.SubprocessError):
+        output = ''
+    version = 'unknown'
+    for line in output.splitlines():
+        line = line.strip()
+        if line.lower().startswith('version'):
+            version = line.split(':', 1)[-1].strip()
+            break
+        if version == 'unknown' and any(c.isdigit() for c in line):
+            version = line
+    _tool_versions[tool_path] = version
+    return version
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Manifest() is the on-disk record of completed stages. File hashes are cached against (size, mtime) so that large read
+# files are only hashed once per run directory.
+class Manifest(object):
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        self.file_hashes = {}
+        if os.path.isfile(path):
+            with open(path) as handle:
+                data = json.load(handle)
+            self.stages = data.get('stages', {})
+            self.file_hashes = data.get('file_hashes', {})
+
+    def hash_file(self, path):
+        stat = os.stat(path)
+        cached = self.file_hashes.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = sha256_file(path)
+        self.file_hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def signature(self, stage):
+        """Hash of everything that determines a stage's output: input contents, parameters and tool versions"""
+        digest = hashlib.sha256()
+        digest.update(stage.name.encode('utf-8'))
+        for path in sorted(stage.inputs):
+            if not os.path.exists(path):
+                raise StageError("Input {0} of stage '{1}' does not exist".format(path, stage.name))
+            digest.update(path.encode('utf-8'))
+            digest.update(self.hash_file(path).encode('utf-8'))
+        digest.update(json.dumps(stage.params, sort_keys=True).encode('utf-8'))
+        for tool_name in sorted(stage.tools):
+            digest.update(tool_name.encode('utf-8'))
+            digest.update(probe_tool_version(tool_name, stage.tools[tool_name]).encode('utf-8'))
+        return digest.hexdigest()
+
+    def is_current(self, stage, signature):
+        record = self.stages.get(stage.name)
+        if record is None or record['signature'] != signature:
+            return False
+        for path, digest in record['outputs'].items():
+            if not os.path.isfile(path) or self.hash_file(path) != digest:
+                return False
+        return True
+
+    def record(self, stage, signature, elapsed):
+        outputs = {}
+        for path in stage.outputs:
+            if not os.path.isfile(path):
+                raise StageError("Stage '{0}' did not produce {1}".format(stage.name, path))
+            outputs[path] = self.hash_file(path)
+        self.stages[stage.name] = {'signature': signature,
+                                   'inputs': dict((path, self.hash_file(path)) for path in stage.inputs),
+                                   'outputs': outputs,
+                                   'params': stage.params,
+                                   'tools': dict((name, probe_tool_version(name, path))
+                                                 for name, path in stage.tools.items()),
+                                   'elapsed': round(elapsed, 2),
+                                   'completed': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as handle:
+            json.dump({'stages': self.stages, 'file_hashes': self.file_hashes}, handle, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+# set_timeouts() applies '--stage_timeout' (see executor.parse_timeouts) to 'stages' and returns them.
+def set_timeouts(stages, spec):
+    timeouts = executor.parse_timeouts(spec)
+    for stage in stages:
+        stage.timeout = timeouts.get(stage.name, timeouts.get('*'))
+    return stages
+
+
+def select_stages(stages, from_stage=None, to_stage=None):
+    names = [stage.name for stage in stages]
+    for name in (from_stage, to_stage):
+        if name is not None and name not in names:
+            raise StageError("Unknown stage '{0}'. Available stages: {1}".format(name, ', '.join(names)))
+    start = names.index(from_stage) if from_stage is not None else 0
+    end = names.index(to_stage) + 1 if to_stage is not None else len(stages)
+    if start >= end:
+        raise StageError("--from_stage '{0}' comes after --to_stage '{1}'".format(from_stage, to_stage))
+    return stages[start:end]
+
+
+# execute_stage() runs a single stage and records it in the manifest. With 'resume', a stage whose recorded signature
+# matches the current one (and whose outputs are intact) is skipped. Returns True if the stage was executed.
+def execute_stage(stage, manifest, threads, resume=False, label=None):
+    prefix = "[{0}] ".format(label) if label else ""
+    signature = manifest.signature(stage)
+    if resume and manifest.is_current(stage, signature):
+        print("{0}Skipping stage '{1}': inputs, parameters and tool versions unchanged".format(prefix, stage.name))
+        return False
+    print("{0}Running stage '{1}' with {2} thread(s)".format(prefix, stage.name, threads))
+    sys.stdout.flush()
+    start = time.time()
+    with telemetry.stage_context(os.path.dirname(manifest.path), stage.name, label, stage.timeout):
+        stage.action(str(threads))
+    for path in stage.outputs:
+        executor.validate_output(path)
+    manifest.record(stage, signature, time.time() - start)
+    return True
+
+
+# execute_stage_batch() runs the same stage of several samples with one call of the stage's batch function and records
+# it in each sample's manifest. 'entries' are (stage, manifest, label) tuples. With 'resume', samples whose stage is up
+# to date are skipped. Returns whether each sample's stage was executed.
+def execute_stage_batch(entries, threads, resume=False):
+    pending = []
+    executed = []
+    for stage, manifest, label in entries:
+        signature = manifest.signature(stage)
+        current = resume and manifest.is_current(stage, signature)
+        if current:
+            print("[{0}] Skipping stage '{1}': inputs, parameters and tool versions unchanged".format(label,
+                                                                                                     stage.name))
+        else:
+            pending.append((stage, manifest, label, signature))
+        executed.append(not current)
+    if len(pending) == 1:
+        stage, manifest, label, signature = pending[0]
+        execute_stage(stage, manifest, threads, label=label)
+    elif pending:
+        stage = pending[0][0]
+        print("Running stage '{0}' for {1} samples together ({2}) with {3} thread(s)".format(
+            stage.name, len(pending), ', '.join(entry[2] for entry in pending), threads))
+        sys.stdout.flush()
+        start = time.time()
+        stage.batch[0]([entry[0].batch[1] for entry in pending], str(threads), stage.timeout)
+        for stage, manifest, label, signature in pending:
+            for path in stage.outputs:
+                executor.validate_output(path)
+            manifest.record(stage, signature, time.time() - start)
+    return executed
+
+
+# run_stages() executes the selected part of the stage graph in order. Each stage gets 'threads', up to its
+# 'max_threads'.
+def run_stages(stages, outdir, threads, resume=False, from_stage=None, to_stage=None):
+    manifest = Manifest(os.path.join(outdir, MANIFEST_NAME))
+    for stage in select_stages(stages, from_stage, to_stage):
+        stage_threads = int(threads) if stage.max_threads is None else min(int(threads), stage.max_threads)
+        execute_stage(stage, manifest, stage_threads, resume)
+    return manifest
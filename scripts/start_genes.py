@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+import os
+import json
+import tempfile
+
+import executor
+import telemetry
+from fasta_io import read_fasta, write_fasta
+from index_cache import sha256_file
+
+"""Native start-gene locator for circular contigs"""
+# Replaces 'circlator fixstart'. The start-site database (dnaA and plasmid rep genes) is indexed once into a k-mer
+# index saved next to the database file (<db>.k<K>.json, keyed on the database's SHA-256). Each contig is scanned on
+# both strands; k-mer seeds are binned by gene and diagonal, and the best-supported diagonals are extended by an
+# anchored alignment of the gene against the contig. A hit must start at the first base of the gene and reach
+# '--start_min_id' percent identity, as in circlator. The contig is then rotated so the gene starts at position 1, and
+# reverse complemented first if the gene is on the reverse strand. Contigs without a hit are started at the prodigal
+# gene closest to their middle when prodigal is available, and are otherwise left unchanged. A missing database is an
+# error, as it is for circlator, rather than a reason to leave every contig where it starts.
+
+KMER = 13
+# Contig positions are looked up every STRIDE bases; the database is indexed at every position, so each diagonal is
+# still seen, with a quarter of the seeds.
+STRIDE = 4
+MIN_SEEDS = 3
+CANDIDATES = 5
+# Largest net indel (bases) allowed between a gene and the contig when extending a seed hit.
+BAND = 60
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+_indices = {}
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def index_path(db_file, fallback_dir, kmer=KMER):
+    """Where the index of 'db_file' lives: next to it, or in 'fallback_dir' if the db directory is read-only"""
+    path = "{0}.k{1}.json".format(db_file, kmer)
+    if os.access(os.path.dirname(os.path.abspath(db_file)), os.W_OK) or os.path.isfile(path):
+        return path
+    return os.path.join(fallback_dir, "{0}.k{1}.json".format(os.path.basename(db_file), kmer))
+
+
+def build_index(db_file, kmer=KMER):
+    genes = read_fasta(db_file)
+    kmers = {}
+    for gene, (name, seq) in enumerate(genes):
+        seq = seq.upper()
+        for offset in range(len(seq) - kmer + 1):
+            kmers.setdefault(seq[offset:offset + kmer], []).append([gene, offset])
+    return {'sha256': sha256_file(db_file), 'k': kmer, 'genes': genes, 'kmers': kmers}
+
+
+# load_index() returns the k-mer index of 'db_file', building and saving it only when the database has changed.
+def load_index(db_file, fallback_dir, kmer=KMER):
+    digest = sha256_file(db_file)
+    if digest in _indices:
+        return _indices[digest]
+    path = index_path(db_file, fallback_dir, kmer)
+    index = None
+    if os.path.isfile(path):
+        with open(path) as handle:
+            index = json.load(handle)
+        if index.get('sha256') != digest or index.get('k') != kmer:
+            index = None
+    if index is None:
+        print("Indexing start-site database {0}".format(db_file))
+        index = build_index(db_file, kmer)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(index, handle)
+        os.replace(path + '.tmp', path)
+    _indices[digest] = index
+    return index
+
+
+# seed_diagonals() counts k-mer seeds per (gene, diagonal) on one strand of a circular contig. A diagonal is the contig
+# position at which the gene would start.
+def seed_diagonals(seq, index, longest_gene):
+    kmer = index['k']
+    kmers = index['kmers']
+    extended = seq + seq[:longest_gene]
+    counts = {}
+    for position in range(0, len(extended) - kmer + 1, STRIDE):
+        hits = kmers.get(extended[position:position + kmer])
+        if hits is None:
+            continue
+        for gene, offset in hits:
+            key = (gene, (position - offset) % len(seq))
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+# extend_hit() returns the percent identity of 'gene_seq' aligned from its first base against the circular contig 'seq'
+# at 'start'. The alignment is global over the gene, free at the contig end, and banded to BAND bases of net indel.
+def extend_hit(seq, gene_seq, start):
+    length = len(gene_seq)
+    window = seq[start:start + length + BAND]
+    if len(window) < length + BAND:
+        window += seq[:length + BAND - len(window)]
+    width = 2 * BAND + 1
+    infinity = length + width
+    # row[k] is the edit distance of gene_seq[:i] against window[:i + k - BAND]
+    row = [k - BAND if k >= BAND else infinity for k in range(width)]
+    for i in range(1, length + 1):
+        base = gene_seq[i - 1]
+        previous = row
+        row = [infinity] * width
+        for k in range(width):
+            j = i + k - BAND
+            if j < 0:
+                continue
+            if j == 0:
+                row[k] = i
+                continue
+            best = previous[k] + (window[j - 1] != base)
+            if k + 1 < width and previous[k + 1] + 1 < best:
+                best = previous[k + 1] + 1
+            if k > 0 and row[k - 1] + 1 < best:
+                best = row[k - 1] + 1
+            row[k] = best
+    distance = min(row)
+    return 100.0 * max(0, length - distance) / length
+
+
+# find_start_gene() returns the best start-gene hit of a contig as a dict, or None.
+def find_start_gene(seq, index, min_id):
+    genes = index['genes']
+    longest_gene = max(len(gene_seq) for name, gene_seq in genes)
+    best = None
+    for strand, strand_seq in (('+', seq.upper()), ('-', reverse_complement(seq.upper()))):
+        counts = seed_diagonals(strand_seq, index, longest_gene)
+        candidates = sorted(counts.items(), key=lambda item: -item[1])[:CANDIDATES]
+        for (gene, start), seeds in candidates:
+            if seeds < MIN_SEEDS:
+                continue
+            name, gene_seq = genes[gene]
+            identity = extend_hit(strand_seq, gene_seq, start)
+            if identity < min_id:
+                continue
+            matches = identity * len(gene_seq)
+            if best is None or matches > best['matches']:
+                best = {'gene': name, 'strand': strand, 'start': start, 'identity': round(identity, 2),
+                        'matches': matches, 'seeds': seeds}
+    return best
+
+
+# prodigal_start() returns (start, strand) of the prodigal gene closest to the middle of 'seq', or None.
+def prodigal_start(seq, prodigal_path, work_dir):
+    with tempfile.NamedTemporaryFile('w', suffix='.fa', dir=work_dir, delete=False) as contig:
+        contig.write('>contig\n' + seq + '\n')
+    genes_file = contig.name + '.sco'
+    try:
+        mode = 'single' if len(seq) >= 20000 else 'meta'
+        result = telemetry.run([prodigal_path, '-i', contig.name, '-o', genes_file, '-f', 'sco', '-c', '-m',
+                                '-g', '11', '-p', mode, '-q'], check=False)
+        if result.returncode != 0:
+            return None
+        genes = []
+        with open(genes_file) as sco:
+            for line in sco:
+                if line.startswith('>'):
+                    number, left, right, strand = line[1:].strip().split('_')
+                    genes.append((int(left) - 1, int(right), strand))
+    except OSError:
+        return None
+    finally:
+        for path in (contig.name, genes_file):
+            if os.path.exists(path):
+                os.remove(path)
+    if not genes:
+        return None
+    middle = len(seq) / 2.0
+    left, right, strand = min(genes, key=lambda gene: abs((gene[0] if gene[2] == '+' else gene[1]) - middle))
+    if strand == '+':
+        return left, '+'
+    return len(seq) - right, '-'
+
+
+def rotate(seq, start, strand):
+    if strand == '-':
+        seq = reverse_complement(seq)
+    return seq[start:] + seq[:start]
+
+
+# fix_start() writes 'infile' with every contig rotated to its start gene to '<prefix>.fasta', and a tab-separated
+# log of what was done to each contig to '<prefix>.log'. Returns the output path.
+def fix_start(infile, db_file, prefix, min_id=70.0, prodigal_path='prodigal'):
+    work_dir = os.path.dirname(os.path.abspath(prefix))
+    if db_file is None or not os.path.isfile(db_file):
+        raise executor.ToolError("Start-site database {0} not found; give one with --dnaA_file (e.g. "
+                                 "db/dnaA_and_plasmid_startSites.fasta)".format(db_file))
+    index = load_index(db_file, work_dir)
+    records = []
+    with open(prefix + '.log', 'w') as log:
+        log.write('contig\tlength\taction\tgene\tstrand\tstart\tidentity\n')
+        for name, seq in read_fasta(infile):
+            hit = find_start_gene(seq, index, min_id) if seq else None
+            if hit is not None:
+                action = 'start_gene'
+                records.append((name, rotate(seq, hit['start'], hit['strand'])))
+                log.write('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n'.format(name, len(seq), action, hit['gene'],
+                                                                       hit['strand'], hit['start'] + 1,
+                                                                       hit['identity']))
+                continue
+            gene = prodigal_start(seq, prodigal_path, work_dir) if seq else None
+            if gene is not None:
+                records.append((name, rotate(seq, gene[0], gene[1])))
+                log.write('{0}\t{1}\tprodigal_middle_gene\t.\t{2}\t{3}\t.\n'.format(name, len(seq), gene[1],
+                                                                                   gene[0] + 1))
+            else:
+                records.append((name, seq))
+                log.write('{0}\t{1}\tunchanged\t.\t.\t.\t.\n'.format(name, len(seq)))
+    write_fasta(records, prefix + '.fasta')
+    return prefix + '.fasta'
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import os
+import json
+import math
+import shutil
+
+from fasta_io import open_binary
+from read_qc import expected_errors
+
+"""Depth-targeted long-read subsampling"""
+# With '--genome_size', the long reads are cut down to '--target_depth' x before Flye in a single pass over the (plain
+# or gzipped) FASTQ. Each read is scored by its expected number of correct bases, its length less the sum of the
+# per-base error probabilities 10^(-Q/10), and written straight into a spool file for its score bin (quarter-octave
+# bins), while a histogram of bases per bin is kept. Once the input is read, bins are concatenated from the highest
+# score down until the target is reached, so memory use does not depend on the number of reads, and only the last bin
+# used is cut part-way.
+
+REPORT_NAME = "subsample_report.json"
+BINS_PER_OCTAVE = 4
+
+
+def parse_genome_size(genome_size):
+    """Return a genome size such as '5.3m', '2600k' or '5300000' in bases"""
+    text = str(genome_size).strip().lower()
+    multiplier = {'k': 1e3, 'm': 1e6, 'g': 1e9}.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    try:
+        size = int(float(text) * multiplier)
+    except ValueError:
+        raise Exception("Cannot read genome size '{0}'; use e.g. 5.3m or 5300000".format(genome_size))
+    if size <= 0:
+        raise Exception("Genome size must be positive, got '{0}'".format(genome_size))
+    return size
+
+
+def read_score(length, quality):
+    """Expected number of correct bases of a read, from the error probabilities of its base qualities"""
+    return length - expected_errors(quality)
+
+
+def score_bin(score):
+    return int(math.log2(score) * BINS_PER_OCTAVE) if score >= 1 else 0
+
+
+# spool_reads() reads 'reads' once, writing each record to the spool file of its score bin in 'spool_dir'. Returns the
+# bases and reads per bin and the totals.
+def spool_reads(reads, spool_dir):
+    bins = {}
+    handles = {}
+    total_bases = 0
+    total_reads = 0
+    try:
+        with open_binary(reads) as fastq:
+            while True:
+                header = fastq.readline()
+                if not header:
+                    break
+                seq = fastq.readline()
+                plus = fastq.readline()
+                quality = fastq.readline()
+                length = len(seq.rstrip())
+                score = score_bin(read_score(length, quality.rstrip()))
+                if score not in handles:
+                    handles[score] = open(os.path.join(spool_dir, 'bin_{0}.fastq'.format(score)), 'wb')
+                    bins[score] = [0, 0]
+                handles[score].write(header + seq + plus + quality)
+                bins[score][0] += length
+                bins[score][1] += 1
+                total_bases += length
+                total_reads += 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return bins, total_bases, total_reads
+
+
+# take_reads() copies reads from a spool file until 'bases' bases have been copied. Returns (bases, reads) copied.
+def take_reads(spool_file, out, bases):
+    copied_bases = 0
+    copied_reads = 0
+    with open(spool_file, 'rb') as spool:
+        while copied_bases < bases:
+            record = [spool.readline() for _ in range(4)]
+            if not record[0]:
+                break
+            out.write(b''.join(record))
+            copied_bases += len(record[1].rstrip())
+            copied_reads += 1
+    return copied_bases, copied_reads
+
+
+def subsample_reads(reads, outfile, genome_size, target_depth):
+    """Write the best reads up to 'target_depth' x of 'genome_size' bases to 'outfile'; returns the report dict"""
+    outdir = os.path.dirname(os.path.abspath(outfile))
+    spool_dir = os.path.join(outdir, 'spool')
+    os.makedirs(spool_dir, exist_ok=True)
+    target_bases = int(genome_size * target_depth)
+    try:
+        bins, total_bases, total_reads = spool_reads(reads, spool_dir)
+        kept_bases = 0
+        kept_reads = 0
+        min_score_bin = None
+        with open(outfile + '.tmp', 'wb') as out:
+            for score in sorted(bins, reverse=True):
+                if kept_bases >= target_bases:
+                    break
+                spool_file = os.path.join(spool_dir, 'bin_{0}.fastq'.format(score))
+                if kept_bases + bins[score][0] <= target_bases:
+                    with open(spool_file, 'rb') as spool:
+                        shutil.copyfileobj(spool, out, 1 << 20)
+                    copied = bins[score]
+                else:
+                    copied = take_reads(spool_file, out, target_bases - kept_bases)
+                kept_bases += copied[0]
+                kept_reads += copied[1]
+                min_score_bin = score
+        os.replace(outfile + '.tmp', outfile)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    report = {'genome_size': genome_size, 'target_depth': target_depth,
+              'input_bases': total_bases, 'input_reads': total_reads,
+              'input_depth': round(total_bases / float(genome_size), 2),
+              'kept_bases': kept_bases, 'kept_reads': kept_reads,
+              'kept_depth': round(kept_bases / float(genome_size), 2),
+              'discarded_bases': total_bases - kept_bases, 'discarded_reads': total_reads - kept_reads,
+              'discarded_depth': round((total_bases - kept_bases) / float(genome_size), 2),
+              'min_expected_correct_bases': int(2 ** (float(min_score_bin) / BINS_PER_OCTAVE))
+              if min_score_bin is not None else 0}
+    with open(os.path.join(outdir, REPORT_NAME), 'w') as handle:
+        json.dump(report, handle, indent=2, sort_keys=True)
+    print("Long reads: {0} reads at {1}x in; kept {2} reads at {3}x, discarded {4} reads at {5}x".format(
+        total_reads, report['input_depth'], kept_reads, report['kept_depth'], report['discarded_reads'],
+        report['discarded_depth']))
+    return report
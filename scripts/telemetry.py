@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import shlex
+import resource
+import threading
+import subprocess
+from contextlib import contextmanager
+
+import executor
+
+"""Per-command resource telemetry"""
+# Every external tool is started through telemetry.Popen/telemetry.run, which reap the child with os.wait4() to get its
+# wall time, user/system CPU, peak RSS and block I/O (for shell pipelines, of the whole pipeline) along with the exit
+# status. Commands are attributed to the stage running in the calling thread and appended to run_metrics.json and
+# run_metrics.tsv in the sample's output directory, next to a per-stage summary. '--progress' adds a live status line.
+# Commands are also supervised by executor.py: stderr goes to the stage's log file, and a command that fails (unless
+# started with check=False), times out or is cancelled raises executor.ToolError when it is reaped.
+
+METRICS_JSON = "run_metrics.json"
+METRICS_TSV = "run_metrics.tsv"
+TSV_COLUMNS = ('stage', 'tool', 'exit_status', 'wall_seconds', 'user_seconds', 'system_seconds', 'max_rss_mb',
+               'read_bytes', 'written_bytes', 'started', 'command')
+
+_context = threading.local()
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def exit_status(status):
+    """Return a subprocess-style return code (negative for a signal) from a wait status"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def tool_name(args):
+    """Name of the tool(s) a command runs: the program, or each program of a shell pipeline"""
+    if not isinstance(args, str):
+        return os.path.basename(str(args[0]))
+    tools = []
+    for command in args.replace(';', '|').split('|'):
+        try:
+            words = shlex.split(command)
+        except ValueError:
+            words = command.split()
+        if words and words[0] != 'set':
+            tools.append(os.path.basename(words[0]))
+    return '|'.join(tools)
+
+
+class RunMetrics(object):
+    def __init__(self, outdir):
+        self.json_path = os.path.join(outdir, METRICS_JSON)
+        self.tsv_path = os.path.join(outdir, METRICS_TSV)
+        self.lock = threading.Lock()
+        self.commands = []
+        self.stages = {}
+        self.scratch = {}
+        if os.path.isfile(self.json_path):
+            with open(self.json_path) as handle:
+                data = json.load(handle)
+            self.commands = data.get('commands', [])
+            self.stages = data.get('stages', {})
+            self.scratch = data.get('scratch', {})
+
+    def record_command(self, entry):
+        with self.lock:
+            self.commands.append(entry)
+            self.save()
+        if entry['exit_status'] != 0:
+            sys.stderr.write("Warning: {0} exited with status {1} in stage '{2}'\n".format(
+                entry['tool'], entry['exit_status'], entry['stage']))
+
+    # record_stage() summarises a stage. 'worker_tool_cpu' is the CPU time of tools run by the stage's process pool
+    # workers, which are recorded in the workers' own output directories rather than in this one's commands.
+    def record_stage(self, stage_name, wall, python_cpu, worker_tool_cpu=0.0):
+        with self.lock:
+            commands = [entry for entry in self.commands if entry['stage'] == stage_name]
+            tool_cpu = sum(c['user_seconds'] + c['system_seconds'] for c in commands) + worker_tool_cpu
+            self.stages[stage_name] = {
+                'wall_seconds': round(wall, 2),
+                'python_cpu_seconds': round(python_cpu, 2),
+                'tool_cpu_seconds': round(tool_cpu, 2),
+                'max_rss_mb': max([c['max_rss_mb'] for c in commands] or [0]),
+                'commands': len(commands),
+                'failed_commands': len([c for c in commands if c['exit_status'] != 0])}
+            if worker_tool_cpu:
+                self.stages[stage_name]['worker_tool_cpu_seconds'] = round(worker_tool_cpu, 2)
+            self.save()
+
+    def record_shared(self, stage_name, cpu_seconds, source):
+        """Add this sample's share of the tool CPU time of a step run for several samples at once ('source')"""
+        with self.lock:
+            summary = self.stages.setdefault(stage_name, {'wall_seconds': 0.0, 'python_cpu_seconds': 0.0,
+                                                          'tool_cpu_seconds': 0.0, 'max_rss_mb': 0, 'commands': 0,
+                                                          'failed_commands': 0})
+            summary['tool_cpu_seconds'] = round(summary['tool_cpu_seconds'] + cpu_seconds, 2)
+            summary['shared_tool_cpu_seconds'] = round(cpu_seconds, 2)
+            summary['shared_with'] = source
+            self.save()
+
+    def record_scratch(self, path, peak_bytes):
+        with self.lock:
+            self.scratch = {'path': path, 'peak_bytes': peak_bytes}
+            self.save()
+
+    def save(self):
+        with open(self.json_path + '.tmp', 'w') as handle:
+            json.dump({'commands': self.commands, 'stages': self.stages, 'scratch': self.scratch}, handle, indent=2,
+                      sort_keys=True)
+        os.replace(self.json_path + '.tmp', self.json_path)
+        with open(self.tsv_path, 'w') as tsv:
+            tsv.write('\t'.join(TSV_COLUMNS) + '\n')
+            for entry in self.commands:
+                tsv.write('\t'.join(str(entry[column]) for column in TSV_COLUMNS) + '\n')
+
+
+def metrics_for(outdir):
+    """Return the shared RunMetrics of an output directory"""
+    key = os.path.abspath(outdir)
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = RunMetrics(key)
+        return _registry[key]
+
+
+def release(outdir):
+    """Forget the RunMetrics of 'outdir' and of every output directory below it (e.g. per-contig jobs)"""
+    key = os.path.abspath(outdir)
+    with _registry_lock:
+        for path in [path for path in _registry if path == key or path.startswith(key + os.sep)]:
+            del _registry[path]
+
+
+# share_stage() splits the tool CPU time of 'stage_name' in 'outdir', a step run once for several samples, between
+# the samples' own stages. 'shares' lists (sample outdir, stage name, weight) tuples.
+def share_stage(outdir, stage_name, shares):
+    cpu_seconds = metrics_for(outdir).stages.get(stage_name, {}).get('tool_cpu_seconds', 0.0)
+    total = float(sum(weight for sample_outdir, sample_stage, weight in shares)) or 1.0
+    for sample_outdir, sample_stage, weight in shares:
+        metrics_for(sample_outdir).record_shared(sample_stage, cpu_seconds * weight / total, os.path.abspath(outdir))
+
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def thread_cpu_seconds():
+    return cpu_seconds(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF))
+
+
+class WorkerCpu(object):
+    """CPU seconds spent for a stage outside its own thread: in thread pool threads and process pool workers"""
+
+    def __init__(self):
+        self.python_seconds = 0.0
+        self.tool_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, python_seconds, tool_seconds=0.0):
+        with self.lock:
+            self.python_seconds += python_seconds
+            self.tool_seconds += tool_seconds
+
+
+# stage_context() attributes the commands started by the calling thread to 'stage_name' of the sample in 'outdir', and
+# records the stage's wall time and in-process CPU time when it ends. The in-process CPU time is that of the calling
+# thread plus what its in_current_stage() threads and measured() process pool calls report. Commands started after
+# 'timeout' seconds, or still running then, are stopped.
+@contextmanager
+def stage_context(outdir, stage_name, label=None, timeout=None):
+    metrics = metrics_for(outdir)
+    previous = getattr(_context, 'stage', None)
+    previous_run = getattr(_context, 'run', None)
+    previous_workers = getattr(_context, 'workers', None)
+    _context.stage = (metrics, stage_name)
+    _context.run = (os.path.abspath(outdir), stage_name, time.time() + timeout if timeout else None)
+    _context.workers = workers = WorkerCpu()
+    start = time.time()
+    cpu_start = thread_cpu_seconds()
+    progress_key = progress.start(label, stage_name)
+    try:
+        yield metrics
+    finally:
+        progress.stop(progress_key)
+        _context.stage = previous
+        _context.run = previous_run
+        _context.workers = previous_workers
+        metrics.record_stage(stage_name, time.time() - start,
+                             thread_cpu_seconds() - cpu_start + workers.python_seconds, workers.tool_seconds)
+
+
+def in_current_stage(function):
+    """Wrap 'function' so that commands it starts in another thread (e.g. a thread pool) belong to the calling stage,
+    and the thread's CPU time is counted in the stage's"""
+    stage = getattr(_context, 'stage', None)
+    run = getattr(_context, 'run', None)
+    workers = getattr(_context, 'workers', None)
+
+    def wrapper(*args, **kwargs):
+        _context.stage = stage
+        _context.run = run
+        _context.workers = workers
+        cpu_start = thread_cpu_seconds()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if workers is not None:
+                workers.add(thread_cpu_seconds() - cpu_start)
+            _context.stage = None
+            _context.run = None
+            _context.workers = None
+    return wrapper
+
+
+# measured() is submitted to a process pool in place of 'function': it runs function(*args) in the worker and returns
+# the result with the CPU time the worker spent on it, its own and that of the tools it ran (which the worker reaps,
+# so they show up in its RUSAGE_CHILDREN). The calling stage collects both with worker_result().
+def measured(function, *args):
+    python_start = cpu_seconds(resource.RUSAGE_SELF)
+    tools_start = cpu_seconds(resource.RUSAGE_CHILDREN)
+    result = function(*args)
+    return (result, cpu_seconds(resource.RUSAGE_SELF) - python_start,
+            cpu_seconds(resource.RUSAGE_CHILDREN) - tools_start)
+
+
+def worker_result(future):
+    """The result of a measured() call, whose CPU time is added to the calling thread's stage"""
+    result, python_seconds, tool_seconds = future.result()
+    workers = getattr(_context, 'workers', None)
+    if workers is not None:
+        workers.add(python_seconds, tool_seconds)
+    return result
+
+
+class Popen(subprocess.Popen):
+    """subprocess.Popen whose wait() reaps the child with os.wait4(), records its resource use and raises
+    executor.ToolError if it failed (unless 'check' is False), timed out or was cancelled"""
+
+    def __init__(self, args, check=True, **kwargs):
+        self.telemetry_stage = getattr(_context, 'stage', None)
+        self.telemetry_start = time.time()
+        self.check = check
+        self.watch = None
+        run = getattr(_context, 'run', None)
+        if run is None:
+            super(Popen, self).__init__(args, **kwargs)
+            return
+        sample, stage_name, deadline = run
+        supervisor = executor.supervisor()
+        supervisor.check_startable(sample, stage_name, deadline)
+        kwargs.setdefault('start_new_session', True)
+        stderr_fd = None
+        if kwargs.get('stderr') is None:
+            stderr_fd, kwargs['stderr'] = os.pipe()
+        try:
+            super(Popen, self).__init__(args, **kwargs)
+        except BaseException:
+            if stderr_fd is not None:
+                os.close(stderr_fd)
+            raise
+        finally:
+            if stderr_fd is not None:
+                os.close(kwargs['stderr'])
+        command = args if isinstance(args, str) else ' '.join(str(arg) for arg in args)
+        self.watch = supervisor.watch(self.pid, sample, stage_name, tool_name(args), command, stderr_fd,
+                                      executor.stage_log_path(sample, stage_name), deadline)
+
+    def wait(self, timeout=None):
+        if self.returncode is None and timeout is None:
+            try:
+                pid, status, usage = os.wait4(self.pid, 0)
+            except ChildProcessError:
+                return super(Popen, self).wait()
+            self.reaped(status, usage)
+        return super(Popen, self).wait(timeout)
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status, usage = os.wait4(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                return super(Popen, self).poll()
+            if pid == 0:
+                return None
+            self.reaped(status, usage)
+        return self.returncode
+
+    def reaped(self, status, usage):
+        self.returncode = exit_status(status)
+        self.record(usage)
+        if self.watch is not None:
+            failure = executor.supervisor().finish(self.watch, self.returncode, self.check)
+            if failure is not None and (self.check or self.watch.reason is not None):
+                raise executor.ToolError(failure)
+        elif self.check and self.returncode != 0:
+            raise executor.ToolError("{0} exited with status {1}".format(tool_name(self.args), self.returncode))
+
+    def record(self, usage):
+        if self.telemetry_stage is None:
+            return
+        metrics, stage_name = self.telemetry_stage
+        metrics.record_command({
+            'stage': stage_name,
+            'tool': tool_name(self.args),
+            'command': self.args if isinstance(self.args, str) else ' '.join(str(arg) for arg in self.args),
+            'exit_status': self.returncode,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.telemetry_start)),
+            'wall_seconds': round(time.time() - self.telemetry_start, 3),
+            'user_seconds': round(usage.ru_utime, 3),
+            'system_seconds': round(usage.ru_stime, 3),
+            'max_rss_mb': round(usage.ru_maxrss / 1024.0, 1),  # ru_maxrss is in KB on Linux
+            'read_bytes': usage.ru_inblock * 512,
+            'written_bytes': usage.ru_oublock * 512})
+
+
+def run(args, check=True, **kwargs):
+    """Instrumented equivalent of subprocess.run(check=True) (without 'input' and 'timeout')"""
+    with Popen(args, check=check, **kwargs) as process:
+        stdout, stderr = process.communicate()
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+# Progress keeps the stages currently running (across samples in batch mode) and, once enabled, redraws a single
+# status line on stderr every second.
+class Progress(object):
+    def __init__(self):
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counter = 0
+
+    def enable(self, interval=1.0):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.draw, args=(interval,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def start(self, label, stage_name):
+        with self.lock:
+            self.counter += 1
+            self.active[self.counter] = (label, stage_name, time.time())
+            return self.counter
+
+    def stop(self, key):
+        with self.lock:
+            self.active.pop(key, None)
+
+    def line(self):
+        now = time.time()
+        with self.lock:
+            entries = sorted(self.active.values(), key=lambda entry: entry[2])
+        parts = []
+        for label, stage_name, start in entries:
+            elapsed = int(now - start)
+            name = "{0}:{1}".format(label, stage_name) if label else stage_name
+            parts.append("{0} {1:02d}:{2:02d}:{3:02d}".format(name, elapsed // 3600, elapsed // 60 % 60, elapsed % 60))
+        return "[progress] " + (" | ".join(parts) if parts else "idle")
+
+    def draw(self, interval):
+        while True:
+            sys.stderr.write("\r\033[K" + self.line())
+            sys.stderr.flush()
+            time.sleep(interval)
+
+
+progress = Progress()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import sys
+
+"""Streaming variant filtering and consensus for fix_repeats"""
+# Reads 'bcftools call' VCF output once, applies the site filters of 'vcfutils.pl varFilter' and the AF1 > 0.9 allele
+# frequency filter, and applies the surviving variants to the region sequences held in memory, in place of the
+# varFilter | filter_vcf | bgzip | tabix | vcf-consensus chain.
+
+# Defaults of 'vcfutils.pl varFilter'. The pipeline runs it with '-w 0 -W 0', which switches off its window based
+# filters around indels; overlapping variants are instead resolved when the consensus is applied.
+VARFILTER_DEFAULTS = {
+    'min_depth': 2,               # -d
+    'max_depth': 10000000,        # -D
+    'min_alt_bases': 2,           # -a
+    'min_mapping_quality': 10,    # -Q
+    'pv4_thresholds': (1e-4, 1e-100, 0, 1e-4),  # -1 strand, -2 baseQ, -3 mapQ, -4 end distance bias
+}
+
+MIN_ALLELE_FREQUENCY = 0.9
+
+
+class Variant(object):
+    def __init__(self, chrom, pos, ref, alts, qual, info, genotype):
+        self.chrom = chrom
+        self.pos = pos
+        self.ref = ref
+        self.alts = alts
+        self.qual = qual
+        self.info = info
+        self.genotype = genotype
+
+    def allele(self):
+        """The allele to apply: the called haploid genotype if there is one, otherwise the first ALT allele"""
+        if self.genotype is not None:
+            index = self.genotype.replace('|', '/').split('/')[0]
+            if index.isdigit():
+                index = int(index)
+                return self.ref if index == 0 else self.alts[index - 1] if index <= len(self.alts) else None
+        return self.alts[0]
+
+    def end(self):
+        return self.pos + len(self.ref) - 1
+
+
+def parse_info(info_field):
+    info = {}
+    for item in info_field.split(';'):
+        key, sep, value = item.partition('=')
+        info[key] = value if sep else True
+    return info
+
+
+def parse_record(line):
+    fields = line.rstrip('\n').split('\t')
+    genotype = None
+    if len(fields) > 9:
+        format_keys = fields[8].split(':')
+        if 'GT' in format_keys:
+            values = fields[9].split(':')
+            index = format_keys.index('GT')
+            genotype = values[index] if index < len(values) else None
+    qual = float(fields[5]) if fields[5] != '.' else 0.0
+    return Variant(fields[0], int(fields[1]), fields[3], fields[4].split(','), qual, parse_info(fields[7]), genotype)
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+# passes_varfilter() applies the per-site rules of 'vcfutils.pl varFilter': depth from DP (or DP4), the number of
+# reads supporting the alternative allele from DP4, the RMS mapping quality MQ and the PV4 bias P-values.
+def passes_varfilter(variant, options=VARFILTER_DEFAULTS):
+    if variant.alts == ['.'] or variant.ref == 'N':
+        return False
+    depth = -1
+    alt_depth = -1
+    if 'DP4' in variant.info:
+        dp4 = int_list(variant.info['DP4'])
+        depth = sum(dp4)
+        alt_depth = dp4[2] + dp4[3]
+    if 'DP' in variant.info:
+        depth = int(variant.info['DP'])
+    if depth >= 0 and (depth < options['min_depth'] or depth > options['max_depth']):
+        return False
+    if 0 <= alt_depth < options['min_alt_bases']:
+        return False
+    if 'MQ' in variant.info and 0 <= int(float(variant.info['MQ'])) < options['min_mapping_quality']:
+        return False
+    if 'PV4' in variant.info:
+        for value, threshold in zip(variant.info['PV4'].split(','), options['pv4_thresholds']):
+            if value != '.' and float(value) < threshold:
+                return False
+    return True
+
+
+def passes_allele_frequency(variant, min_frequency=MIN_ALLELE_FREQUENCY):
+    """Keep only alleles called at a high frequency (the AF1 filter of fix_repeats.filter_vcf)"""
+    return 'AF1' in variant.info and float(variant.info['AF1']) > min_frequency
+
+
+# read_variants() streams VCF lines and returns the variants passing both filters, grouped by sequence name.
+def read_variants(lines):
+    variants = {}
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        variant = parse_record(line)
+        if passes_varfilter(variant) and passes_allele_frequency(variant):
+            variants.setdefault(variant.chrom, []).append(variant)
+    return variants
+
+
+# apply_variants() returns 'seq' with the variants applied, following vcf-consensus: variants are applied in position
+# order, a variant overlapping one that has already been applied is skipped, as are variants whose REF allele does not
+# match the sequence, symbolic or spanning-deletion alleles and sites genotyped as the reference allele.
+def apply_variants(name, seq, variants):
+    pieces = []
+    last = 0
+    applied_end = 0
+    for variant in sorted(variants, key=lambda v: (v.pos, -v.qual)):
+        start = variant.pos - 1
+        allele = variant.allele()
+        if allele is None or allele == variant.ref or allele == '*' or allele.startswith('<'):
+            continue
+        if variant.pos <= applied_end:
+            sys.stderr.write("Skipping variant at {0}:{1}, it overlaps a variant that was already applied\n".format(
+                name, variant.pos))
+            continue
+        if seq[start:start + len(variant.ref)].upper() != variant.ref.upper():
+            sys.stderr.write("Skipping variant at {0}:{1}, REF {2} does not match the sequence\n".format(
+                name, variant.pos, variant.ref))
+            continue
+        pieces.append(seq[last:start])
+        pieces.append(allele)
+        last = start + len(variant.ref)
+        applied_end = variant.end()
+    pieces.append(seq[last:])
+    return ''.join(pieces)
+
+
+def apply_consensus(sequences, variants):
+    """Apply 'variants' (from read_variants) to a dict of name -> sequence; returns a new dict"""
+    return dict((name, apply_variants(name, seq, variants.get(name, []))) for name, seq in sequences.items())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The pipeline modules live in scripts/ and import each other by name.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
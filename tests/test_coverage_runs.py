@@ -0,0 +1,86 @@
+import random
+
+from coverage_runs import Coverage, read_coverage
+
+
+# per_base_regions() is the per-base scan of the original fix_repeats.correct_regions().
+def per_base_regions(depths, cutoff, read_length):
+    regions = []
+    minval = None
+    maxval = None
+    for pos, depth in enumerate(depths):
+        if depth < cutoff:
+            if minval is None and pos > read_length:
+                minval = pos - read_length
+            if minval is not None:
+                maxval = pos
+        elif maxval is not None and pos > maxval + 2 * read_length:
+            regions.append((minval, maxval + read_length))
+            minval = None
+            maxval = None
+    return regions
+
+
+def random_depths(generator, length):
+    """Per-base depths made of runs, with dips below the cutoff of varying length and spacing"""
+    depths = []
+    while len(depths) < length:
+        depth = generator.choice((0, 1, 3, 5, 20, 30, 40))
+        depths.extend([depth] * generator.randint(1, 120))
+    return depths[:length]
+
+
+def coverage_of(depths, name='contig'):
+    coverage = Coverage()
+    for pos, depth in enumerate(depths):
+        coverage.contig(name).add_run(pos, pos + 1, depth)
+    return coverage
+
+
+def test_low_coverage_regions_match_per_base_scan():
+    generator = random.Random(7)
+    for trial in range(300):
+        depths = random_depths(generator, generator.randint(1, 3000))
+        cutoff = generator.choice((2, 4, 10))
+        read_length = generator.choice((1, 10, 50, 150))
+        regions = coverage_of(depths).low_coverage_regions(cutoff, read_length)['contig']
+        assert regions == per_base_regions(depths, cutoff, read_length), (trial, cutoff, read_length)
+
+
+def test_low_coverage_region_edge_cases():
+    for depths, expected in (([0] * 50 + [30] * 500, []),
+                             ([30] * 100 + [0] * 10 + [30] * 300, [(50, 159)]),
+                             ([30] * 100 + [0] * 10 + [30] * 100, []),
+                             ([30] * 100 + [0] * 10 + [30] * 60 + [0] * 10 + [30] * 300, [(50, 229)])):
+        assert per_base_regions(depths, 5, 50) == expected
+        assert coverage_of(depths).low_coverage_regions(5, 50)['contig'] == expected
+
+
+def test_median_matches_sorted_per_base_depths():
+    generator = random.Random(11)
+    for trial in range(50):
+        depths = random_depths(generator, generator.randint(1, 2000))
+        coverage = coverage_of(depths[:len(depths) // 2], 'a')
+        for pos, depth in enumerate(depths[len(depths) // 2:]):
+            coverage.contig('b').add_run(pos, pos + 1, depth)
+        ordered = sorted(depths)
+        assert coverage.median() == ordered[min(round(len(ordered) / 2), len(ordered) - 1)]
+
+
+def test_any_below():
+    coverage = coverage_of([30] * 10 + [2] * 5 + [30] * 10)
+    contig = coverage.contigs['contig']
+    assert contig.any_below(5, 0, 11)
+    assert not contig.any_below(5, 0, 10)
+    assert not contig.any_below(5, 15, 25)
+
+
+def test_bedgraph_and_per_base_files_give_the_same_runs(tmp_path):
+    depths = [4, 4, 4, 0, 0, 7]
+    per_base = tmp_path / 'per_base.cov'
+    per_base.write_text(''.join("tig\t{0}\t{1}\n".format(pos + 1, depth) for pos, depth in enumerate(depths)))
+    bedgraph = tmp_path / 'coverage.bedgraph'
+    bedgraph.write_text("track type=bedGraph\ntig\t0\t3\t4\ntig\t3\t5\t0\ntig\t5\t6\t7\n")
+    for path in (per_base, bedgraph):
+        runs = list(read_coverage(str(path)).contigs['tig'].runs())
+        assert runs == [(0, 3, 4), (3, 5, 0), (5, 6, 7)]
@@ -0,0 +1,27 @@
+import io
+import threading
+import collections
+
+from executor import StderrProtocol
+
+
+class FakeWatch(object):
+    def __init__(self):
+        self.log = io.BytesIO()
+        self.log.close = lambda: None
+        self.tail = collections.deque(maxlen=3)
+        self.drained = threading.Event()
+
+
+def test_stderr_tail_keeps_lines_split_across_reads():
+    watch = FakeWatch()
+    protocol = StderrProtocol(watch)
+    for chunk in (b'[M::main] Ver', b'sion: 0.7.17\n[E::bwa_idx_load] fail to locate the', b' index\r', b'\n'):
+        protocol.data_received(chunk)
+    assert list(watch.tail) == ['[M::main] Version: 0.7.17', '[E::bwa_idx_load] fail to locate the index']
+    for chunk in (b'12%\r50%\r', b'caf\xc3', b'\xa9 done\nno newline at the end'):
+        protocol.data_received(chunk)
+    assert list(watch.tail) == ['12%', '50%', 'caf\xe9 done']
+    protocol.connection_lost(None)
+    assert list(watch.tail) == ['50%', 'caf\xe9 done', 'no newline at the end']
+    assert watch.log.getvalue().endswith(b'no newline at the end') and watch.drained.is_set()
@@ -0,0 +1,30 @@
+import io
+import shlex
+
+import fix_repeats
+
+
+class FakeProcess(object):
+    def __init__(self, stdout=''):
+        self.stdout = io.StringIO(stdout)
+
+    def wait(self):
+        return 0
+
+
+# The per-region re-polish runs the given bwa, and every path survives the shell even with spaces in it.
+def test_call_consensus_uses_bwa_path_and_quotes_paths(tmp_path, monkeypatch):
+    commands = []
+    monkeypatch.setattr(fix_repeats.telemetry, 'run', lambda args, **kwargs: commands.append(args))
+    monkeypatch.setattr(fix_repeats.telemetry, 'Popen',
+                        lambda args, **kwargs: commands.append(args) or FakeProcess())
+    work_dir = str(tmp_path / 'fix repeats')
+    reads = str(tmp_path / 'pe reads.fastq')
+    result = fix_repeats.call_consensus(work_dir, reads, '2', {'region_1': 'ACGT'}, bwa_path='/opt/my tools/bwa')
+    assert result == {'region_1': 'ACGT'}
+    assert commands[0] == ['/opt/my tools/bwa', 'index', work_dir + '/ref.fa']
+    assert commands[1] == ['samtools', 'faidx', work_dir + '/ref.fa']
+    assert shlex.split(commands[2])[3:5] == ['/opt/my tools/bwa', 'mem']
+    assert work_dir + '/ref.fa' in shlex.split(commands[2]) and reads in shlex.split(commands[2])
+    assert commands[3] == ['samtools', 'index', work_dir + '/ref.sort.bam']
+    assert work_dir + '/ref.sort.bam' in shlex.split(commands[4])
@@ -0,0 +1,71 @@
+import gzip
+
+from interleave import interleave_reads, normalise_header
+from read_qc import read_stats, pair_key
+from realign import read_name
+
+
+def write_reads(path, headers):
+    with gzip.open(str(path), 'wt') as fastq:
+        for header in headers:
+            fastq.write("{0}\nACGTACGTAC\n+\nIIIIIIIIII\n".format(header))
+
+
+def round_trip(tmp_path, r1_headers, r2_headers):
+    r1 = tmp_path / 'sample_R1.fq.gz'
+    r2 = tmp_path / 'sample_R2.fq.gz'
+    write_reads(r1, r1_headers)
+    write_reads(r2, r2_headers)
+    out_path = str(tmp_path / 'scratch' / 'pe_reads_interleaved.fastq.gz')
+    assert interleave_reads(str(r1), str(r2), out_path) == len(r1_headers)
+    stats = read_stats(out_path, paired=True)
+    with gzip.open(out_path, 'rb') as fastq:
+        headers = [line for number, line in enumerate(fastq) if number % 4 == 0]
+    assert_names_survive_alignment(headers)
+    return stats, [header.rstrip().decode() for header in headers]
+
+
+# The aligners report a read by the first word of its name less a trailing /1 or /2 (bwa mem's trim_readno): every
+# interleaved read must keep its FASTQ name as its SAM QNAME, distinct from its mate's, and still pair up from it.
+def assert_names_survive_alignment(headers):
+    for header_1, header_2 in zip(headers[::2], headers[1::2]):
+        qname_1, qname_2 = read_name(header_1), read_name(header_2)
+        assert (qname_1, qname_2) == (header_1[1:].rstrip(), header_2[1:].rstrip())
+        assert qname_1 != qname_2
+        assert pair_key(b'@' + qname_1)[0] == pair_key(b'@' + qname_2)[0]
+
+
+def test_slash_mate_names_with_comments(tmp_path):
+    stats, headers = round_trip(tmp_path, ['@read{0}/1 length=10'.format(i) for i in range(3)],
+                                ['@read{0}/2 length=10'.format(i) for i in range(3)])
+    assert stats['errors'] == [] and stats['pairs'] == 3 and stats['whitespace_headers'] == 0
+    assert headers[:2] == ['@read0/1_length=10', '@read0/2_length=10']
+
+
+def test_slash_mate_names_without_comments(tmp_path):
+    stats, headers = round_trip(tmp_path, ['@read{0}/1'.format(i) for i in range(3)],
+                                ['@read{0}/2'.format(i) for i in range(3)])
+    assert stats['errors'] == [] and stats['pairs'] == 3
+    assert headers[:2] == ['@read0_1', '@read0_2']
+
+
+def test_casava_mate_names(tmp_path):
+    stats, headers = round_trip(tmp_path, ['@M0:1:FC:1:1:{0}:1 1:N:0:ACGT'.format(i) for i in range(3)],
+                                ['@M0:1:FC:1:1:{0}:1 2:N:0:ACGT'.format(i) for i in range(3)])
+    assert stats['errors'] == [] and stats['pairs'] == 3
+    assert headers[:2] == ['@M0:1:FC:1:1:0:1_1:N:0:ACGT', '@M0:1:FC:1:1:0:1_2:N:0:ACGT']
+
+
+def test_mates_without_a_mate_tag_get_one(tmp_path):
+    stats, headers = round_trip(tmp_path, ['@read{0} sample=x'.format(i) for i in range(2)],
+                                ['@read{0} sample=x'.format(i) for i in range(2)])
+    assert stats['errors'] == []
+    assert headers[:2] == ['@read0_sample=x_1', '@read0_sample=x_2']
+
+
+def test_pair_key_accepts_mate_tags_before_comments_and_after_underscores():
+    assert pair_key(b'@read7/1_length=10\n') == (b'read7', '1')
+    assert pair_key(b'@read7/2\n') == (b'read7', '2')
+    assert pair_key(b'@read7_2\n') == (b'read7', '2')
+    assert pair_key(b'@read7/12\n') == (b'read7/12', None)
+    assert normalise_header(b'@read7/1  length=10\n') == b'@read7/1_length=10\n'
@@ -0,0 +1,25 @@
+import sys
+import subprocess
+
+import executor
+import telemetry
+from polish_profile import stage_cost
+
+# Busy-loops for 0.3 s of CPU time.
+BURN = "import time\nstart = time.process_time()\nwhile time.process_time() - start < 0.3:\n    pass\n"
+
+
+def test_stage_cost_includes_process_pool_workers(tmp_path):
+    outdir = str(tmp_path)
+    with telemetry.stage_context(outdir, 'per_contig_polish'):
+        with executor.process_pool(2) as pool:
+            futures = [pool.submit(telemetry.measured, subprocess.call, [sys.executable, '-c', BURN]),
+                       pool.submit(telemetry.measured, exec, BURN)]
+            assert [telemetry.worker_result(future) for future in futures] == [0, None]
+    summary = telemetry.metrics_for(outdir).stages['per_contig_polish']
+    assert summary['worker_tool_cpu_seconds'] >= 0.3
+    assert summary['python_cpu_seconds'] >= 0.3
+    telemetry.release(outdir)
+    cpu_seconds, wall_seconds = stage_cost(outdir, 'per_contig_polish')
+    assert cpu_seconds >= 0.6
+    assert cpu_seconds == round(summary['tool_cpu_seconds'] + summary['python_cpu_seconds'], 2)
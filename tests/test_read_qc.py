@@ -0,0 +1,34 @@
+from read_qc import HQ_QUALITY, derive_parameters, expected_errors, read_stats
+
+
+def write_reads(path, qualities):
+    with open(str(path), 'w') as fastq:
+        for number, quality in enumerate(qualities):
+            fastq.write("@read{0}\n{1}\n+\n{2}\n".format(number, 'A' * len(quality), quality))
+    return str(path)
+
+
+def stats_with_quality(mean_quality):
+    return {'n50': 10000, 'mean_quality': mean_quality, 'max_length': 150}
+
+
+def test_expected_errors():
+    assert abs(expected_errors(b'+5') - 0.11) < 1e-9
+    assert abs(expected_errors(b'!') - 1.0) < 1e-9
+
+
+def test_mean_quality_averages_error_probabilities(tmp_path):
+    stats = read_stats(write_reads(tmp_path / 'uniform.fastq', ['0' * 100]))
+    assert stats['mean_quality'] == 15.0
+    # Q30 and Q5 bases average to Q17.5 as Phred scores, but to a 15.9% error rate (Q8)
+    stats = read_stats(write_reads(tmp_path / 'uneven.fastq', ['?' * 50 + '&' * 50]))
+    assert stats['mean_quality'] == 8.0
+
+
+def test_flye_mode_at_the_q15_boundary(tmp_path):
+    assert HQ_QUALITY == 15.0
+    assert derive_parameters(stats_with_quality(15.0), stats_with_quality(35.0))['flye_mode'] == 'nano-hq'
+    assert derive_parameters(stats_with_quality(14.99), stats_with_quality(35.0))['flye_mode'] == 'nano-raw'
+    for qualities, mode in ((['0' * 100], 'nano-hq'), (['/' * 100], 'nano-raw'), (['?' * 50 + '&' * 50], 'nano-raw')):
+        long_stats = read_stats(write_reads(tmp_path / 'long.fastq', qualities))
+        assert derive_parameters(long_stats, stats_with_quality(35.0))['flye_mode'] == mode
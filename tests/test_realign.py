@@ -0,0 +1,79 @@
+import random
+
+from realign import contig_map, lift_sam_record, lift_paf_record, reverse_complement
+
+
+def random_sequence(length, seed=1):
+    generator = random.Random(seed)
+    return ''.join(generator.choice('ACGT') for _ in range(length))
+
+
+def sam(name, flag, pos, cigar, seq, mate_pos=0, tlen=0, contig='tig', tags=''):
+    mate = ('=' if mate_pos else '*') if flag & 0x1 else '*'
+    line = '\t'.join((name, str(flag), contig, str(pos), '60', cigar, mate, str(mate_pos), str(tlen), seq,
+                      'I' * len(seq))) + (('\t' + tags) if tags else '')
+    return (line + '\n').encode()
+
+
+def fields(line):
+    return line.rstrip(b'\n').decode().split('\t')
+
+
+OLD = random_sequence(6000)
+# a 5 bp insertion at 2000 and a 3 bp deletion at 4000 (old coordinates)
+NEW = OLD[:2000] + 'GATTA' + OLD[2000:4000] + OLD[4003:]
+
+
+def test_lift_sam_across_indels():
+    maps = {'tig': contig_map(OLD, NEW)}
+    before = lift_sam_record(sam('r1', 0, 101, '100M', OLD[100:200]), maps)
+    assert fields(before)[3] == '101'
+    between = lift_sam_record(sam('r2', 16, 3001, '50M2I48M', OLD[3000:3100]), maps)
+    assert fields(between)[3] == '3006'
+    after = lift_sam_record(sam('r3', 0, 5001, '100M', OLD[5000:5100]), maps)
+    assert fields(after)[3] == '5003'
+    lifted = fields(after)
+    assert NEW[int(lifted[3]) - 1:int(lifted[3]) - 1 + 100] == lifted[9]
+
+
+def test_records_overlapping_an_edit_are_realigned():
+    maps = {'tig': contig_map(OLD, NEW)}
+    assert lift_sam_record(sam('r1', 0, 1951, '100M', OLD[1950:2050]), maps) is None
+    assert lift_sam_record(sam('r2', 0, 3951, '100M', OLD[3950:4050]), maps) is None
+    assert lift_sam_record(sam('r3', 2048, 101, '100M', OLD[100:200]), maps) is None
+    assert lift_sam_record(sam('r4', 0, 101, '100M', OLD[100:200], tags='SA:Z:tig,3000,+,50M,60,0;'), maps) is None
+    assert lift_sam_record(sam('r5', 0, 101, '100M', OLD[100:200], contig='gone'), maps) is None
+    assert lift_sam_record(sam('r6', 4, 0, '*', OLD[100:200], contig='*'), maps) == b''
+
+
+def test_paired_records_move_their_mate_position_and_template_length():
+    maps = {'tig': contig_map(OLD, NEW)}
+    first = fields(lift_sam_record(sam('p', 0x1 | 0x40, 1801, '100M', OLD[1800:1900], 2201, 500), maps))
+    assert (first[3], first[7], first[8]) == ('1801', '2206', '505')
+    # the mate starts in the deleted bases
+    assert lift_sam_record(sam('q', 0x1 | 0x40, 1801, '100M', OLD[1800:1900], 4002, 300), maps) is None
+
+
+def test_lift_across_rotation_and_reverse_complement():
+    rotated = reverse_complement(OLD[2500:] + OLD[:2500])
+    maps = {'tig': contig_map(OLD, rotated)}
+    assert maps['tig'].reverse
+    read = OLD[4000:4030] + OLD[4031:4101]
+    lifted = fields(lift_sam_record(sam('r1', 0, 4001, '30M1D70M', read, tags='NM:i:1\tMD:Z:30^A70'), maps))
+    start = int(lifted[3]) - 1
+    assert lifted[1] == '16' and lifted[5] == '70M1D30M'
+    assert lifted[9] == reverse_complement(read)
+    assert rotated[start:start + 70] == reverse_complement(read)[:70]
+    assert rotated[start + 71:start + 101] == reverse_complement(read)[70:]
+    assert lifted[11:] == ['NM:i:1']
+    # a read spanning the new origin has to be re-aligned
+    assert lift_sam_record(sam('r2', 0, 2451, '100M', OLD[2450:2550]), maps) is None
+
+
+def test_lift_paf_across_indels():
+    maps = {'tig': contig_map(OLD, NEW)}
+    line = '\t'.join(('r1', '100', '0', '100', '+', 'tig', '6000', '3000', '3100', '100', '100', '60', 'cg:Z:100M'))
+    lifted = lift_paf_record((line + '\n').encode(), maps).decode().rstrip('\n').split('\t')
+    assert lifted[6:9] == [str(len(NEW)), '3005', '3105']
+    edited = '\t'.join(('r2', '100', '0', '100', '+', 'tig', '6000', '1990', '2090', '100', '100', '60'))
+    assert lift_paf_record((edited + '\n').encode(), maps) is None
@@ -0,0 +1,14 @@
+import resources
+
+
+def test_explicit_threads_and_memory_are_kept_with_a_warning(monkeypatch, capsys):
+    monkeypatch.setattr(resources, 'detect_cores', lambda: 4)
+    monkeypatch.setattr(resources, 'detect_memory', lambda: 16.0)
+    assert resources.resolve_threads('auto') == 4
+    assert resources.resolve_threads('2') == 2
+    assert resources.resolve_memory(None) == 16.0
+    assert resources.resolve_memory(8.0) == 8.0
+    assert capsys.readouterr().out == ''
+    assert resources.resolve_threads('8') == 8
+    assert resources.resolve_memory(32.0) == 32.0
+    assert capsys.readouterr().out.count('Warning') == 2
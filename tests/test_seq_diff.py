@@ -0,0 +1,67 @@
+import random
+
+from seq_diff import EditCounts, align_gap, diff_sequences, matching_blocks, diff_assemblies
+
+
+def random_sequence(length, seed=1):
+    generator = random.Random(seed)
+    return ''.join(generator.choice('ACGT') for _ in range(length))
+
+
+def substitute(seq, position):
+    return seq[:position] + ('A' if seq[position] != 'A' else 'C') + seq[position + 1:]
+
+
+def counts(edits):
+    return edits.substitutions, edits.insertions, edits.deletions
+
+
+def test_identical_sequences():
+    seq = random_sequence(20000)
+    assert counts(diff_sequences(seq, seq)) == (0, 0, 0)
+
+
+def test_known_edits():
+    old = random_sequence(20000)
+    new = old
+    for position in (15000, 9000, 3000):
+        new = substitute(new, position)
+    new = new[:12000] + 'GATTACA' + new[12000:]
+    new = new[:6000] + new[6005:]
+    new = new[:500] + 'T' + new[500:]
+    assert counts(diff_sequences(old, new)) == (3, 8, 5)
+
+
+def test_edits_within_one_block_and_at_the_ends():
+    old = random_sequence(5000, seed=2)
+    new = 'C' + substitute(old, 2500)[:-3]
+    assert counts(diff_sequences(old, new)) == (1, 1, 3)
+
+
+def test_align_gap():
+    assert counts(align_gap('ACGT', 'AGGT')) == (1, 0, 0)
+    assert counts(align_gap('ACGT', 'ACGGT')) == (0, 1, 0)
+    assert counts(align_gap('ACGT', 'AT')) == (0, 0, 2)
+    assert counts(align_gap('', 'ACG')) == (0, 3, 0)
+
+
+def test_long_gap_is_counted_without_alignment():
+    assert counts(align_gap('A' * 300, 'C' * 250)) == (250, 0, 50)
+
+
+def test_matching_blocks_cover_unchanged_bases():
+    old = random_sequence(10000, seed=3)
+    new = old[:4000] + 'TTTT' + old[4000:]
+    assert matching_blocks(old, new) == [[0, 0, 4000], [4000, 4004, 6000]]
+
+
+def test_diff_assemblies_counts_missing_and_new_contigs():
+    chromosome = random_sequence(3000, seed=4)
+    plasmid = random_sequence(400, seed=5)
+    edits = diff_assemblies([('chromosome', chromosome), ('plasmid', plasmid)],
+                            [('chromosome', substitute(chromosome, 100)), ('new', 'ACGTACGT')])
+    assert counts(edits['chromosome']) == (1, 0, 0)
+    assert counts(edits['plasmid']) == (0, 0, 400)
+    assert counts(edits['new']) == (0, 8, 0)
+    assert EditCounts(1, 2, 3).add(EditCounts(1, 1, 1)).as_dict() == {'substitutions': 2, 'insertions': 3,
+                                                                      'deletions': 4, 'total': 9}
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+import executor
+from fasta_io import read_fasta, write_fasta
+from start_genes import fix_start, index_path, reverse_complement
+
+random.seed(7)
+GENE = ''.join(random.choice('ACGT') for _ in range(600))
+BACKGROUND = ''.join(random.choice('ACGT') for _ in range(6000))
+# The gene with every other base of its last 240 substituted: 80% identity, with exact seeds at its start.
+DIVERGED = GENE[:360] + ''.join(base if offset % 2 else {'A': 'C', 'C': 'G', 'G': 'T', 'T': 'A'}[base]
+                                for offset, base in enumerate(GENE[360:]))
+
+
+def run_fix_start(tmp_path, contig, gene=GENE, min_id=70.0):
+    write_fasta([('dnaA', gene)], str(tmp_path / 'start_sites.fasta'))
+    write_fasta([('contig_1', contig)], str(tmp_path / 'contigs.fasta'))
+    prefix = str(tmp_path / 'fixstart')
+    fix_start(str(tmp_path / 'contigs.fasta'), str(tmp_path / 'start_sites.fasta'), prefix, min_id,
+              str(tmp_path / 'no_prodigal'))
+    with open(prefix + '.log') as log:
+        fields = log.read().splitlines()[1].split('\t')
+    return read_fasta(prefix + '.fasta')[0][1], fields
+
+
+def test_contig_is_rotated_to_its_start_gene(tmp_path):
+    contig = BACKGROUND[:2500] + GENE + BACKGROUND[2500:]
+    rotated, fields = run_fix_start(tmp_path, contig)
+    assert rotated == GENE + BACKGROUND[2500:] + BACKGROUND[:2500]
+    assert fields[2:7] == ['start_gene', 'dnaA', '+', '2501', '100.0']
+    assert (tmp_path / 'start_sites.fasta.k13.json').exists()
+    assert index_path(str(tmp_path / 'start_sites.fasta'), str(tmp_path)).endswith('start_sites.fasta.k13.json')
+
+
+def test_gene_on_the_reverse_strand_is_reverse_complemented(tmp_path):
+    contig = BACKGROUND[:4000] + reverse_complement(GENE) + BACKGROUND[4000:]
+    rotated, fields = run_fix_start(tmp_path, contig)
+    assert rotated == GENE + reverse_complement(BACKGROUND[:4000]) + reverse_complement(BACKGROUND[4000:])
+    assert fields[2:5] == ['start_gene', 'dnaA', '-']
+
+
+def test_gene_spanning_the_contig_origin(tmp_path):
+    contig = GENE[200:] + BACKGROUND + GENE[:200]
+    rotated, fields = run_fix_start(tmp_path, contig)
+    assert rotated == GENE + BACKGROUND
+    assert fields[5] == str(len(contig) - 200 + 1)
+
+
+def test_start_min_id(tmp_path):
+    contig = BACKGROUND[:2500] + DIVERGED + BACKGROUND[2500:]
+    rotated, fields = run_fix_start(tmp_path, contig, min_id=75.0)
+    assert fields[2] == 'start_gene' and 80.0 <= float(fields[6]) < 81.0
+    assert rotated.startswith(DIVERGED)
+    rotated, fields = run_fix_start(tmp_path, contig, min_id=90.0)
+    assert fields[2] == 'unchanged' and rotated == contig
+
+
+def test_missing_database_is_an_error(tmp_path):
+    write_fasta([('contig_1', BACKGROUND)], str(tmp_path / 'contigs.fasta'))
+    with pytest.raises(executor.ToolError):
+        fix_start(str(tmp_path / 'contigs.fasta'), str(tmp_path / 'missing.fasta'), str(tmp_path / 'fixstart'))
+    assert not (tmp_path / 'fixstart.fasta').exists()
@@ -0,0 +1,49 @@
+import json
+import os
+
+from subsample import REPORT_NAME, read_score, score_bin, subsample_reads
+
+
+def write_reads(path, reads):
+    with open(str(path), 'w') as fastq:
+        for name, quality in reads:
+            fastq.write("@{0}\n{1}\n+\n{2}\n".format(name, 'A' * len(quality), quality))
+    return str(path)
+
+
+def read_names(path):
+    with open(path) as fastq:
+        return [line[1:].rstrip() for number, line in enumerate(fastq) if number % 4 == 0]
+
+
+def test_read_score_sums_error_probabilities():
+    assert abs(read_score(10, b'+' * 10) - 9.0) < 1e-9
+    # Q30 and Q5 bases: 50 * (0.001 + 0.316) expected errors, not those of the arithmetic mean Q17.5
+    assert abs(read_score(100, b'?' * 50 + b'&' * 50) - 84.14) < 0.01
+    assert read_score(0, b'') == 0
+
+
+def test_score_bins_are_quarter_octaves():
+    assert score_bin(0.5) == 0
+    assert score_bin(1000) == 39
+    assert score_bin(2000) == 43
+    assert score_bin(1000) < score_bin(1190) < score_bin(2000)
+
+
+def test_subsample_keeps_the_highest_scoring_bins(tmp_path):
+    # long_uneven (Q30 and Q5 halves) scores 3366 and falls one bin below long_good (3762). Scored from its mean Phred
+    # score, Q17.5, it would score 3929, share the top bin and, coming first, be the read kept.
+    reads = [('long_uneven', '?' * 2000 + '&' * 2000), ('long_good', '5' * 3800), ('short_good', '5' * 1000),
+             ('long_poor', '%' * 4000)]
+    outfile = str(tmp_path / 'subsampled' / 'long_reads.fastq')
+    os.makedirs(os.path.dirname(outfile))
+    report = subsample_reads(write_reads(tmp_path / 'reads.fastq', reads), outfile, 100, 38)
+    assert read_names(outfile) == ['long_good']
+    assert report['kept_bases'] == 3800 and report['discarded_reads'] == 3 and report['input_depth'] == 128.0
+    assert report['min_expected_correct_bases'] == int(2 ** (47 / 4.0))
+    report = subsample_reads(write_reads(tmp_path / 'reads.fastq', reads), outfile, 100, 50)
+    assert read_names(outfile) == ['long_good', 'long_uneven']
+    assert report['kept_bases'] == 7800 and report['kept_reads'] == 2
+    with open(str(tmp_path / 'subsampled' / REPORT_NAME)) as handle:
+        assert json.load(handle)['kept_reads'] == 2
+    assert not os.path.exists(str(tmp_path / 'subsampled' / 'spool'))
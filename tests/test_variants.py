@@ -0,0 +1,67 @@
+from variants import (parse_record, passes_varfilter, passes_allele_frequency, read_variants, apply_variants,
+                      apply_consensus)
+
+
+def record(pos, ref, alt, info, genotype='1', chrom='region_1', qual='50'):
+    return '\t'.join((chrom, str(pos), '.', ref, alt, qual, '.', info, 'GT:PL', genotype + ':90,0')) + '\n'
+
+
+PASSING = 'DP=30;AF1=1;DP4=0,0,15,15;MQ=60'
+
+
+def test_varfilter_keeps_a_well_supported_site():
+    assert passes_varfilter(parse_record(record(10, 'A', 'G', PASSING)))
+
+
+def test_varfilter_site_rules():
+    for info in ('DP=1;AF1=1;DP4=0,0,1,0;MQ=60',            # depth below -d 2
+                 'DP=30;AF1=1;DP4=15,14,1,0;MQ=60',         # one read with the alternative allele, below -a 2
+                 'DP=30;AF1=1;DP4=0,0,15,15;MQ=9',          # mapping quality below -Q 10
+                 'DP=30;AF1=1;DP4=0,0,15,15;MQ=60;PV4=0.00001,1,1,1',   # strand bias
+                 'DP=30;AF1=1;DP4=0,0,15,15;MQ=60;PV4=1,1,1,0.00001'):  # end distance bias
+        assert not passes_varfilter(parse_record(record(10, 'A', 'G', info))), info
+    assert not passes_varfilter(parse_record(record(10, 'A', '.', PASSING)))
+    assert not passes_varfilter(parse_record(record(10, 'N', 'G', PASSING)))
+    # DP takes precedence over the DP4 sum, and a baseQ bias P-value never fails (threshold 1e-100)
+    assert passes_varfilter(parse_record(record(10, 'A', 'G', 'DP=3;AF1=1;DP4=0,0,0,2;MQ=60;PV4=1,1e-50,1,1')))
+
+
+def test_allele_frequency_filter():
+    assert passes_allele_frequency(parse_record(record(10, 'A', 'G', 'DP=30;AF1=0.95')))
+    assert not passes_allele_frequency(parse_record(record(10, 'A', 'G', 'DP=30;AF1=0.9')))
+    assert not passes_allele_frequency(parse_record(record(10, 'A', 'G', 'DP=30')))
+
+
+def test_read_variants_groups_passing_records():
+    lines = ['##fileformat=VCFv4.2\n', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n',
+             record(5, 'A', 'G', PASSING), record(9, 'C', 'T', 'DP=30;AF1=0.5;DP4=8,7,8,7;MQ=60'),
+             record(3, 'G', 'C', PASSING, chrom='region_3')]
+    variants = read_variants(lines)
+    assert sorted(variants) == ['region_1', 'region_3']
+    assert [v.pos for v in variants['region_1']] == [5]
+
+
+def test_apply_snp_insertion_and_deletion():
+    seq = 'ACGTACGTACGT'
+    variants = [parse_record(record(2, 'C', 'G', PASSING)),
+                parse_record(record(5, 'A', 'ATTT', PASSING)),
+                parse_record(record(9, 'ACG', 'A', PASSING))]
+    assert apply_variants('region_1', seq, variants) == 'AGGTATTTCGTAT'
+
+
+def test_overlapping_and_mismatching_variants_are_skipped(capsys):
+    seq = 'ACGTACGTACGT'
+    variants = [parse_record(record(3, 'GTA', 'G', PASSING, qual='20')),
+                parse_record(record(4, 'T', 'C', PASSING)),             # inside the deletion applied above
+                parse_record(record(8, 'A', 'C', PASSING)),             # REF does not match ('T')
+                parse_record(record(10, 'C', 'T', PASSING, genotype='0'))]   # genotyped as the reference
+    assert apply_variants('region_1', seq, variants) == 'ACGCGTACGT'
+    messages = capsys.readouterr().err
+    assert 'region_1:4, it overlaps' in messages
+    assert 'region_1:8, REF A does not match' in messages
+
+
+def test_higher_quality_call_wins_at_the_same_position():
+    variants = [parse_record(record(2, 'C', 'A', PASSING, qual='10')), parse_record(record(2, 'C', 'T', PASSING))]
+    assert apply_consensus({'region_1': 'ACGT', 'region_2': 'GGGG'}, {'region_1': variants}) == \
+        {'region_1': 'ATGT', 'region_2': 'GGGG'}